@@ -20,17 +20,30 @@ if [ ! -L "/workspace/LTX-Video/models" ]; then
   echo "[entrypoint] Создан симлинк models -> $MODELS_DIR"
 fi
 
-# Качаем веса только если нет маркера
-if [ ! -f "$MARKER_FILE" ]; then
-  echo "[entrypoint] Первый запуск - загружаем веса модели..."
-  cd /workspace/LTX-Video
-  /workspace/LTX-Video/env/bin/python download_weights.py
-  touch "$MARKER_FILE"
-  echo "[entrypoint] Веса загружены и закешированы!"
+# Таймлайн старта: время проверки/загрузки весов читает startup_timeline.py
+export LTX_ENTRYPOINT_TIMELINE="${LTX_ENTRYPOINT_TIMELINE:-/tmp/ltx_entrypoint_timeline.json}"
+WEIGHTS_STARTED_AT=$(date +%s.%N)
+WEIGHTS_DOWNLOADED=false
+
+# Маркер пишет сам download_weights.py (атомарно, только после проверки sha256 всех файлов).
+# При валидном маркере скрипт сразу выходит; старый пустой маркер или оборванная загрузка
+# приводят к проверке и докачке.
+cd /workspace/LTX-Video
+if ! /workspace/LTX-Video/env/bin/python download_weights.py --models-dir "$MODELS_DIR" --marker "$MARKER_FILE" --check-only; then
+  echo "[entrypoint] Загружаем/проверяем веса модели..."
+  /workspace/LTX-Video/env/bin/python download_weights.py --models-dir "$MODELS_DIR" --marker "$MARKER_FILE"
+  WEIGHTS_DOWNLOADED=true
+  echo "[entrypoint] Веса загружены, проверены и закешированы!"
 else
-  echo "[entrypoint] Используем закешированные веса из $MODELS_DIR"
+  echo "[entrypoint] Используем проверенные веса из $MODELS_DIR"
 fi
 
+WEIGHTS_FINISHED_AT=$(date +%s.%N)
+printf '{"phases": [{"name": "entrypoint.weights_check", "started_at": %s, "wall_seconds": %s, "downloaded": %s}]}\n' \
+  "$WEIGHTS_STARTED_AT" \
+  "$(awk "BEGIN {printf \"%.3f\", $WEIGHTS_FINISHED_AT - $WEIGHTS_STARTED_AT}")" \
+  "$WEIGHTS_DOWNLOADED" > "$LTX_ENTRYPOINT_TIMELINE" || true
+
 # Запускаем соответствующий режим
 if [ "$RUN_MODE" = "serverless" ]; then
   exec /workspace/LTX-Video/env/bin/python /workspace/rp_handler.py
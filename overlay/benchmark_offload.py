@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк выгрузки весов: пропускная способность и пик памяти GPU в режимах LTX_OFFLOAD
+Каждый режим — отдельный процесс (режим читается при импорте, веса грузятся заново):
+загрузка, один прогон на прогрев, затем --runs замеров на одном размере.
+По умолчанию промпты уникальные, как в реальном трафике: T5 и улучшатели промптов
+отрабатывают на каждой задаче (--repeat-prompt — все попадания в кеши).
+
+Запуск (из /workspace/LTX-Video):
+    python benchmark_offload.py --modes off,phase,blocks --height 512 --width 768 --num-frames 121
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+
+def run_mode(args):
+    """Дочерний процесс: замеры одного режима, результат — JSON строкой в stdout"""
+    import torch
+    import inference_daemon_official as daemon
+    import offload
+
+    loaded_at = time.time()
+    if not daemon.load_models_once():
+        raise SystemExit("load_models_once() вернул False")
+    load_seconds = time.time() - loaded_at
+
+    def run(index):
+        prompt = args.prompt if args.repeat_prompt else f"{args.prompt} (take {index})"
+        config, _ = daemon.build_inference_config({
+            'prompt': prompt,
+            'negative_prompt': daemon.DEFAULT_NEGATIVE_PROMPT,
+            'height': args.height,
+            'width': args.width,
+            'num_frames': args.num_frames,
+            'seed': index,
+        })
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        started_at = time.time()
+        daemon.infer_with_ready_pipeline(config, daemon.global_pipeline, daemon.global_pipeline_config, in_memory=True)
+        torch.cuda.synchronize()
+        return time.time() - started_at, torch.cuda.max_memory_allocated()
+
+    run(0)
+    seconds, peaks = [], []
+    for index in range(1, args.runs + 1):
+        elapsed, peak = run(index)
+        seconds.append(elapsed)
+        peaks.append(peak)
+    result = {
+        'mode': offload.offloader.mode,
+        'load_seconds': round(load_seconds, 1),
+        'seconds': [round(s, 2) for s in seconds],
+        'mean_seconds': round(sum(seconds) / len(seconds), 2),
+        'jobs_per_minute': round(60 * len(seconds) / sum(seconds), 2),
+        'peak_gb': round(max(peaks) / 1024 ** 3, 2),
+        'offload': offload.offloader.stats(),
+    }
+    print(RESULT_PREFIX + json.dumps(result, ensure_ascii=False), flush=True)
+
+
+def run_all(args):
+    results = []
+    for mode in args.modes.split(","):
+        env = {**os.environ, "LTX_OFFLOAD": mode}
+        command = [sys.executable, os.path.abspath(__file__), "--child", *sys.argv[1:]]
+        print(f"▶️ Режим {mode}...", flush=True)
+        process = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True)
+        lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+        if process.returncode != 0 or not lines:
+            # Полная модель не влезает в память без выгрузки — это тоже результат
+            print(f"❌ Режим {mode} не отработал (код {process.returncode})", flush=True)
+            results.append({'mode': mode, 'error': process.returncode})
+            continue
+        results.append(json.loads(lines[-1][len(RESULT_PREFIX):]))
+
+    baseline = next((r for r in results if r.get('mode') == "off" and 'error' not in r), None)
+    print(f"\n{'режим':<8} {'с/задачу':>9} {'задач/мин':>10} {'пик GB':>8} {'к off':>7}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['mode']:<8} {'—':>9} {'—':>10} {'—':>8} {'—':>7}")
+            continue
+        slowdown = f"x{result['mean_seconds'] / baseline['mean_seconds']:.2f}" if baseline else "—"
+        print(
+            f"{result['mode']:<8} {result['mean_seconds']:>9.2f} {result['jobs_per_minute']:>10.2f} "
+            f"{result['peak_gb']:>8.2f} {slowdown:>7}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Результаты: {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк выгрузки весов на хост (LTX_OFFLOAD)")
+    parser.add_argument("--modes", default="off,phase,blocks", help="Режимы через запятую")
+    parser.add_argument("--runs", type=int, default=3, help="Замеров на режим (после одного прогрева)")
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--num-frames", type=int, default=121)
+    parser.add_argument("--prompt", default="A red fox running through a snowy forest, cinematic lighting")
+    parser.add_argument("--repeat-prompt", action="store_true", help="Один промпт на все прогоны (кеши T5 и LLM)")
+    parser.add_argument("--output", help="Куда сохранить результаты (JSON)")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_mode(args)
+    else:
+        run_all(args)
+
+
+if __name__ == "__main__":
+    main()
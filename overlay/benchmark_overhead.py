@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк накладных расходов вокруг модели (GPU не нужен)
+Вместо LTX pipeline — FakePipeline: случайный тензор реальной формы выхода (B, 3, F, H, W) в [0, 1]
+(bf16 на GPU, если он есть, иначе float32 на CPU); шаги denoising — только вызовы callback'а.
+Случаи:
+- infer      — infer_with_ready_pipeline(in_memory=True): промпт из кешей, обрезка паддинга, uint8 и копия
+               на хост, ffmpeg (шум для x264 — худший случай по битрейту и времени кодирования);
+- infer_file — то же с записью MP4 на диск;
+- mimsave    — imageio.mimsave тех же кадров (прежний путь кодирования, для сравнения);
+- base64     — result_uploader.encode_base64_chunked результата (ответ rp_handler без хранилища);
+- upload     — MultipartStream с клиентом S3, который никуда не шлёт (части, пул потоков, spool на диск);
+- file_ipc   — команда JSON -> захват демоном (rename) -> result JSON -> чтение на стороне Celery
+               (без интервала опроса: он добавляет до 2с сверху);
+- rpc_ipc    — submit через Unix socket демона и ответ (быстрый путь Celery -> демон).
+На каждый случай — p50, p99, пропускная способность и пиковый RSS процесса во время случая.
+--save-baseline сохраняет результаты, --baseline сравнивает p50 и помечает регрессии (код выхода 1).
+
+Запуск (из /workspace/LTX-Video):
+    python benchmark_overhead.py --shapes 512x768,720x1280 --frames 49,121 --repeats 5
+    python benchmark_overhead.py --baseline overhead_baseline.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import queue
+import shutil
+import argparse
+import dataclasses
+import tempfile
+import threading
+
+WORK_DIR = tempfile.mkdtemp(prefix="ltx_overhead_")
+# До импорта демона: модель памяти, таймлайн и лог — во временную папку, а не на том
+os.environ.setdefault("LTX_MEMORY_MODEL_PATH", os.path.join(WORK_DIR, "memory_model.json"))
+os.environ.setdefault("LTX_STARTUP_TIMELINE", os.path.join(WORK_DIR, "startup_timeline.json"))
+os.environ.setdefault("LTX_DAEMON_LOG", os.path.join(WORK_DIR, "daemon.log"))
+os.environ.setdefault("LTX_METRICS", "0")
+
+import torch
+
+import daemon_rpc
+import job_leases
+import result_uploader
+from frame_transfer import quantize_frames
+
+BASELINE_THRESHOLD = 0.10
+FAKE_PROMPT_TOKENS = 256
+FAKE_TEXT_DIM = 4096
+
+
+class RssSampler:
+    """Пиковый RSS за время случая: опрос /proc/self/statm в фоне"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def rss():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self._thread = threading.Thread(target=self._loop, name="rss-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+        return False
+
+
+class FakeResult:
+    def __init__(self, images):
+        self.images = images
+
+
+class FakePipeline:
+    """Двойник LTXMultiScalePipeline: та же сигнатура вызова, на выходе — случайные кадры"""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.dtype = torch.bfloat16 if self.device.type == "cuda" else torch.float32
+        # get_video_pipeline() берёт .video_pipeline — эмбеддинги тоже даёт двойник
+        self.video_pipeline = self
+        self.vae = None
+        self.latent_upsampler = None
+
+    def encode_prompt(self, prompt, do_classifier_free_guidance=False, device=None, **kwargs):
+        embeds = torch.randn(1, FAKE_PROMPT_TOKENS, FAKE_TEXT_DIM, device=device, dtype=self.dtype)
+        mask = torch.ones(1, FAKE_PROMPT_TOKENS, device=device, dtype=torch.int64)
+        return embeds, mask, None, None
+
+    def __call__(self, height, width, num_frames, prompt_embeds, callback_on_step_end=None,
+                 first_pass=None, second_pass=None, timesteps=None, **kwargs):
+        steps = len((first_pass or {}).get("timesteps") or timesteps or ()) + len((second_pass or {}).get("timesteps") or ())
+        for step in range(steps):
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step, None, {})
+        images = torch.rand(
+            (prompt_embeds.shape[0], 3, num_frames, height, width), device=self.device, dtype=self.dtype
+        )
+        return FakeResult(images)
+
+
+class NullS3Client:
+    """Клиент S3, который принимает части и ничего не отправляет"""
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "benchmark"}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        return {"ETag": f"etag-{PartNumber}-{len(Body)}"}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+    def put_object(self, **kwargs):
+        return {}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://benchmark.invalid/{Params['Bucket']}/{Params['Key']}"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def measure(name, shape, fn, repeats, units=1.0, unit="ops"):
+    """fn() выполняется repeats раз после одного прогрева -> словарь результата"""
+    fn()
+    seconds = []
+    with RssSampler() as rss:
+        for _ in range(repeats):
+            started_at = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - started_at)
+    result = {
+        "case": name,
+        "shape": shape,
+        "runs": repeats,
+        "p50_ms": round(percentile(seconds, 50) * 1000, 2),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 2),
+        "throughput": round(units * repeats / sum(seconds), 2) if sum(seconds) else None,
+        "unit": f"{unit}/s",
+        "peak_rss_mb": round(rss.peak / 1024 ** 2, 1),
+    }
+    print(
+        f"  {name:<11} {shape:<14} p50 {result['p50_ms']:>9.2f}мс  p99 {result['p99_ms']:>9.2f}мс  "
+        f"{result['throughput']:>9.2f} {result['unit']:<9} RSS {result['peak_rss_mb']:.0f}MB",
+        flush=True,
+    )
+    return result
+
+
+def setup_daemon(device):
+    """Демон с двойником pipeline: кеши эмбеддингов и промптов во временной папке, LLM не вызывается"""
+    import inference_daemon_official as daemon
+    from ltx_video.inference import load_pipeline_config
+    from embedding_cache import EmbeddingCache
+    from prompt_cache import EnhancedPromptCache
+
+    daemon.global_pipeline_config = load_pipeline_config("ltxv-13b-0.9.8-distilled.yaml")
+    daemon.global_pipeline = FakePipeline(device)
+    daemon.global_embedding_cache = EmbeddingCache(encoder_id="benchmark", persist_dir="")
+    daemon.global_prompt_cache = EnhancedPromptCache(enhancer_id="benchmark", cache_dir=os.path.join(WORK_DIR, "prompts"))
+    # Улучшатель промптов — тоже модель: двойник возвращает промпт как есть
+    daemon.enhance_prompt_text = lambda prompt, pipeline, conditioning_items: prompt
+    return daemon
+
+
+def video_cases(daemon, height, width, num_frames, repeats):
+    from ltx_video.inference import InferenceConfig
+
+    shape = f"{height}x{width}x{num_frames}"
+    config = InferenceConfig(
+        prompt="benchmark", negative_prompt=daemon.DEFAULT_NEGATIVE_PROMPT,
+        height=height, width=width, num_frames=num_frames, seed=0,
+        pipeline_config="ltxv-13b-0.9.8-distilled.yaml", frame_rate=24,
+    )
+    pipeline, pipeline_config = daemon.global_pipeline, daemon.global_pipeline_config
+    results = []
+
+    def infer():
+        return daemon.infer_with_ready_pipeline(config, pipeline, pipeline_config, in_memory=True)
+
+    results.append(measure("infer", shape, infer, repeats, units=num_frames, unit="frames"))
+    video_bytes = infer()[0]
+
+    file_config = dataclasses.replace(config, output_path=os.path.join(WORK_DIR, "videos"))
+
+    def infer_file():
+        for path in daemon.infer_with_ready_pipeline(file_config, pipeline, pipeline_config):
+            os.remove(path)
+
+    results.append(measure("infer_file", shape, infer_file, repeats, units=num_frames, unit="frames"))
+
+    try:
+        import imageio
+        frames = quantize_frames(torch.rand(3, num_frames, height, width)).numpy()
+        mimsave_path = os.path.join(WORK_DIR, "mimsave.mp4")
+        results.append(measure(
+            "mimsave", shape, lambda: imageio.mimsave(mimsave_path, frames, fps=24),
+            repeats, units=num_frames, unit="frames",
+        ))
+        del frames
+    except ImportError:
+        print("  mimsave: imageio не установлен, пропускаем", flush=True)
+
+    megabytes = len(video_bytes) / 1024 ** 2
+    results.append(measure(
+        "base64", shape, lambda: result_uploader.encode_base64_chunked(io.BytesIO(video_bytes), limit=None),
+        repeats, units=megabytes, unit="MB",
+    ))
+
+    try:
+        uploader = result_uploader.ResultUploader(
+            endpoint_url="http://127.0.0.1:9", access_key_id="benchmark", secret_access_key="benchmark",
+            bucket="benchmark", part_bytes=5 * 1024 * 1024,
+        )
+        uploader.client = NullS3Client()
+
+        def upload():
+            stream = uploader.open_stream("benchmark.mp4")
+            try:
+                for offset in range(0, len(video_bytes), 256 * 1024):
+                    stream.write(video_bytes[offset:offset + 256 * 1024])
+                stream.close()
+            finally:
+                stream.discard()
+
+        results.append(measure("upload", shape, upload, repeats, units=megabytes, unit="MB"))
+    except ImportError:
+        print("  upload: boto3 не установлен, пропускаем", flush=True)
+    return results
+
+
+def ipc_cases(repeats):
+    results = []
+    commands_dir = os.path.join(WORK_DIR, "inference_commands")
+    lease = job_leases.WorkerLease("benchmark", commands_dir=commands_dir)
+    os.makedirs(lease.claimed_dir, exist_ok=True)
+    command = {
+        "prompt": "benchmark " * 40, "negative_prompt": "worst quality", "image_base64": None,
+        "height": 512, "width": 768, "num_frames": 121, "seed": 0,
+    }
+
+    def file_ipc():
+        # Celery: команда в папку; демон: захват, чтение, результат; Celery: чтение результата
+        command_id = os.urandom(8).hex()
+        command_path = os.path.join(commands_dir, f"command_{command_id}.json")
+        with open(command_path, "w") as f:
+            json.dump(command, f)
+        claimed_path = lease.claim(lease.pending()[0])
+        with open(claimed_path) as f:
+            json.load(f)
+        result_path = os.path.join(commands_dir, f"result_{command_id}.json")
+        job_leases.write_json_atomic(result_path, {"status": "success", "result": "video.mp4", "command_id": command_id})
+        lease.release(claimed_path)
+        with open(result_path) as f:
+            json.load(f)
+        os.remove(result_path)
+
+    results.append(measure("file_ipc", "-", file_ipc, repeats))
+
+    jobs = queue.Queue()
+    socket_path = os.path.join(WORK_DIR, "daemon.sock")
+    server = daemon_rpc.RPCServer(jobs, socket_path=socket_path)
+    server.start()
+
+    def serve():
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            job["reply"].progress(stage="started", command_id=job["command_id"])
+            job["reply"].finish({"status": "success", "result": "video.mp4", "command_id": job["command_id"]})
+
+    worker = threading.Thread(target=serve, name="fake-daemon", daemon=True)
+    worker.start()
+    try:
+        results.append(measure(
+            "rpc_ipc", "-", lambda: daemon_rpc.submit_job(command, socket_path=socket_path, timeout=10), repeats,
+        ))
+    finally:
+        jobs.put(None)
+        server.stop()
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """-> список регрессий по p50 относительно сохранённого прогона"""
+    with open(baseline_path) as f:
+        baseline = {(r["case"], r["shape"]): r for r in json.load(f)["results"]}
+    regressions = []
+    print(f"\n📏 Сравнение с {baseline_path} (порог +{threshold * 100:.0f}% по p50):")
+    for result in results:
+        base = baseline.get((result["case"], result["shape"]))
+        if base is None:
+            continue
+        change = result["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+        regressed = change > threshold
+        print(
+            f"  {'❌' if regressed else '✅'} {result['case']:<11} {result['shape']:<14} "
+            f"{base['p50_ms']:>9.2f} -> {result['p50_ms']:>9.2f}мс ({change * 100:+.1f}%)"
+        )
+        if regressed:
+            regressions.append({**result, "baseline_p50_ms": base["p50_ms"], "change": round(change, 4)})
+    return regressions
+
+
+def parse_shapes(value):
+    shapes = []
+    for item in value.split(","):
+        height, width = item.lower().split("x")
+        shapes.append((int(height), int(width)))
+    return shapes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы вокруг модели на двойнике pipeline")
+    parser.add_argument("--shapes", default="512x768,720x1280", help="Размеры HxW через запятую")
+    parser.add_argument("--frames", default="49,121", help="Количество кадров через запятую")
+    parser.add_argument("--repeats", type=int, default=5, help="Замеров на случай (после одного прогрева)")
+    parser.add_argument("--ipc-repeats", type=int, default=200, help="Замеров на случай IPC")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", help="Куда сохранить результаты (JSON)")
+    parser.add_argument("--save-baseline", help="Сохранить результаты как базовую линию")
+    parser.add_argument("--baseline", help="Сравнить с базовой линией и пометить регрессии")
+    parser.add_argument("--threshold", type=float, default=BASELINE_THRESHOLD, help="Допустимый рост p50 (доля)")
+    args = parser.parse_args()
+
+    print(f"🧪 Накладные расходы на {args.device}, рабочая папка {WORK_DIR}", flush=True)
+    results = []
+    try:
+        daemon = setup_daemon(args.device)
+        for height, width in parse_shapes(args.shapes):
+            for num_frames in (int(f) for f in args.frames.split(",")):
+                results.extend(video_cases(daemon, height, width, num_frames, args.repeats))
+        results.extend(ipc_cases(args.ipc_repeats))
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        "device": args.device,
+        "torch": torch.__version__,
+        "created_at": time.time(),
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 Результаты: {path}")
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Регрессий: {len(regressions)}")
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
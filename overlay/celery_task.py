@@ -10,6 +10,7 @@ from diffusers import LTXConditionPipeline, LTXLatentUpsamplePipeline
 from diffusers.pipelines.ltx.pipeline_ltx_condition import LTXVideoCondition
 from diffusers.utils import export_to_video, load_image, load_video
 from my_celery import celery_app, get_models, load_models_on_startup
+from conditioning import load_image as load_conditioning_image
 
 def round_to_nearest_resolution_acceptable_by_vae(height, width, pipe):
     """Округляет размеры до ближайших, приемлемых для VAE."""
@@ -129,15 +130,10 @@ def generate_video_task(
 
     # Определяем режим: text-to-video или image-to-video
     if image_base64 and isinstance(image_base64, str):
-        # image-to-video
-        image = Image.open(io.BytesIO(base64.b64decode(image_base64))).convert("RGB")
+        # image-to-video: декодируем в памяти (JPEG сразу в уменьшенном размере), без временного MP4
+        image = load_conditioning_image(image_base64, target_size=(width, height))
         image = image.resize((width, height), Image.Resampling.LANCZOS)
-        # Сжимаем картинку в видео (1 кадр)
-        temp_video_path = f"temp_{uuid.uuid4().hex}.mp4"
-        export_to_video([image], temp_video_path, fps=30)
-        video_frames = load_video(temp_video_path)
-        os.remove(temp_video_path)
-        condition1 = LTXVideoCondition(video=video_frames, frame_index=0)
+        condition1 = LTXVideoCondition(image=image, frame_index=0)
         conditions = [condition1]
     else:
         # text-to-video
@@ -5,8 +5,49 @@ import time
 from pathlib import Path
 from celery import shared_task
 
-@shared_task(name="celery_task.generate_video_inference_task")
+import daemon_rpc
+import progress
+import result_cache
+import coalescing
+
+
+def _finish_result(result_data, task=None):
+    """Копируем готовое видео в task_results"""
+    if result_data['status'] != 'success':
+        raise Exception(f"Ошибка в демоне: {result_data['error']}")
+    
+    print("✅ Генерация завершена успешно!")
+    if result_data.get('coalesced_with'):
+        print(f"🔗 Результат общий с задачей {result_data['coalesced_with']}")
+    
+    # Дубли этой задачи, склеенные на уровне API, получат тот же результат — считаем сэкономленное
+    coalescer = coalescing.task_coalescer(task.app) if task is not None else None
+    if coalescer is not None:
+        try:
+            followers = coalescer.finish(task.request.id, result_data.get('generation_seconds'))
+            if followers:
+                print(f"🔗 Результат ждали ещё {followers} одинаковых запросов")
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить счётчики склейки: {e}")
+    
+    # Копируем результат в task_results
+    video_path = result_data['result']
+    final_path = f"task_results/result_{uuid.uuid4().hex}.mp4"
+    os.makedirs("task_results", exist_ok=True)
+    
+    import shutil
+    shutil.copy2(video_path, final_path)
+    
+    return final_path
+
+
+def _progress_meta(message):
+    return {key: message.get(key) for key in ('stage', 'step', 'steps', 'elapsed_seconds', 'eta_seconds', 'progress', 'preview')}
+
+
+@shared_task(name="celery_task.generate_video_inference_task", bind=True)
 def generate_video_inference_task(
+    self,
     prompt,
     negative_prompt=None,
     image_base64=None,
@@ -14,7 +55,13 @@ def generate_video_inference_task(
     height=720,
     num_frames=120,
     seed=0,
-    output_path=None
+    output_path=None,
+    priority=None,
+    deadline_seconds=None,
+    preview=None,
+    idempotency_key=None,
+    oversize=None,
+    vae_tiling=None
 ):
     """Генерируем видео через inference демон"""
     print(f"🎬 Начинаем генерацию через inference демон...")
@@ -23,46 +70,70 @@ def generate_video_inference_task(
     print(f"🎞️ Кадры: {num_frames}")
     print(f"🎲 Seed: {seed}")
     
-    # Сохраняем изображение если передано в base64
-    image_path = None
-    if image_base64:
-        import base64
-        from PIL import Image
-        import io
-        
-        # Декодируем base64
-        image_data = base64.b64decode(image_base64.split(',')[1] if ',' in image_base64 else image_base64)
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Конвертируем в RGB если нужно (для JPEG)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Сохраняем временный файл
-        image_path = f"temp_image_{uuid.uuid4().hex}.jpg"
-        image.save(image_path)
-        print(f"💾 Изображение сохранено: {image_path}")
-    else:
-        # Для text-to-video режима не используем изображение
-        image_path = None
-    
     # Создаем уникальный ID для команды
     command_id = uuid.uuid4().hex
     command_file = f"inference_commands/command_{command_id}.json"
     result_file = f"inference_commands/result_{command_id}.json"
+    progress_file = f"inference_commands/progress_{command_id}.json"
     
     # Создаем команду для демона
     command = {
         'prompt': prompt,
         'negative_prompt': negative_prompt or "worst quality, inconsistent motion, blurry, jittery, distorted",
-        'image_path': image_path,
+        # Картинка уходит демону как есть, он декодирует её в памяти
+        'image_base64': image_base64,
         'height': height,
         'width': width,
         'num_frames': num_frames,
         'seed': seed,
-        'output_path': output_path
+        'output_path': output_path,
+        # Планировщик демона: класс приоритета и дедлайн (секунды от постановки)
+        'priority': priority,
+        'deadline_seconds': deadline_seconds,
+        # Превью из первого прохода: "poster" (JPEG) или "clip" (короткий MP4), путь — в прогрессе
+        'preview': preview,
+        # Одинаковые задачи в очереди/работе демона склеиваются по этому ключу (иначе — по хешу запроса)
+        'idempotency_key': idempotency_key,
+        # Размер, который не помещается в память GPU: "reject" (по умолчанию) или "downscale"
+        'oversize': oversize,
+        # Декодирование VAE тайлами: "auto" (если целиком не помещается), "on" или "off"
+        'vae_tiling': vae_tiling
     }
     
+    # Повтор уже сгенерированного (ретрай, дубль) — сразу из кеша результатов, без демона
+    cache_key = result_cache.command_key(command)
+    hit = result_cache.get_cache().get(cache_key)
+    if hit is not None:
+        print(f"🎯 Результат из кеша: {cache_key[:12]}")
+        return _finish_result({'status': 'success', 'result': hit[0]}, task=self)
+    
+    # Быстрый путь: RPC сокет демона (без опроса файловой системы)
+    socket_path = daemon_rpc.pick_daemon_socket()
+    if socket_path is not None:
+        print(f"🔌 Отправляем команду демону через RPC ({socket_path}): {command_id}")
+        command['command_id'] = command_id
+        def on_message(message):
+            print(f"📡 Демон: {message}")
+            # Позиция в очереди демона видна клиенту через /status
+            if message.get('stage') == 'queued':
+                self.update_state(state='QUEUED', meta={
+                    'position': message.get('position'),
+                    'expected_start': message.get('expected_start'),
+                    'expected_wait_seconds': message.get('expected_wait_seconds'),
+                })
+            elif message.get('stage') == 'coalesced':
+                # Такая же задача уже в работе у демона — ждём её результат
+                self.update_state(state='QUEUED', meta={'coalesced_with': message.get('leader_command_id')})
+            elif message.get('stage') == 'started':
+                self.update_state(state='STARTED')
+            elif message.get('stage') in progress.STAGES:
+                # Шаг/этап генерации, прошедшее время и ETA
+                self.update_state(state='PROGRESS', meta=_progress_meta(message))
+        
+        result_data = daemon_rpc.submit_job(command, socket_path=socket_path, on_message=on_message)
+        return _finish_result(result_data, task=self)
+    
+    # Файловый режим: общая очередь, задачу захватит первый свободный демон
     # Создаем папку для команд
     os.makedirs("inference_commands", exist_ok=True)
     
@@ -76,7 +147,18 @@ def generate_video_inference_task(
     max_wait_time = 3600  # 1 час
     start_time = time.time()
     
+    last_progress = None
     while time.time() - start_time < max_wait_time:
+        # Прогресс, который демон пишет рядом с результатом
+        try:
+            with open(progress_file, 'r') as f:
+                progress_data = json.load(f)
+            if progress_data != last_progress:
+                last_progress = progress_data
+                self.update_state(state='PROGRESS', meta=_progress_meta(progress_data))
+        except (OSError, ValueError):
+            pass
+        
         if os.path.exists(result_file):
             try:
                 # Читаем результат
@@ -86,24 +168,7 @@ def generate_video_inference_task(
                 # Удаляем файл результата
                 os.remove(result_file)
                 
-                if result_data['status'] == 'success':
-                    print("✅ Генерация завершена успешно!")
-                    
-                    # Копируем результат в task_results
-                    video_path = result_data['result']
-                    final_path = f"task_results/result_{uuid.uuid4().hex}.mp4"
-                    os.makedirs("task_results", exist_ok=True)
-                    
-                    import shutil
-                    shutil.copy2(video_path, final_path)
-                    
-                    # Удаляем временное изображение
-                    if image_path and image_path.startswith("temp_image_"):
-                        os.remove(image_path)
-                    
-                    return final_path
-                else:
-                    raise Exception(f"Ошибка в демоне: {result_data['error']}")
+                return _finish_result(result_data, task=self)
                     
             except Exception as e:
                 print(f"❌ Ошибка чтения результата: {e}")
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Склейка одинаковых задач, которые уже в очереди или в работе
+Клиент отвалился по таймауту и отправил запрос ещё раз, UI прислал пачку одинаковых запросов —
+без склейки каждый дубль занимает свой слот GPU. Ключ — idempotency_key клиента или канонический
+хеш запроса (тот же, что у кеша результатов). Дубль присоединяется к ведущей задаче и получает
+её прогресс и её результат.
+Два уровня:
+- InflightRegistry — внутри демона (RPC и файловые задачи одного GPU);
+- TaskCoalescer — на уровне API: ключ -> task_id Celery в Redis, дубль получает тот же task_id
+  (задачи разных GPU-демонов, несколько процессов API).
+Счётчик сэкономленных GPU-секунд — время генерации ведущей задачи на каждого присоединённого.
+"""
+
+import os
+import logging
+import threading
+
+import result_cache
+
+logger = logging.getLogger(__name__)
+
+COALESCE = os.environ.get("LTX_COALESCE", "1") == "1"
+# Сколько живёт ключ задачи в Redis (страховка, если воркер Celery упал и задача не завершилась)
+INFLIGHT_TTL = int(os.environ.get("LTX_COALESCE_TTL", "3600"))
+REDIS_PREFIX = "ltx:coalesce"
+
+
+def coalesce_key(command, request_hash=None, **key_kwargs):
+    """idempotency_key клиента или канонический хеш запроса; None — не склеиваем"""
+    if not COALESCE or not command:
+        return None
+    if command.get("idempotency_key"):
+        return f"idempotency:{command['idempotency_key']}"
+    if request_hash is None:
+        request_hash = result_cache.command_key(command, **key_kwargs)
+    if not request_hash:
+        return None
+    # Политика oversize в хеш результата не входит (уменьшенное не кешируется), но задачи с разной
+    # политикой дают разный ответ (ошибка или уменьшенное видео) — не склеиваем их
+    oversize = str(command.get("oversize") or "").strip().lower()
+    return f"request:{request_hash}:{oversize}" if oversize else f"request:{request_hash}"
+
+
+class InflightRegistry:
+    """Ведущие задачи демона по ключу склейки; дубли — в job['followers'] ведущей"""
+
+    def __init__(self):
+        self._leaders = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+        self.gpu_seconds_saved = 0.0
+
+    def leader(self, key):
+        with self._lock:
+            return self._leaders.get(key) if key is not None else None
+
+    def attach(self, key, job, lead=True):
+        """Ведущая с тем же ключом, к которой присоединили job, или None
+
+        lead=False — job не становится ведущей (файловая команда, ещё не захваченная демоном).
+        """
+        if key is None:
+            return None
+        with self._lock:
+            leader = self._leaders.get(key)
+            if leader is None or leader is job:
+                if lead:
+                    self._leaders[key] = job
+                return None
+            leader.setdefault('followers', []).append(job)
+            self.coalesced += 1
+            return leader
+
+    def release(self, job):
+        """Ведущая завершена: снимаем её с учёта и возвращаем присоединённые задачи"""
+        key = job.get('coalesce_key')
+        with self._lock:
+            if key is not None and self._leaders.get(key) is job:
+                del self._leaders[key]
+            # После снятия с учёта новые дубли сюда не попадут
+            return list(job.get('followers', ()))
+
+    def record_saved(self, seconds):
+        with self._lock:
+            self.gpu_seconds_saved += seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._leaders),
+                'coalesced': self.coalesced,
+                'gpu_seconds_saved': round(self.gpu_seconds_saved, 1),
+            }
+
+
+class TaskCoalescer:
+    """Склейка на уровне API: <prefix>:task:<ключ> -> task_id ведущей задачи Celery (Redis)"""
+
+    def __init__(self, client, ttl=INFLIGHT_TTL):
+        self.client = client
+        self.ttl = ttl
+
+    def submit(self, key, task_id, is_running):
+        """Ведущий task_id для ключа: свой (задачу нужно отправить) или уже работающей задачи
+
+        is_running(task_id) — задача ещё не завершилась; завершённую заменяем новой
+        (повтор готового результата отдаст кеш результатов).
+        """
+        if key is None:
+            return task_id
+        name = f"{REDIS_PREFIX}:task:{key}"
+        for _ in range(3):
+            if self.client.set(name, task_id, nx=True, ex=self.ttl):
+                return task_id
+            existing = self.client.get(name)
+            if existing is None:
+                continue
+            existing = existing.decode() if isinstance(existing, bytes) else existing
+            if is_running(existing):
+                self.client.hincrby(f"{REDIS_PREFIX}:stats", "coalesced", 1)
+                self.client.incr(f"{REDIS_PREFIX}:followers:{existing}")
+                self.client.expire(f"{REDIS_PREFIX}:followers:{existing}", self.ttl)
+                logger.info(f"🔗 Дубль запроса присоединён к задаче {existing}")
+                return existing
+            # Ведущая завершилась — ставим свою (гонка двух процессов здесь стоит лишь одной генерации)
+            self.client.set(name, task_id, ex=self.ttl)
+            return task_id
+        return task_id
+
+    def finish(self, task_id, generation_seconds=None):
+        """Ведущая задача завершена: GPU-секунды на каждого присоединённого — в счётчик"""
+        name = f"{REDIS_PREFIX}:followers:{task_id}"
+        followers = int(self.client.get(name) or 0)
+        self.client.delete(name)
+        if followers and generation_seconds:
+            self.client.hincrbyfloat(f"{REDIS_PREFIX}:stats", "gpu_seconds_saved", followers * generation_seconds)
+        return followers
+
+    def stats(self):
+        raw = self.client.hgetall(f"{REDIS_PREFIX}:stats")
+        raw = {(k.decode() if isinstance(k, bytes) else k): v for k, v in raw.items()}
+        return {
+            'coalesced': int(raw.get('coalesced', 0)),
+            'gpu_seconds_saved': round(float(raw.get('gpu_seconds_saved', 0.0)), 1),
+        }
+
+
+def task_coalescer(celery_app):
+    """TaskCoalescer поверх Redis бэкенда Celery; None — бэкенд не Redis или недоступен"""
+    if not COALESCE:
+        return None
+    client = getattr(celery_app.backend, "client", None)
+    if client is None or not hasattr(client, "set"):
+        return None
+    return TaskCoalescer(client)
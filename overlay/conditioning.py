@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Conditioning изображения для image-to-video прямо из памяти
+Принимает bytes / base64 / numpy массив / PIL.Image, без временных файлов и повторного JPEG.
+JPEG декодируется через draft режим PIL сразу в размере, близком к целевому.
+"""
+
+import io
+import base64
+import hashlib
+import logging
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def decode_base64_image(image_base64):
+    """base64 (в т.ч. data URL) -> сырые bytes"""
+    return base64.b64decode(image_base64.split(',')[1] if ',' in image_base64 else image_base64)
+
+
+def image_hash(image):
+    """Хеш исходных данных картинки (для ключей кешей)"""
+    if isinstance(image, str):
+        image = decode_base64_image(image)
+    if isinstance(image, np.ndarray):
+        image = np.ascontiguousarray(image).tobytes()
+    if isinstance(image, Image.Image):
+        image = image.tobytes()
+    return hashlib.sha256(image).hexdigest()
+
+
+def load_image(image, target_size=None):
+    """Открываем картинку из памяти как RGB PIL.Image
+
+    target_size=(width, height): для JPEG декодер сразу уменьшает картинку (в 2/4/8 раз),
+    но не меньше target_size — дальнейшее кадрирование/ресайз работают с меньшим изображением.
+    """
+    if isinstance(image, str):
+        image = decode_base64_image(image)
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        pil_image = Image.open(io.BytesIO(image))
+        if target_size is not None and pil_image.format == "JPEG":
+            original_size = pil_image.size
+            pil_image.draft("RGB", tuple(int(v) for v in target_size))
+            if pil_image.size != original_size:
+                logger.info(f"🖼️ JPEG draft: {original_size} -> {pil_image.size}")
+    elif isinstance(image, np.ndarray):
+        array = image
+        if array.dtype != np.uint8:
+            array = (np.clip(array, 0, 1) * 255).astype(np.uint8)
+        pil_image = Image.fromarray(array)
+    elif isinstance(image, Image.Image):
+        pil_image = image
+    else:
+        raise ValueError(f"Неподдерживаемый тип изображения: {type(image)}")
+    if pil_image.mode != 'RGB':
+        pil_image = pil_image.convert('RGB')
+    return pil_image
+
+
+def prepare_conditioning_from_images(images, height, width, padding, strengths=None, start_frames=None):
+    """Аналог ltx_video.inference.prepare_conditioning для картинок в памяти
+
+    Тензор получается тем же путём, что и из файла (load_image_to_tensor_with_resize_and_crop
+    с just_crop=True + паддинг), только без чтения с диска.
+    """
+    import torch
+    from ltx_video.inference import load_image_to_tensor_with_resize_and_crop
+    from ltx_video.pipelines.pipeline_ltx_video import ConditioningItem
+
+    strengths = strengths or [1.0] * len(images)
+    start_frames = start_frames or [0] * len(images)
+    conditioning_items = []
+    for image, strength, start_frame in zip(images, strengths, start_frames):
+        pil_image = load_image(image, target_size=(width, height))
+        media_tensor = load_image_to_tensor_with_resize_and_crop(pil_image, height, width, just_crop=True)
+        media_tensor = torch.nn.functional.pad(media_tensor, padding)
+        conditioning_items.append(ConditioningItem(media_tensor, start_frame, strength))
+    return conditioning_items
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Локальный RPC интерфейс inference демона
+Unix domain socket, сообщения — JSON с 4-байтным префиксом длины (big-endian).
+
+Протокол (клиент -> демон):
+    {"op": "submit", "command": {...}}   — поставить задачу, ответы идут потоком
+    {"op": "status"}                     — состояние демона
+    {"op": "ping"}
+
+Поток ответов на submit (демон -> клиент):
+    {"type": "accepted", "command_id": ...}
+    {"type": "progress", ...}            — ноль или больше (stage: "queued" с position/expected_start, "started")
+    {"type": "result", "status": "success"|"error", ...}  — финальное сообщение
+"""
+
+import os
+import json
+import glob
+import socket
+import struct
+import threading
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SOCKET_DIR = os.environ.get("LTX_DAEMON_SOCKET_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+
+def socket_path_for_device(device):
+    """Сокет демона конкретного устройства (по одному демону на GPU)"""
+    return os.path.join(SOCKET_DIR, f"inference_daemon_gpu{device}.sock")
+
+
+DEFAULT_SOCKET_PATH = os.environ.get("LTX_DAEMON_SOCKET") or socket_path_for_device("0")
+
+# Картинка в base64 может быть большой, но не бесконечной
+MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+
+_HEADER = struct.Struct("!I")
+
+
+def send_message(sock, message):
+    """Отправляем одно JSON сообщение с префиксом длины"""
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv(min(remaining, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock):
+    """Читаем одно сообщение; None если соединение закрыто"""
+    header = _recv_exactly(sock, _HEADER.size)
+    if header is None:
+        return None
+    (size,) = _HEADER.unpack(header)
+    if size > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Слишком большое сообщение: {size} байт")
+    body = _recv_exactly(sock, size)
+    if body is None:
+        return None
+    return json.loads(body.decode("utf-8"))
+
+
+class ConnectionReply:
+    """Канал ответов клиенту: прогресс и финальный результат по тому же соединению"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.alive = True
+
+    def send(self, message):
+        if not self.alive:
+            return
+        with self._lock:
+            try:
+                send_message(self._conn, message)
+            except OSError:
+                # Клиент ушёл — генерацию не прерываем, просто перестаём писать
+                self.alive = False
+
+    def progress(self, **fields):
+        self.send({"type": "progress", **fields})
+
+    def finish(self, result):
+        self.send({"type": "result", **result})
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class RPCServer:
+    """Принимает задачи через Unix socket и кладёт их в очередь демона"""
+
+    def __init__(self, job_queue, socket_path=DEFAULT_SOCKET_PATH, status_provider=None, validate=None):
+        self.job_queue = job_queue
+        self.socket_path = socket_path
+        self.status_provider = status_provider
+        # validate(command) -> текст ошибки или None: негодная команда отклоняется сразу, в очередь не идёт
+        self.validate = validate
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        # Убираем сокет, оставшийся от прошлого запуска
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        self._sock.listen(64)
+        self._thread = threading.Thread(target=self._accept_loop, name="rpc-accept", daemon=True)
+        self._thread.start()
+        logger.info(f"🔌 RPC сокет слушает: {self.socket_path}")
+
+    def stop(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+        if os.path.exists(self.socket_path):
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        try:
+            message = recv_message(conn)
+            if message is None:
+                return
+            op = message.get("op")
+            if op == "submit":
+                command = message.get("command") or {}
+                command_id = command.get("command_id") or uuid.uuid4().hex
+                reply = ConnectionReply(conn)
+                error = self.validate(command) if self.validate else None
+                if error:
+                    reply.finish({"status": "error", "error": error, "command_id": command_id})
+                    return
+                reply.send({"type": "accepted", "command_id": command_id})
+                self.job_queue.put({"command_id": command_id, "command": command, "reply": reply})
+                # Держим соединение, пока поток генерации не отдаст результат
+                reply.wait()
+            elif op == "status":
+                status = self.status_provider() if self.status_provider else {}
+                send_message(conn, {"type": "status", **status})
+            elif op == "ping":
+                send_message(conn, {"type": "pong"})
+            else:
+                send_message(conn, {"type": "result", "status": "error", "error": f"Неизвестная операция: {op}"})
+        except Exception as e:
+            logger.error(f"❌ Ошибка RPC соединения: {e}")
+        finally:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+
+def _connect(socket_path, timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(socket_path)
+    return sock
+
+
+def discover_sockets():
+    """Все сокеты демонов в SOCKET_DIR"""
+    return sorted(glob.glob(os.path.join(SOCKET_DIR, "inference_daemon*.sock")))
+
+
+def pick_daemon_socket():
+    """Выбираем наименее загруженного живого демона; None если ни один не отвечает"""
+    best_path, best_load = None, None
+    for socket_path in discover_sockets():
+        try:
+            status = request_status(socket_path, timeout=2)
+        except OSError:
+            continue
+        if not status.get("ready"):
+            continue
+        load = status.get("rpc_queue_depth", 0) + (1 if status.get("busy") else 0)
+        if best_load is None or load < best_load:
+            best_path, best_load = socket_path, load
+    return best_path
+
+
+def submit_job(command, socket_path=DEFAULT_SOCKET_PATH, on_message=None, timeout=None):
+    """Отправляем задачу демону и ждём финальный результат, прогресс отдаём в on_message"""
+    with _connect(socket_path, timeout=timeout) as sock:
+        send_message(sock, {"op": "submit", "command": command})
+        while True:
+            message = recv_message(sock)
+            if message is None:
+                raise ConnectionError("Демон закрыл соединение без результата")
+            if message.get("type") == "result":
+                message.pop("type", None)
+                return message
+            if on_message is not None:
+                on_message(message)
+
+
+def request_status(socket_path=DEFAULT_SOCKET_PATH, timeout=5):
+    """Запрашиваем состояние демона"""
+    with _connect(socket_path, timeout=timeout) as sock:
+        send_message(sock, {"op": "status"})
+        message = recv_message(sock) or {}
+        message.pop("type", None)
+        return message
@@ -1,44 +1,385 @@
-from huggingface_hub import hf_hub_download
+#!/usr/bin/env python3
+"""
+Загрузка весов LTX-Video
+- файл качается параллельно кусками (HTTP Range) в <файл>.part, прогресс кусков — в <файл>.part.json,
+  поэтому прерванная загрузка продолжается с места остановки
+- sha256 считается потоково в отдельном потоке по мере готовности кусков (по порядку),
+  проверка почти не добавляет времени к загрузке
+- ожидаемый sha256 берётся из метаданных Hugging Face (X-Linked-Etag у LFS файлов)
+- готовый файл появляется только после проверки (os.replace), маркер готовности пишется атомарно
+  только когда проверены все файлы
+
+Запускать: python download_weights.py [--models-dir models] [--marker models/.models_ready] [--check-only]
+Для проверки без интернета: LTX_WEIGHTS_BASE_URL=http://127.0.0.1:8080 (любой сервер с поддержкой Range)
+"""
+
 import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
-print("🎬 Проверяем веса LTX-Video...")
-
-# Создаем папку для моделей
-os.makedirs("models", exist_ok=True)
-
-# Проверяем существование файлов
-main_model_path = "./models/ltxv-13b-0.9.8-distilled.safetensors"
-upscaler_path = "./models/ltxv-spatial-upscaler-0.9.8.safetensors"
-
-if os.path.exists(main_model_path) and os.path.exists(upscaler_path):
-    print("✅ Веса уже загружены! Пропускаем загрузку.")
-    print(f"📁 Основная модель: {main_model_path}")
-    print(f"📁 Upscaler: {upscaler_path}")
-else:
-    print("📥 Начинаем загрузку весов...")
-    
-    # Скачиваем основную модель (13B distilled)
-    if not os.path.exists(main_model_path):
-        print("📥 Скачиваем основную модель ltxv-13b-0.9.8-distilled...")
-        hf_hub_download(
-            repo_id="Lightricks/LTX-Video",
-            filename="ltxv-13b-0.9.8-distilled.safetensors",
-            local_dir="./models",
-    local_dir_use_symlinks=False
-)
-    else:
-        print("✅ Основная модель уже существует")
-
-# Скачиваем spatial upscaler
-    if not os.path.exists(upscaler_path):
-        print("📥 Скачиваем spatial upscaler...")
-        hf_hub_download(
-            repo_id="Lightricks/LTX-Video",
-            filename="ltxv-spatial-upscaler-0.9.8.safetensors",
-            local_dir="./models",
-    local_dir_use_symlinks=False
-)
+REPO_ID = "Lightricks/LTX-Video"
+WEIGHT_FILES = [
+    "ltxv-13b-0.9.8-distilled.safetensors",
+    "ltxv-spatial-upscaler-0.9.8.safetensors",
+]
+BASE_URL = os.environ.get("LTX_WEIGHTS_BASE_URL", f"https://huggingface.co/{REPO_ID}/resolve/main")
+MODELS_DIR = os.environ.get("LTX_MODELS_DIR", "models")
+DOWNLOAD_WORKERS = int(os.environ.get("LTX_DOWNLOAD_WORKERS", "8"))
+CHUNK_BYTES = int(float(os.environ.get("LTX_DOWNLOAD_CHUNK_MB", "64")) * 1024 * 1024)
+RETRIES = int(os.environ.get("LTX_DOWNLOAD_RETRIES", "5"))
+TIMEOUT = 60
+READ_BLOCK = 1024 * 1024
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def _headers(url, extra=None):
+    """Заголовки запроса; HF_TOKEN — только хосту BASE_URL, не CDN/S3 из редиректа"""
+    headers = {"User-Agent": "ltxv-runpod-bootstrap"}
+    token = os.environ.get("HF_TOKEN")
+    if token and urllib.parse.urlsplit(url).netloc == urllib.parse.urlsplit(BASE_URL).netloc:
+        headers["Authorization"] = f"Bearer {token}"
+    headers.update(extra or {})
+    return headers
+
+
+def remote_metadata(url):
+    """(url для загрузки, размер, sha256 или None, поддержка Range)
+
+    HF отдаёт редирект на CDN, а хеш LFS файла — в X-Linked-Etag; редирект не выполняем,
+    чтобы прочитать эти заголовки.
+    """
+    opener = urllib.request.build_opener(_NoRedirect)
+    request = urllib.request.Request(url, method="HEAD", headers=_headers(url))
+    try:
+        response = opener.open(request, timeout=TIMEOUT)
+        headers, download_url = response.headers, url
+    except urllib.error.HTTPError as e:
+        if e.code not in (301, 302, 303, 307, 308):
+            raise
+        headers = e.headers
+        download_url = urllib.request.urljoin(url, headers["Location"])
+
+    size = headers.get("X-Linked-Size") or headers.get("Content-Length")
+    etag = (headers.get("X-Linked-Etag") or headers.get("ETag") or "").strip('"').lower()
+    if download_url != url:
+        # Размер и Accept-Ranges знает уже CDN
+        with urllib.request.urlopen(urllib.request.Request(download_url, method="HEAD", headers=_headers(download_url)),
+                                    timeout=TIMEOUT) as response:
+            size = size or response.headers.get("Content-Length")
+            accept_ranges = response.headers.get("Accept-Ranges", "")
     else:
-        print("✅ Upscaler уже существует")
+        accept_ranges = headers.get("Accept-Ranges", "")
+    if size is None:
+        raise RuntimeError(f"Сервер не вернул размер файла: {url}")
+    return download_url, int(size), (etag if _SHA256_RE.match(etag) else None), "bytes" in accept_ranges.lower()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class StreamingHasher:
+    """sha256 по кускам в порядке их номеров, в отдельном потоке
+
+    Куски докачиваются в любом порядке; хешер читает их из файла (обычно ещё из page cache),
+    как только готов следующий по порядку.
+    """
+
+    def __init__(self, path, size, chunk_bytes):
+        self.path = path
+        self.size = size
+        self.chunk_bytes = chunk_bytes
+        self.num_chunks = max(1, (size + chunk_bytes - 1) // chunk_bytes)
+        self._digest = hashlib.sha256()
+        self._ready = set()
+        self._next = 0
+        self._cond = threading.Condition()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="sha256", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def chunk_ready(self, index):
+        with self._cond:
+            self._ready.add(index)
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            with open(self.path, "rb") as f:
+                while self._next < self.num_chunks:
+                    with self._cond:
+                        while self._next not in self._ready:
+                            self._cond.wait()
+                    start = self._next * self.chunk_bytes
+                    remaining = min(self.chunk_bytes, self.size - start)
+                    f.seek(start)
+                    while remaining > 0:
+                        block = f.read(min(READ_BLOCK, remaining))
+                        if not block:
+                            raise IOError(f"Файл короче ожидаемого: {self.path}")
+                        self._digest.update(block)
+                        remaining -= len(block)
+                    self._next += 1
+        except Exception as e:
+            self._error = e
+
+    def hexdigest(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._digest.hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK * 8), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fetch_range(url, fd, start, end, progress):
+    """Качаем [start, end] в файл по смещению; повторы с паузой"""
+    for attempt in range(1, RETRIES + 1):
+        offset = start
+        try:
+            request = urllib.request.Request(url, headers=_headers(url, {"Range": f"bytes={offset}-{end}"}))
+            with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+                if response.status != 206:
+                    raise RuntimeError(f"Сервер не отдал диапазон (HTTP {response.status})")
+                while offset <= end:
+                    block = response.read(min(READ_BLOCK, end - offset + 1))
+                    if not block:
+                        raise IOError("Соединение оборвалось")
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+                    progress(len(block))
+            return
+        except Exception as e:
+            progress(-(offset - start))
+            if attempt == RETRIES:
+                raise
+            print(f"⚠️ Диапазон {start}-{end}: {e}, повтор {attempt}/{RETRIES - 1}")
+            time.sleep(min(2 ** attempt, 30))
+
+
+class _Progress:
+    def __init__(self, name, total, already):
+        self.name = name
+        self.total = total
+        self.done = already
+        self.started_at = time.time()
+        self.started_bytes = already
+        self._last_print = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            now = time.time()
+            if now - self._last_print < 5:
+                return
+            self._last_print = now
+            speed = (self.done - self.started_bytes) / max(now - self.started_at, 1e-6) / 1024 / 1024
+            print(f"📥 {self.name}: {self.done / self.total * 100:.1f}% "
+                  f"({self.done / 1024 ** 3:.2f}/{self.total / 1024 ** 3:.2f}GB, {speed:.0f}MB/s)")
+
+
+def download_file(url, final_path, workers=DOWNLOAD_WORKERS, chunk_bytes=CHUNK_BYTES):
+    """Качаем файл с докачкой и проверкой; -> (size, sha256)"""
+    name = os.path.basename(final_path)
+    download_url, size, expected_sha256, ranges = remote_metadata(url)
+    part_path = f"{final_path}.part"
+    state_path = f"{part_path}.json"
+    identity = {"url": url, "size": size, "sha256": expected_sha256, "chunk_bytes": chunk_bytes}
+
+    # Прогресс прошлой попытки годится, только если файл на сервере тот же
+    done = set()
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if {k: state.get(k) for k in identity} == identity and os.path.exists(part_path):
+            done = set(state.get("done", []))
+    except (OSError, ValueError):
+        pass
+    if not ranges:
+        print(f"⚠️ {name}: сервер не поддерживает Range, качаем одним потоком без докачки")
+        done, workers, chunk_bytes = set(), 1, max(size, 1)
+
+    num_chunks = max(1, (size + chunk_bytes - 1) // chunk_bytes)
+    if done:
+        print(f"↩️ {name}: продолжаем загрузку, готово {len(done)}/{num_chunks} кусков")
+    with open(part_path, "ab") as f:
+        f.truncate(size)
+
+    hasher = StreamingHasher(part_path, size, chunk_bytes)
+    hasher.start()
+    for index in done:
+        hasher.chunk_ready(index)
+
+    state_lock = threading.Lock()
+    progress = _Progress(name, size, sum(min(chunk_bytes, size - i * chunk_bytes) for i in done))
+    fd = os.open(part_path, os.O_WRONLY)
+    started_at = time.time()
+
+    def fetch_chunk(index):
+        start = index * chunk_bytes
+        end = min(start + chunk_bytes, size) - 1
+        if ranges:
+            _fetch_range(download_url, fd, start, end, progress)
+        else:
+            with urllib.request.urlopen(urllib.request.Request(download_url, headers=_headers(download_url)),
+                                        timeout=TIMEOUT) as response:
+                offset = 0
+                for block in iter(lambda: response.read(READ_BLOCK), b""):
+                    os.pwrite(fd, block, offset)
+                    offset += len(block)
+                    progress(len(block))
+        with state_lock:
+            done.add(index)
+            _write_json_atomic(state_path, {**identity, "done": sorted(done)})
+        hasher.chunk_ready(index)
+
+    try:
+        todo = [i for i in range(num_chunks) if i not in done]
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="download") as pool:
+            for future in [pool.submit(fetch_chunk, i) for i in todo]:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    actual_sha256 = hasher.hexdigest()
+    elapsed = time.time() - started_at
+    if os.path.getsize(part_path) != size:
+        raise RuntimeError(f"{name}: размер {os.path.getsize(part_path)} != {size}")
+    if expected_sha256 and actual_sha256 != expected_sha256:
+        # Битые данные не докачать: начинаем заново при следующем запуске
+        os.remove(part_path)
+        os.remove(state_path)
+        raise RuntimeError(f"{name}: sha256 не совпал ({actual_sha256} != {expected_sha256})")
+    if not expected_sha256:
+        print(f"⚠️ {name}: сервер не сообщил sha256, проверен только размер")
+
+    os.replace(part_path, final_path)
+    _write_json_atomic(f"{final_path}.sha256.json", {"size": size, "sha256": actual_sha256})
+    os.remove(state_path)
+    print(f"✅ {name}: {size / 1024 ** 3:.2f}GB за {elapsed:.0f}с, sha256 {actual_sha256[:16]}…")
+    return size, actual_sha256
+
+
+def verify_existing(url, final_path):
+    """Уже скачанный файл: (size, sha256) если он совпадает с сервером, иначе None"""
+    name = os.path.basename(final_path)
+    sidecar_path = f"{final_path}.sha256.json"
+    try:
+        with open(sidecar_path) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        recorded = None
+    try:
+        _, size, expected_sha256, _ = remote_metadata(url)
+    except Exception as e:
+        # Без сети доверяем файлу, проверенному раньше
+        if recorded and os.path.getsize(final_path) == recorded["size"]:
+            print(f"⚠️ {name}: сервер недоступен ({e}), используем проверенный ранее файл")
+            return recorded["size"], recorded["sha256"]
+        raise
+    if os.path.getsize(final_path) != size:
+        print(f"⚠️ {name}: размер {os.path.getsize(final_path)} != {size}, качаем заново")
+        return None
+    if recorded and recorded.get("size") == size and (not expected_sha256 or recorded.get("sha256") == expected_sha256):
+        return size, recorded["sha256"]
+    # Файл от старой версии скрипта (без записанного хеша): проверяем один раз
+    print(f"🔍 {name}: проверяем sha256 существующего файла...")
+    actual_sha256 = file_sha256(final_path)
+    if expected_sha256 and actual_sha256 != expected_sha256:
+        print(f"⚠️ {name}: sha256 не совпал, качаем заново")
+        return None
+    _write_json_atomic(sidecar_path, {"size": size, "sha256": actual_sha256})
+    return size, actual_sha256
+
+
+def marker_valid(marker_path, models_dir, files):
+    """Маркер считается валидным, если перечисляет все файлы и их размеры совпадают"""
+    try:
+        with open(marker_path) as f:
+            marker = json.load(f)
+        recorded = marker["files"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    for filename in files:
+        path = os.path.join(models_dir, filename)
+        if filename not in recorded or not os.path.exists(path):
+            return False
+        if os.path.getsize(path) != recorded[filename]["size"]:
+            return False
+    return True
+
+
+def ensure_weights(models_dir=MODELS_DIR, marker_path=None, base_url=BASE_URL, files=WEIGHT_FILES):
+    os.makedirs(models_dir, exist_ok=True)
+    if marker_path and marker_valid(marker_path, models_dir, files):
+        print("✅ Веса уже загружены и проверены! Пропускаем загрузку.")
+        return True
+
+    print("🎬 Проверяем веса LTX-Video...")
+    verified = {}
+    for filename in files:
+        url = f"{base_url.rstrip('/')}/{filename}"
+        final_path = os.path.join(models_dir, filename)
+        result = verify_existing(url, final_path) if os.path.exists(final_path) else None
+        if result is None:
+            print(f"📥 Скачиваем {filename}...")
+            result = download_file(url, final_path)
+        else:
+            print(f"✅ {filename} уже загружен и проверен")
+        verified[filename] = {"size": result[0], "sha256": result[1]}
+
+    if marker_path:
+        _write_json_atomic(marker_path, {"files": verified, "verified_at": time.time()})
+    print("✅ Все веса загружены успешно!")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Загрузка и проверка весов LTX-Video")
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--marker", default=None, help="Файл маркера готовности (пишется после проверки)")
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--check-only", action="store_true",
+                        help="Только проверить маркер (без сети): код 0 если веса готовы")
+    args = parser.parse_args()
+    if args.check_only:
+        sys.exit(0 if args.marker and marker_valid(args.marker, args.models_dir, WEIGHT_FILES) else 1)
+    try:
+        ensure_weights(args.models_dir, args.marker, args.base_url)
+    except Exception as e:
+        print(f"❌ Ошибка загрузки весов: {e}")
+        sys.exit(1)
+
 
-    print("✅ Все веса загружены успешно!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Кеш эмбеддингов текстового энкодера (T5)
+Ключ — нормализованный текст + идентичность энкодера, LRU по числу записей и байтам.
+Записи живут в памяти хоста (pinned, если есть CUDA) и копируются на устройство при попадании:
+VRAM под кеш не отнимается у генерации и не выпадает из модели пика памяти (memory_model).
+Опционально записи сохраняются на диск (например, /runpod-volume), чтобы пережить рестарт.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = int(os.environ.get("LTX_EMBEDDING_CACHE_ENTRIES", "256"))
+MAX_BYTES = int(float(os.environ.get("LTX_EMBEDDING_CACHE_MB", "1024")) * 1024 * 1024)
+# Пусто — без сохранения на диск; например /runpod-volume/cache/text_embeddings
+PERSIST_DIR = os.environ.get("LTX_EMBEDDING_CACHE_DIR", "")
+
+
+def _to_host(tensor):
+    """Копия записи в памяти хоста: pinned — копия на устройство при попадании асинхронная"""
+    if tensor.device.type == "cpu" and (tensor.is_pinned() or not torch.cuda.is_available()):
+        return tensor
+    host = tensor.to("cpu")
+    if torch.cuda.is_available():
+        try:
+            return host.pin_memory()
+        except RuntimeError as e:
+            logger.warning(f"⚠️ pinned память недоступна ({e}), кеш эмбеддингов в обычной памяти")
+    return host
+
+
+def normalize_text(text):
+    """Схлопываем пробелы: ' a  b ' и 'a b' дают один и тот же ключ"""
+    return " ".join((text or "").split())
+
+
+class EmbeddingCache:
+    """LRU кеш (embeds, attention_mask) для текстов"""
+
+    def __init__(self, encoder_id, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, persist_dir=PERSIST_DIR):
+        self.encoder_id = encoder_id
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir or None
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.persist_dir:
+            os.makedirs(self.persist_dir, exist_ok=True)
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.encoder_id}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _entry_bytes(embeds, mask):
+        return embeds.numel() * embeds.element_size() + mask.numel() * mask.element_size()
+
+    def _disk_path(self, key):
+        return os.path.join(self.persist_dir, f"{key}.pt")
+
+    def _remember(self, key, embeds, mask):
+        size = self._entry_bytes(embeds, mask)
+        if size > self.max_bytes:
+            return
+        embeds, mask = _to_host(embeds), _to_host(mask)
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (embeds, mask, size)
+            self.total_bytes += size
+            # Выселяем самые давние записи
+            while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, (_, _, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+
+    def get(self, text, device=None):
+        key = self.key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            embeds, mask = entry[0], entry[1]
+        elif self.persist_dir and os.path.exists(self._disk_path(key)):
+            try:
+                data = torch.load(self._disk_path(key), map_location="cpu")
+                embeds, mask = data["embeds"], data["mask"]
+            except Exception as e:
+                logger.warning(f"⚠️ Повреждённая запись кеша эмбеддингов {key}: {e}")
+                return None
+            self._remember(key, embeds, mask)
+        else:
+            return None
+        if device is not None and embeds.device != torch.device(device):
+            # Из pinned памяти — без блокировки; запись в кеше не меняется, источник живёт до конца копии
+            embeds, mask = embeds.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+        return embeds, mask
+
+    def put(self, text, embeds, mask):
+        key = self.key(text)
+        embeds, mask = embeds.detach(), mask.detach()
+        self._remember(key, embeds, mask)
+        if self.persist_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.tmp.{os.getpid()}"
+            try:
+                torch.save({"embeds": embeds.cpu(), "mask": mask.cpu(), "encoder_id": self.encoder_id}, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить эмбеддинг на диск: {e}")
+
+    def get_or_encode(self, text, encode_fn, device=None):
+        """Берём из кеша или считаем encode_fn(text) -> (embeds, mask)"""
+        cached = self.get(text, device=device)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        embeds, mask = encode_fn(text)
+        self.put(text, embeds, mask)
+        return embeds, mask
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
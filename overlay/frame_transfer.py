@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Перевод декодированного видео в uint8 на устройстве и перекачка кусками на хост
+- clamp / * 255 / uint8 / permute делаются на GPU, на хост уходит только uint8 (в 4 раза меньше float32)
+- копирование идёт асинхронно в переиспользуемые pinned буферы (двойная буферизация),
+  поэтому копия следующего куска перекрывается с кодированием текущего
+"""
+
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Переиспользуемые pinned буферы: растут до максимального размера куска и живут весь процесс
+_pinned_slots = []
+_copy_stream = None
+
+
+def _get_pinned_slots(nbytes, count=2):
+    global _pinned_slots
+    if len(_pinned_slots) < count or _pinned_slots[0].numel() < nbytes:
+        logger.info(f"📌 Выделяем pinned буферы: {count} x {nbytes / 1024 / 1024:.1f}MB")
+        _pinned_slots = [torch.empty(nbytes, dtype=torch.uint8, pin_memory=True) for _ in range(count)]
+    return _pinned_slots
+
+
+def _get_copy_stream(device):
+    global _copy_stream
+    if _copy_stream is None or _copy_stream.device != device:
+        _copy_stream = torch.cuda.Stream(device=device)
+    return _copy_stream
+
+
+def quantize_frames(video_chunk):
+    """(C, N, H, W) float [0, 1] -> (N, H, W, C) uint8 на том же устройстве"""
+    return video_chunk.clamp(0, 1).mul(255).to(torch.uint8).permute(1, 2, 3, 0).contiguous()
+
+
+def iter_uint8_chunks(video, chunk_frames):
+    """Отдаём numpy куски (N, H, W, C) uint8 для одного видео формы (C, F, H, W)
+
+    Массив валиден только до следующей итерации: буфер переиспользуется.
+    """
+    num_frames = video.shape[1]
+    starts = list(range(0, num_frames, chunk_frames))
+
+    if video.device.type != "cuda":
+        for start in starts:
+            yield quantize_frames(video[:, start:start + chunk_frames]).numpy()
+        return
+
+    _, _, height, width = video.shape
+    frame_bytes = height * width * video.shape[0]
+    slots = _get_pinned_slots(frame_bytes * chunk_frames)
+    copy_stream = _get_copy_stream(video.device)
+    compute_stream = torch.cuda.current_stream(video.device)
+
+    previous = None  # (slot_view, event)
+    for index, start in enumerate(starts):
+        quantized = quantize_frames(video[:, start:start + chunk_frames])
+        slot_view = slots[index % 2][: quantized.numel()].view(quantized.shape)
+
+        # Копия на отдельном стриме: ждёт квантизацию, но не блокирует следующий кусок
+        copy_stream.wait_stream(compute_stream)
+        with torch.cuda.stream(copy_stream):
+            slot_view.copy_(quantized, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(copy_stream)
+        quantized.record_stream(copy_stream)
+        del quantized
+
+        # Пока копируется текущий кусок, отдаём предыдущий на кодирование
+        if previous is not None:
+            previous[1].synchronize()
+            yield previous[0].numpy()
+        previous = (slot_view, event)
+
+    if previous is not None:
+        previous[1].synchronize()
+        yield previous[0].numpy()
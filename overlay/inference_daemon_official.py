@@ -9,7 +9,10 @@ import sys
 import json
 import time
 import glob
+import queue
+import threading
 import subprocess
+import startup_timeline  # до torch: фаза импортов считается от загрузки модуля
 import torch
 import logging
 from pathlib import Path
@@ -19,7 +22,7 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('inference_daemon_official.log'),
+        logging.FileHandler(os.environ.get("LTX_DAEMON_LOG", 'inference_daemon_official.log')),
         logging.StreamHandler()
     ]
 )
@@ -28,78 +31,226 @@ logger = logging.getLogger(__name__)
 # Добавляем текущую директорию в путь для импортов
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# Стейджинг весов на локальный диск (LTX_STAGE_WEIGHTS=1) стартует до импорта ltx_video;
+# повторный вызов (rp_handler уже запустил) ничего не делает
+import weight_staging
+weight_staging.start_from_config("ltxv-13b-0.9.8-distilled.yaml")
+
 # Импортируем функции inference напрямую
 from ltx_video.inference import infer, InferenceConfig, load_pipeline_config, create_ltx_video_pipeline, get_device, calculate_padding, get_unique_filename, seed_everething
 from ltx_video.pipelines.pipeline_ltx_video import SkipLayerStrategy
 
+import daemon_rpc
+import job_leases
+import job_scheduler
+from video_writer import StreamingMp4Writer, ENCODE_CHUNK_FRAMES
+from frame_transfer import iter_uint8_chunks
+from embedding_cache import EmbeddingCache
+from shapes import padded_shape, bucket_name
+from prompt_cache import EnhancedPromptCache, hash_file
+import conditioning
+import warmup
+import parallel_loader
+import progress
+import preview
+import result_cache
+import coalescing
+import memory_model
+import tiled_vae
+import offload
+import stage_profile
+import metrics
+
+# Устройство этого демона (на поде запускается по одному демону на GPU)
+DAEMON_DEVICE = os.environ.get("LTX_DAEMON_DEVICE", "0")
+
+# Период опроса папки inference_commands/ (файловый режим)
+COMMAND_POLL_INTERVAL = float(os.environ.get("LTX_COMMAND_POLL_INTERVAL", "1.0"))
+# Динамический батчинг: сколько ждать совместимые задачи и максимум задач в одном вызове pipeline
+# (1 — батчинг выключен; память растёт примерно линейно с размером батча)
+BATCH_WINDOW_MS = float(os.environ.get("LTX_BATCH_WINDOW_MS", "200"))
+MAX_BATCH_SIZE = int(os.environ.get("LTX_MAX_BATCH_SIZE", "1"))
+# Куда демон кладёт превью первого прохода (путь уходит клиенту в прогрессе)
+PREVIEW_DIR = os.environ.get("LTX_PREVIEW_DIR", "outputs/previews")
+
 def create_ready_flag():
-    """Создаем флаг готовности демона"""
+    """Создаем флаг готовности демона (и рядом таймлайн старта)"""
     with open("daemon_ready.flag", "w") as f:
         f.write(str(time.time()))
+    startup_timeline.timeline.mark_ready()
 
 def clear_gpu_cache():
-    """Очищаем GPU кеш, но сохраняем модели"""
-    if torch.cuda.is_available():
-        # Очищаем только промежуточные данные, но не модели
-        torch.cuda.empty_cache()
-        logger.info("🧹 Промежуточные данные очищены")
+    """Очищаем GPU кеш между задачами (модели остаются) — по политике LTX_CACHE_FLUSH_POLICY"""
+    memory_model.flush("idle")
 
 # Глобальная переменная для хранения pipeline
 global_pipeline = None
 global_pipeline_config = None
+global_embedding_cache = None
+global_prompt_cache = None
+
+# Негативный промпт по умолчанию (его шлют rp_handler, server.py и celery_task_inference)
+DEFAULT_NEGATIVE_PROMPT = "worst quality, inconsistent motion, blurry, jittery, distorted"
+
+def get_video_pipeline(pipeline):
+    """LTXVideoPipeline внутри multi-scale обёртки (или сам pipeline)"""
+    return getattr(pipeline, 'video_pipeline', pipeline)
+
+def encode_text_cached(text, pipeline, device):
+    """Эмбеддинг текста через кеш: T5 запускается только на промахе"""
+    video_pipeline = get_video_pipeline(pipeline)
+    
+    def encode(t):
+        # Только на промахе кеша: T5 приходит на устройство (при выгрузке) лишь когда нужен
+        offload.offloader.use("text")
+        with torch.no_grad():
+            embeds, mask, _, _ = video_pipeline.encode_prompt(t, do_classifier_free_guidance=False, device=device)
+        return embeds, mask
+    
+    return global_embedding_cache.get_or_encode(text, encode, device=device)
+
+def enhance_prompt_text(prompt, pipeline, conditioning_items):
+    """Улучшаем промпт (caption модель + LLM) вне pipeline, чтобы дальше работать с эмбеддингами"""
+    from ltx_video.utils.prompt_enhance_utils import generate_cinematic_prompt
+    video_pipeline = get_video_pipeline(pipeline)
+    offload.offloader.use("enhance")
+    with torch.no_grad():
+        enhanced = generate_cinematic_prompt(
+            video_pipeline.prompt_enhancer_image_caption_model,
+            video_pipeline.prompt_enhancer_image_caption_processor,
+            video_pipeline.prompt_enhancer_llm_model,
+            video_pipeline.prompt_enhancer_llm_tokenizer,
+            prompt,
+            conditioning_items,
+            max_new_tokens=256,
+        )
+    return enhanced[0] if isinstance(enhanced, (list, tuple)) else enhanced
+
+def enhance_prompt_cached(config, pipeline, conditioning_items, conditioning_images=None):
+    """Улучшенный промпт из персистентного кеша; LLM запускается только на промахе"""
+    image_hash = None
+    if conditioning_images:
+        image_hash = conditioning.image_hash(conditioning_images[0])
+    elif config.conditioning_media_paths:
+        image_hash = hash_file(config.conditioning_media_paths[0])
+    enhanced = global_prompt_cache.get_or_enhance(
+        config.prompt,
+        image_hash,
+        lambda: enhance_prompt_text(config.prompt, pipeline, conditioning_items),
+    )
+    logger.info(f"🗂️ Кеш промптов: {global_prompt_cache.stats()}")
+    return enhanced
 
 def load_models_once():
     """Загружаем модели один раз и держим в памяти"""
-    global global_pipeline, global_pipeline_config
+    global global_pipeline, global_pipeline_config, global_embedding_cache, global_prompt_cache
     
     logger.info("🎬 Загружаем модели в GPU...")
     
+    timeline = startup_timeline.timeline
     try:
                 # Загружаем конфиг
-        global_pipeline_config = load_pipeline_config("ltxv-13b-0.9.8-distilled.yaml")
+        with timeline.phase("config"):
+            global_pipeline_config = load_pipeline_config("ltxv-13b-0.9.8-distilled.yaml")
         logger.info("✅ Конфиг загружен")
         
 
         # Создаем pipeline один раз
-        logger.info("🎯 Создаем pipeline...")
-        global_pipeline = create_ltx_video_pipeline(
-            ckpt_path=global_pipeline_config["checkpoint_path"],
-            precision=global_pipeline_config["precision"],
-            text_encoder_model_name_or_path=global_pipeline_config["text_encoder_model_name_or_path"],
-            enhance_prompt=True,
-            prompt_enhancer_image_caption_model_name_or_path=global_pipeline_config.get(
-                "prompt_enhancer_image_caption_model_name_or_path"
-            ),
-            prompt_enhancer_llm_model_name_or_path=global_pipeline_config.get(
-                "prompt_enhancer_llm_model_name_or_path"
-            ),
-        )
+        device = get_device()
+        # С выгрузкой (LTX_OFFLOAD) всё грузится на хост, на устройство компоненты разводит offload
+        load_device = "cpu" if offload.OFFLOAD != "off" else device
+        load_started_at = time.time()
+        with timeline.phase("load_models", parallel=parallel_loader.PARALLEL_LOAD):
+            latent_upsampler = None
+            global_pipeline = None
+            if parallel_loader.PARALLEL_LOAD:
+                # Компоненты грузятся одновременно и сразу на устройство в нужном dtype
+                logger.info("🎯 Создаем pipeline (параллельная загрузка)...")
+                try:
+                    global_pipeline, latent_upsampler = parallel_loader.load_pipeline_parallel(
+                        global_pipeline_config, load_device, enhance_prompt=True
+                    )
+                except Exception as e:
+                    logger.error(f"❌ Параллельная загрузка не удалась, грузим последовательно: {e}")
+                    global_pipeline, latent_upsampler = None, None
+                    import gc
+                    gc.collect()
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+            if global_pipeline is None:
+                logger.info("🎯 Создаем pipeline...")
+                global_pipeline = create_ltx_video_pipeline(
+                    ckpt_path=weight_staging.resolve(global_pipeline_config["checkpoint_path"]),
+                    precision=global_pipeline_config["precision"],
+                    text_encoder_model_name_or_path=global_pipeline_config["text_encoder_model_name_or_path"],
+                    enhance_prompt=True,
+                    prompt_enhancer_image_caption_model_name_or_path=global_pipeline_config.get(
+                        "prompt_enhancer_image_caption_model_name_or_path"
+                    ),
+                    prompt_enhancer_llm_model_name_or_path=global_pipeline_config.get(
+                        "prompt_enhancer_llm_model_name_or_path"
+                    ),
+                )
         
-        # Если это multi-scale pipeline, создаем соответствующий wrapper
-        if global_pipeline_config.get("pipeline_type") == "multi-scale":
-            from ltx_video.pipelines.pipeline_ltx_video import LTXMultiScalePipeline
-            from ltx_video.inference import create_latent_upsampler
+        with timeline.phase("multi_scale"):
+            # Если это multi-scale pipeline, создаем соответствующий wrapper
+            if global_pipeline_config.get("pipeline_type") == "multi-scale":
+                from ltx_video.pipelines.pipeline_ltx_video import LTXMultiScalePipeline
+                from ltx_video.inference import create_latent_upsampler
             
-            spatial_upscaler_model_path = global_pipeline_config.get("spatial_upscaler_model_path")
-            if spatial_upscaler_model_path:
-                logger.info("🎯 Создаем latent upsampler...")
-                latent_upsampler = create_latent_upsampler(spatial_upscaler_model_path, global_pipeline.device)
-                global_pipeline = LTXMultiScalePipeline(global_pipeline, latent_upsampler=latent_upsampler)
-                logger.info("✅ Multi-scale pipeline создан")
+                spatial_upscaler_model_path = global_pipeline_config.get("spatial_upscaler_model_path")
+                if spatial_upscaler_model_path:
+                    if latent_upsampler is None:
+                        logger.info("🎯 Создаем latent upsampler...")
+                        latent_upsampler = create_latent_upsampler(
+                            weight_staging.resolve(spatial_upscaler_model_path), load_device
+                        )
+                    global_pipeline = LTXMultiScalePipeline(global_pipeline, latent_upsampler=latent_upsampler)
+                    logger.info("✅ Multi-scale pipeline создан")
         
-        # Перемещаем pipeline на GPU
-        device = get_device()
-        logger.info(f"🎯 Перемещаем pipeline на {device}...")
-        if hasattr(global_pipeline, 'video_pipeline'):
-            # Это multi-scale pipeline
-            global_pipeline.video_pipeline = global_pipeline.video_pipeline.to(device)
-            # Также перемещаем latent_upsampler на GPU
-            if hasattr(global_pipeline, 'latent_upsampler'):
-                global_pipeline.latent_upsampler = global_pipeline.latent_upsampler.to(device)
-                logger.info(f"🎯 Latent upsampler перемещен на {device}")
-        else:
-            # Обычный pipeline
-            global_pipeline = global_pipeline.to(device)
+        with timeline.phase("device_move"):
+            # Перемещаем pipeline на GPU (после параллельной загрузки всё уже там — это no-op)
+            logger.info(f"🎯 Перемещаем pipeline на {device}...")
+            if offload.OFFLOAD != "off":
+                # T5, улучшатели и трансформер — в pinned память хоста, VAE и upsampler — на устройство
+                offload.offloader.attach(global_pipeline, device, offload.OFFLOAD)
+            elif hasattr(global_pipeline, 'video_pipeline'):
+                # Это multi-scale pipeline
+                global_pipeline.video_pipeline = global_pipeline.video_pipeline.to(device)
+                # Также перемещаем latent_upsampler на GPU
+                if hasattr(global_pipeline, 'latent_upsampler'):
+                    global_pipeline.latent_upsampler = global_pipeline.latent_upsampler.to(device)
+                    logger.info(f"🎯 Latent upsampler перемещен на {device}")
+            else:
+                # Обычный pipeline
+                global_pipeline = global_pipeline.to(device)
+        
+        logger.info(
+            f"⏱️ Модели загружены за {time.time() - load_started_at:.1f}с, "
+            f"пиковый RSS {parallel_loader.peak_rss_gb():.1f}GB"
+        )
+        if weight_staging.STAGE_WEIGHTS:
+            staging = weight_staging.stager.report()
+            logger.info(
+                f"💾 Стейджинг весов: {staging['staged_bytes'] / 1024 ** 3:.1f}GB скопировано за "
+                f"{staging['copy_seconds']:.1f}с в фоне, загрузчик ждал {staging['blocked_seconds']:.1f}с, "
+                f"сэкономлено ~{staging['saved_seconds']:.1f}с чтения с тома"
+            )
+            timeline.event("weight_staging", **staging)
+        
+        with timeline.phase("caches"):
+            # Кеш эмбеддингов: идентичность энкодера = модель + точность
+            global_embedding_cache = EmbeddingCache(
+                encoder_id=f"{global_pipeline_config['text_encoder_model_name_or_path']}:{global_pipeline_config['precision']}"
+            )
+            encode_text_cached(DEFAULT_NEGATIVE_PROMPT, global_pipeline, device)
+            logger.info("✅ Негативный промпт по умолчанию закодирован и закеширован")
+        
+            # Кеш улучшенных промптов на томе: идентичность = caption модель + LLM
+            global_prompt_cache = EnhancedPromptCache(enhancer_id="|".join([
+                str(global_pipeline_config.get("prompt_enhancer_image_caption_model_name_or_path")),
+                str(global_pipeline_config.get("prompt_enhancer_llm_model_name_or_path")),
+            ]))
         
         logger.info("✅ Pipeline создан и готов к работе")
         return True
@@ -108,6 +259,25 @@ def load_models_once():
         logger.error(f"❌ Ошибка загрузки моделей: {e}")
         return False
 
+def warmup_pipeline():
+    """Прогрев готового pipeline на частых размерах (до флага готовности)"""
+    def run_warmup_request(height, width, num_frames):
+        config = InferenceConfig(
+            prompt=warmup.WARMUP_PROMPT,
+            negative_prompt=DEFAULT_NEGATIVE_PROMPT,
+            height=height,
+            width=width,
+            num_frames=num_frames,
+            seed=0,
+            pipeline_config="ltxv-13b-0.9.8-distilled.yaml",
+            frame_rate=24,
+        )
+        # В память: файл не нужен, но кодирование тоже прогревается
+        infer_with_ready_pipeline(config, global_pipeline, global_pipeline_config, in_memory=True)
+    
+    with startup_timeline.timeline.phase("warmup"):
+        return warmup.run_warmup(global_pipeline, run_warmup_request)
+
 def test_pipeline():
     """Тестируем pipeline простой генерацией"""
     global global_pipeline
@@ -219,36 +389,78 @@ def generate_with_pipeline(config, pipeline, pipeline_config):
     
     return output_files
 
-def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
-    """Модифицированная версия infer() которая использует готовый pipeline"""
+def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config, in_memory=False, conditioning_images=None, output=None, progress_tracker=None, preview_mode="off", on_preview=None, vae_tiling=None, profile=None):
+    """Модифицированная версия infer() которая использует готовый pipeline
+    
+    in_memory=True — MP4 кодируется прямо в память и возвращаются bytes вместо путей к файлам
+    conditioning_images — картинки в памяти (bytes/base64/numpy) вместо config.conditioning_media_paths
+    output — объект с .write() (например, поток загрузки в S3): MP4 пишется в него, он же и возвращается
+    progress_tracker — progress.ProgressTracker вызывающего (этапы после кодирования и finish() — на нём)
+    preview_mode/on_preview — превью первого прохода multi-scale: on_preview(0, data, fmt)
+    vae_tiling — декодирование VAE тайлами: "off" / "auto" / "on" (None — LTX_VAE_TILING)
+    profile — stage_profile.StageProfile вызывающего (этапы до и после генерации — на нём)
+    """
+    return infer_batch_with_ready_pipeline(
+        [config], ready_pipeline, pipeline_config,
+        in_memory=in_memory, conditioning_images_list=[conditioning_images],
+        outputs=[output] if output is not None else None, progress_tracker=progress_tracker,
+        preview_mode=preview_mode, on_preview=on_preview, vae_tiling=vae_tiling, profile=profile,
+    )[0]
+
+def infer_batch_with_ready_pipeline(configs, ready_pipeline, pipeline_config, in_memory=False, conditioning_images_list=None, outputs=None, progress_tracker=None, preview_mode="off", on_preview=None, vae_tiling=None, profile=None):
+    """Один вызов pipeline на несколько задач с одинаковым padded размером
+    
+    У каждой задачи свои промпт и seed; возвращает список результатов (как у infer_with_ready_pipeline) на каждую задачу.
+    Conditioning в LTX общий на весь батч, поэтому image-to-video выполняется только поодиночке.
+    outputs — по объекту с .write() на задачу (или None): MP4 стримится туда вместо BytesIO/файла.
+    progress_tracker — прогресс по шагам и этапам; без него создаётся свой (история длительностей для ETA)
+    preview_mode ("off"/"poster"/"clip") и on_preview(index, data, fmt) — превью из первого прохода,
+    отдаётся в отдельном потоке, пока идёт второй проход
+    vae_tiling — декодирование VAE тайлами и кусками по времени ("off" / "auto" / "on"; None — LTX_VAE_TILING)
+    profile — время и пик памяти по этапам (stage_profile.StageProfile); без него создаётся свой (только в лог)
+    """
+    import io
     import torch
-    import numpy as np
-    import imageio
     from datetime import datetime
     
+    started_at = time.time()
+    tracker = progress_tracker if progress_tracker is not None else progress.ProgressTracker()
+    profile = profile if profile is not None else stage_profile.StageProfile(batch_size=len(configs))
+    config = configs[0]
+    conditioning_images = (conditioning_images_list or [None])[0]
+    batch_size = len(configs)
+    if batch_size > 1 and (conditioning_images or any(c.conditioning_media_paths or c.input_media_path for c in configs)):
+        raise ValueError("Батч поддерживается только для text-to-video задач")
+    
     # Настройки
     device = get_device()
     seed_everething(config.seed)
     
-    # Подготавливаем размеры
-    height_padded = ((config.height - 1) // 32 + 1) * 32
-    width_padded = ((config.width - 1) // 32 + 1) * 32
-    num_frames_padded = ((config.num_frames - 2) // 8 + 1) * 8 + 1
+    # Подготавливаем размеры (у всех задач батча padded размеры совпадают)
+    height_padded, width_padded, num_frames_padded = padded_shape(config.height, config.width, config.num_frames)
+    for other in configs[1:]:
+        if padded_shape(other.height, other.width, other.num_frames) != (height_padded, width_padded, num_frames_padded):
+            raise ValueError("В батче задачи с разными padded размерами")
     
     padding = calculate_padding(config.height, config.width, height_padded, width_padded)
     
-    logger.warning(f"Padded dimensions: {height_padded}x{width_padded}x{num_frames_padded}")
-    
-    # Подготавливаем входные данные
-    sample = {
-        "prompt": config.prompt,
-        "prompt_attention_mask": None,
-        "negative_prompt": config.negative_prompt,
-        "negative_prompt_attention_mask": None,
-    }
+    logger.warning(f"Padded dimensions: {height_padded}x{width_padded}x{num_frames_padded} (batch={batch_size})")
+    tracker.configure(
+        pipeline_config, hasattr(ready_pipeline, 'video_pipeline'),
+        bucket=bucket_name((height_padded, width_padded, num_frames_padded)),
+    )
+    # Прогноз пика памяти (для политики сброса кеша) и замер фактического пика для модели
+    memory_kind = memory_model.pipeline_type(ready_pipeline)
+    predicted_peak = memory_model.model.predict(memory_kind, (height_padded, width_padded, num_frames_padded), batch_size)
+    peak_meter = memory_model.PeakMeter(memory_model.model, memory_kind, (height_padded, width_padded, num_frames_padded), batch_size)
+    # Декодирование VAE тайлами, если целиком не помещается (auto) или всегда (on)
+    tiled_decode = tiled_vae.TiledDecode(tiled_vae.parse_mode(vae_tiling), meter=peak_meter)
     
-    # 🔥 КРИТИЧНО: generator на CPU чтобы не держал память на GPU
-    generator = torch.Generator(device="cpu").manual_seed(config.seed)
+    # 🔥 КРИТИЧНО: generator на CPU чтобы не держал память на GPU (в батче — свой на каждую задачу)
+    if batch_size == 1:
+        generator = torch.Generator(device="cpu").manual_seed(config.seed)
+    else:
+        generator = [torch.Generator(device="cpu").manual_seed(c.seed) for c in configs]
     
     # Настройки STG
     stg_mode = pipeline_config.get("stg_mode", "attention_values")
@@ -267,34 +479,71 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
     media_item = None
     conditioning_items = None
     
-    # Обрабатываем conditioning_media_paths (для image-to-video как в рабочем скрипте)
-    if config.conditioning_media_paths:
-        from ltx_video.inference import prepare_conditioning
-        logger.info(f"🖼️ Загружаем conditioning images: {config.conditioning_media_paths}")
-        conditioning_items = prepare_conditioning(
-            conditioning_media_paths=config.conditioning_media_paths,
-            conditioning_strengths=config.conditioning_strengths or [1.0],
-            conditioning_start_frames=config.conditioning_start_frames or [0],
-            height=config.height,
-            width=config.width,
-            num_frames=config.num_frames,
-            padding=padding,
-            pipeline=ready_pipeline,
-        )
-        logger.info(f"🖼️ Conditioning items: {type(conditioning_items)} {len(conditioning_items) if conditioning_items else 'None'}")
+    with profile.stage("conditioning"):
+        # Картинки из памяти: без временных файлов, JPEG декодируется сразу в нужном размере
+        if conditioning_images:
+            logger.info(f"🖼️ Загружаем conditioning images из памяти: {len(conditioning_images)} шт.")
+            conditioning_items = conditioning.prepare_conditioning_from_images(
+                conditioning_images,
+                height=config.height,
+                width=config.width,
+                padding=padding,
+                strengths=config.conditioning_strengths,
+                start_frames=config.conditioning_start_frames,
+            )
+        # Обрабатываем conditioning_media_paths (для image-to-video как в рабочем скрипте)
+        elif config.conditioning_media_paths:
+            from ltx_video.inference import prepare_conditioning
+            logger.info(f"🖼️ Загружаем conditioning images: {config.conditioning_media_paths}")
+            conditioning_items = prepare_conditioning(
+                conditioning_media_paths=config.conditioning_media_paths,
+                conditioning_strengths=config.conditioning_strengths or [1.0],
+                conditioning_start_frames=config.conditioning_start_frames or [0],
+                height=config.height,
+                width=config.width,
+                num_frames=config.num_frames,
+                padding=padding,
+                pipeline=ready_pipeline,
+            )
+            logger.info(f"🖼️ Conditioning items: {type(conditioning_items)} {len(conditioning_items) if conditioning_items else 'None'}")
         
-    # input_media_path НЕ используется для image-to-video (только для video-to-video)
-    if config.input_media_path:
-        from ltx_video.inference import load_media_file
-        logger.info(f"🖼️ Загружаем input media: {config.input_media_path}")
-        media_item = load_media_file(
-            media_path=config.input_media_path,
-            height=config.height,
-            width=config.width,
-            max_frames=num_frames_padded,
-            padding=padding,
-        )
-        logger.info(f"🖼️ Input media item shape: {media_item.shape if hasattr(media_item, 'shape') else type(media_item)}")
+        # input_media_path НЕ используется для image-to-video (только для video-to-video)
+        if config.input_media_path:
+            from ltx_video.inference import load_media_file
+            logger.info(f"🖼️ Загружаем input media: {config.input_media_path}")
+            media_item = load_media_file(
+                media_path=config.input_media_path,
+                height=config.height,
+                width=config.width,
+                max_frames=num_frames_padded,
+                padding=padding,
+            )
+            logger.info(f"🖼️ Input media item shape: {media_item.shape if hasattr(media_item, 'shape') else type(media_item)}")
+    
+    # Промпт улучшаем один раз здесь (а не в каждом проходе pipeline), затем берём эмбеддинги из кеша
+    prompt_embeds_list, prompt_mask_list, negative_embeds_list, negative_mask_list = [], [], [], []
+    for c in configs:
+        with profile.stage("prompt_enhance"):
+            enhanced_prompt = enhance_prompt_cached(c, ready_pipeline, conditioning_items, conditioning_images)
+        logger.info(f"📝 Улучшенный промпт: {enhanced_prompt[:100]}...")
+        with profile.stage("text_encode"):
+            embeds, mask = encode_text_cached(enhanced_prompt, ready_pipeline, device)
+            negative_embeds, negative_mask = encode_text_cached(c.negative_prompt or DEFAULT_NEGATIVE_PROMPT, ready_pipeline, device)
+        prompt_embeds_list.append(embeds)
+        prompt_mask_list.append(mask)
+        negative_embeds_list.append(negative_embeds)
+        negative_mask_list.append(negative_mask)
+    logger.info(f"🧠 Кеш эмбеддингов: {global_embedding_cache.stats()}")
+    
+    # Подготавливаем входные данные: готовые эмбеддинги и маски вместо сырых строк (по строке на задачу)
+    sample = {
+        "prompt": None,
+        "prompt_embeds": torch.cat(prompt_embeds_list, dim=0),
+        "prompt_attention_mask": torch.cat(prompt_mask_list, dim=0),
+        "negative_prompt": None,
+        "negative_prompt_embeds": torch.cat(negative_embeds_list, dim=0),
+        "negative_prompt_attention_mask": torch.cat(negative_mask_list, dim=0),
+    }
     
     # Используем оригинальные timesteps как в inference.py - без фильтрации для image-to-video
     timesteps = pipeline_config.get("first_pass", {}).get("timesteps", [1.0, 0.9937, 0.9875, 0.9812, 0.975, 0.9094, 0.725])
@@ -313,12 +562,14 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
         if torch.cuda.is_available():
             allocated = torch.cuda.memory_allocated() / 1024**3
             cached = torch.cuda.memory_reserved() / 1024**3
-            logger.info(f"🔥 Память перед генерацией: {allocated:.1f}GB allocated, {cached:.1f}GB cached")
-            torch.cuda.empty_cache()
-            logger.info("🧹 Очистка GPU кеша перед генерацией (multi-scale)")
+            logger.info(f"🔥 Память перед генерацией: {allocated:.1f}GB allocated, {cached:.1f}GB cached, "
+                        f"прогноз пика +{predicted_peak / 1024**3:.1f}GB")
+        # При выгрузке трансформер приходит до замера пика: веса — не пик задачи
+        offload.offloader.use("denoise")
+        memory_model.flush("before", predicted_peak)
         
         # 🔥 КРИТИЧНО: используем no_grad для отключения autograd (позволяет callback'и)
-        with torch.no_grad():
+        with torch.no_grad(), peak_meter, tiled_decode, offload.offloader.generation(), preview.PreviewHook(ready_pipeline, pipeline_config, preview_mode, on_preview, fps=config.frame_rate), profile.pipeline_stages(ready_pipeline):
             images = ready_pipeline(
                 downscale_factor=pipeline_config.get("downscale_factor", 0.6666666),
                 first_pass=first_pass_config,
@@ -326,7 +577,7 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
                 skip_layer_strategy=skip_layer_strategy,
                 generator=generator,
                 output_type="pt",
-                callback_on_step_end=None,
+                callback_on_step_end=tracker.on_step_end,
                 height=height_padded,
                 width=width_padded,
                 num_frames=num_frames_padded,
@@ -340,25 +591,11 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
                 mixed_precision=(pipeline_config.get("precision") == "mixed_precision"),
                 offload_to_cpu=False,
                 device=device,
-                enhance_prompt=True,
+                enhance_prompt=False,  # промпт уже улучшен и закодирован
             ).images
         
-        # 🔥 КРИТИЧНО: очистка памяти между этапами multi-scale
-        if torch.cuda.is_available():
-            allocated_before = torch.cuda.memory_allocated() / 1024**3
-            cached_before = torch.cuda.memory_reserved() / 1024**3
-            logger.info(f"🧹 Память между этапами multi-scale: {allocated_before:.1f}GB allocated, {cached_before:.1f}GB cached")
-            
-            # Принудительная очистка между этапами
-            torch.cuda.synchronize()
-            torch.cuda.empty_cache()
-            
-            allocated_after = torch.cuda.memory_allocated() / 1024**3
-            cached_after = torch.cuda.memory_reserved() / 1024**3
-            freed_allocated = allocated_before - allocated_after
-            freed_cached = cached_before - cached_after
-            logger.info(f"🧹 Очистка между этапами multi-scale: {allocated_after:.1f}GB allocated, {cached_after:.1f}GB cached")
-            logger.info(f"🧹 Освобождено между этапами: {freed_allocated:.1f}GB allocated, {freed_cached:.1f}GB cached")
+        # Очистка между генерацией и кодированием (always — как раньше; auto — кодированию хватает пула аллокатора)
+        memory_model.flush("between")
         
         # 🔥 Очищаем промежуточные переменные multi-scale
         del first_pass_config
@@ -378,16 +615,15 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
         del conditioning_items, media_item
     else:
         # Обычный pipeline
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            logger.info("🧹 Очистка GPU кеша перед генерацией (single-scale)")
+        offload.offloader.use("denoise")
+        memory_model.flush("before", predicted_peak)
         # 🔥 КРИТИЧНО: используем no_grad для отключения autograd (позволяет callback'и)
-        with torch.no_grad():
+        with torch.no_grad(), peak_meter, tiled_decode, offload.offloader.generation(), profile.pipeline_stages(ready_pipeline):
             images = ready_pipeline(
                 skip_layer_strategy=skip_layer_strategy,
                 generator=generator,
                 output_type="pt",
-                callback_on_step_end=None,
+                callback_on_step_end=tracker.on_step_end,
                 height=height_padded,
                 width=width_padded,
                 num_frames=num_frames_padded,
@@ -401,7 +637,7 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
                 mixed_precision=(pipeline_config.get("precision") == "mixed_precision"),
                 offload_to_cpu=False,
                 device=device,
-                enhance_prompt=True,
+                enhance_prompt=False,  # промпт уже улучшен и закодирован
                 timesteps=timesteps,
                 guidance_scale=pipeline_config.get("first_pass", {}).get("guidance_scale", 1.0),
                 stg_scale=pipeline_config.get("first_pass", {}).get("stg_scale", 0.0),
@@ -409,154 +645,675 @@ def infer_with_ready_pipeline(config, ready_pipeline, pipeline_config):
                 skip_block_list=pipeline_config.get("first_pass", {}).get("skip_block_list", [42]),
             ).images
     
-    # Обрезаем до нужного размера
-    (pad_left, pad_right, pad_top, pad_bottom) = padding
-    pad_bottom = -pad_bottom
-    pad_right = -pad_right
-    if pad_bottom == 0:
-        pad_bottom = images.shape[3]
-    if pad_right == 0:
-        pad_right = images.shape[4]
-    images = images[:, :, : config.num_frames, pad_top:pad_bottom, pad_left:pad_right]
-    
-    # Сохраняем видео
-    output_dir = Path(config.output_path) if config.output_path else Path(f"outputs/{datetime.today().strftime('%Y-%m-%d')}")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # Сохраняем видео: кадры кусками уходят в ffmpeg, целиком в памяти хоста видео не собирается
+    if not in_memory:
+        output_dir = Path(config.output_path) if config.output_path else Path(f"outputs/{datetime.today().strftime('%Y-%m-%d')}")
+        output_dir.mkdir(parents=True, exist_ok=True)
     
-    result_paths = []
-    for i in range(images.shape[0]):
-        video_np = images[i].permute(1, 2, 3, 0).cpu().float().numpy()
-        video_np = (video_np * 255).astype(np.uint8)
-        
-        output_filename = get_unique_filename(
-            f"video_output_{i}",
-            ".mp4",
-            prompt=config.prompt,
-            seed=config.seed,
-            resolution=(config.height, config.width, config.num_frames),
-            dir=output_dir,
-        )
-        
-        imageio.mimsave(output_filename, video_np, fps=config.frame_rate)
-        logger.info(f"Output saved to {output_filename}")
-        result_paths.append(str(output_filename))
-    
-    # 🔥 КРИТИЧНО: Очищаем память после генерации
-    if torch.cuda.is_available():
-        # 🔥 АГРЕССИВНО: выгружаем результат на CPU и сразу очищаем GPU
-        images_cpu = images.detach().to("cpu", copy=True)  # отдельный буфер на CPU
-        del images  # удаляем с GPU
+    tracker.stage("encode")
+    results_per_config = []
+    for i, c in enumerate(configs):
+        # Обрезаем до нужного размера (паддинг у каждой задачи свой)
+        (pad_left, pad_right, pad_top, pad_bottom) = calculate_padding(c.height, c.width, height_padded, width_padded)
+        pad_bottom = -pad_bottom
+        pad_right = -pad_right
+        if pad_bottom == 0:
+            pad_bottom = images.shape[3]
+        if pad_right == 0:
+            pad_right = images.shape[4]
+        video = images[i, :, : c.num_frames, pad_top:pad_bottom, pad_left:pad_right]
         
-        # Принудительная очистка CUDA
-        torch.cuda.synchronize()
-        torch.cuda.empty_cache()
+        sink = outputs[i] if outputs else None
+        if sink is not None:
+            output = sink
+        elif in_memory:
+            output = io.BytesIO()
+        else:
+            output = get_unique_filename(
+                f"video_output_0",
+                ".mp4",
+                prompt=c.prompt,
+                seed=c.seed,
+                resolution=(c.height, c.width, c.num_frames),
+                dir=output_dir,
+            )
         
-        # Логируем состояние памяти после очистки
-        allocated = torch.cuda.memory_allocated() / 1024**3
-        cached = torch.cuda.memory_reserved() / 1024**3
-        logger.info(f"🧹 Память очищена после генерации: {allocated:.1f}GB allocated, {cached:.1f}GB cached")
+        # Ожидание кусков кадров — tensor_to_host, остальное (ffmpeg, запись) — encode
+        with profile.stage("encode"), StreamingMp4Writer(output, width=video.shape[3], height=video.shape[2], fps=c.frame_rate) as writer:
+            # uint8 считается на устройстве, на хост кусками через pinned буфер (копия перекрывается с кодированием)
+            for chunk_np in profile.timed_iter("tensor_to_host", iter_uint8_chunks(video, ENCODE_CHUNK_FRAMES)):
+                writer.write(chunk_np)
+        del video
         
-        # Используем images_cpu для сохранения видео
-        images = images_cpu
+        if sink is not None:
+            logger.info(f"Output streamed: {writer.frames_written} frames, {writer.bytes_written / 1024 / 1024:.2f}MB")
+            results_per_config.append([sink])
+        elif in_memory:
+            logger.info(f"Output encoded in memory: {writer.frames_written} frames, {writer.bytes_written / 1024 / 1024:.2f}MB")
+            results_per_config.append([output.getvalue()])
+        else:
+            logger.info(f"Output saved to {output}")
+            results_per_config.append([str(output)])
     
-    # 🔥 ФИНАЛЬНАЯ очистка: удаляем все большие объекты
-    del images_cpu
+    # 🔥 КРИТИЧНО: Очищаем память после генерации (кадры уже закодированы, копия на CPU не нужна)
+    del images
     if 'conditioning_items' in locals():
         del conditioning_items
     if 'media_item' in locals():
         del media_item
     if 'generator' in locals():
         del generator
-    import gc
-    gc.collect()
-    torch.cuda.synchronize()
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()  # помогает добить IPC-хэндлы
+    # Сброс кеша аллокатора по политике: с auto пул остаётся следующей задаче того же размера
+    memory_model.flush("after")
     
-    return result_paths
+    logger.info(f"⏱️ Этапы: {profile.summary()}")
+    warmup.latency.record((height_padded, width_padded, num_frames_padded), time.time() - started_at)
+    if not warmup.latency.warming_up:
+        startup_timeline.timeline.event(
+            "first_request", seconds=round(time.time() - started_at, 3),
+            bucket=bucket_name((height_padded, width_padded, num_frames_padded)),
+        )
+    if progress_tracker is None:
+        tracker.finish()
+    return results_per_config
+
+def build_inference_config(command):
+    """Команда (dict) -> (InferenceConfig, conditioning_images)"""
+    inference_config = InferenceConfig(
+        prompt=command['prompt'],
+        negative_prompt=command['negative_prompt'],
+        height=command['height'],
+        width=command['width'],
+        num_frames=command['num_frames'],
+        seed=command['seed'],
+        pipeline_config="ltxv-13b-0.9.8-distilled.yaml",
+        frame_rate=24  # Устанавливаем 24 FPS как стандарт для видео
+    )
+    
+    # Добавляем изображение если есть: base64 прямо в команде (без временного файла)
+    conditioning_images = None
+    if command.get('image_base64'):
+        conditioning_images = [conditioning.decode_base64_image(command['image_base64'])]
+        inference_config.conditioning_start_frames = [0]
+        logger.info("🖼️ Conditioning изображение получено в команде (в памяти)")
+    elif command.get('image_path') and os.path.exists(command['image_path']):
+        # Для image-to-video используем conditioning_media_paths как в рабочем скрипте
+        inference_config.conditioning_media_paths = [command['image_path']]
+        inference_config.conditioning_start_frames = [0]
+        logger.info(f"🖼️ Устанавливаем conditioning_media_paths: {command['image_path']}")
+    return inference_config, conditioning_images
+
+def command_error(command):
+    """Текст ошибки, если без полей команды задачу нельзя запланировать; None — команда годится"""
+    if not isinstance(command, dict):
+        return "Команда должна быть JSON объектом"
+    for field in ('height', 'width', 'num_frames'):
+        if command.get(field) is None:
+            return f"В команде нет поля {field}"
+        try:
+            value = int(command[field])
+        except (TypeError, ValueError):
+            return f"Поле {field} должно быть целым числом, получено {command[field]!r}"
+        if value <= 0:
+            return f"Поле {field} должно быть положительным, получено {value}"
+    return None
+
+def command_bucket(command):
+    """Padded размер команды (ключ батча); None — команду нельзя батчить (image-to-video)"""
+    if command.get('image_base64') or command.get('image_path'):
+        return None
+    try:
+        return padded_shape(command['height'], command['width'], command['num_frames'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def metrics_bucket(command):
+    """Метка размера для метрик: padded размер и у image-to-video (у них command_bucket — None)"""
+    try:
+        return bucket_name(padded_shape(command['height'], command['width'], command['num_frames']))
+    except (KeyError, TypeError, ValueError):
+        return "none"
+
+def progress_path(command_id):
+    return os.path.join(job_leases.COMMANDS_DIR, f"progress_{command_id}.json")
+
+def job_group(job):
+    """Задача и присоединённые к ней дубли (список дублей может пополняться из потоков RPC)"""
+    return [job] + list(job.get('followers', ()))
+
+def send_progress(job, update, extra):
+    command_id = job['command_id']
+    if job.get('reply') is not None:
+        job['reply'].progress(command_id=command_id, **update, **extra)
+    elif job.get('claimed_path') is not None:
+        job_leases.write_json_atomic(progress_path(command_id), {'command_id': command_id, **update, **extra})
+
+def progress_sink(job):
+    """Куда отправлять обновления прогресса задачи (и её дублей)"""
+    def send(update):
+        # progress_extra — поля, которые идут в каждом следующем обновлении (путь к превью)
+        extra = job.get('progress_extra', {})
+        for target in job_group(job):
+            send_progress(target, update, extra)
+    return send
+
+def job_preview_mode(job):
+    try:
+        return preview.parse_mode(job['command'].get('preview'))
+    except ValueError as e:
+        logger.warning(f"⚠️ {job['command_id']}: {e}, превью выключено")
+        return "off"
 
-def process_command_file(command_file):
-    """Обрабатываем команду из файла"""
+def job_vae_tiling(job):
+    try:
+        return tiled_vae.parse_mode(job['command'].get('vae_tiling'))
+    except ValueError as e:
+        logger.warning(f"⚠️ {job['command_id']}: {e}, режим по умолчанию")
+        return tiled_vae.parse_mode(None)
+
+def make_preview_handler(jobs, preview_modes, tracker):
+    """on_preview для батча: файл превью + путь в прогресс задачи, которая его просила"""
+    def on_preview(index, data, fmt):
+        if preview_modes[index] == "off":
+            return
+        job = jobs[index]
+        os.makedirs(PREVIEW_DIR, exist_ok=True)
+        path = os.path.join(PREVIEW_DIR, f"preview_{job['command_id']}.{fmt}")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        job['progress_extra'] = {'preview': path}
+        tracker.refresh()
+    return on_preview
+
+def process_jobs(jobs):
+    """Выполняем задачи одним вызовом pipeline (батч) и возвращаем результат на каждую"""
     global global_pipeline, global_pipeline_config
     
+    command_ids = [job['command_id'] for job in jobs]
     try:
-        # Читаем команду
-        with open(command_file, 'r') as f:
-            command = json.load(f)
-        
-        logger.info(f"📥 Обрабатываем: {command_file}")
-        logger.info(f"🎬 Генерируем видео: {command['prompt'][:50]}...")
+        for job in jobs:
+            logger.info(f"🎬 Генерируем видео: {job['command']['prompt'][:50]}...")
         
         # Проверяем что pipeline готов
         if global_pipeline is None:
             raise Exception("Pipeline не загружен")
         
-        # Создаем конфиг для inference
-        inference_config = InferenceConfig(
-            prompt=command['prompt'],
-            negative_prompt=command['negative_prompt'],
-            height=command['height'],
-            width=command['width'],
-            num_frames=command['num_frames'],
-            seed=command['seed'],
-            pipeline_config="ltxv-13b-0.9.8-distilled.yaml",
-            frame_rate=24  # Устанавливаем 24 FPS как стандарт для видео
-        )
+        # Время и пик памяти по этапам — общие на батч, уходят в результат каждой задачи
+        profile = stage_profile.StageProfile(batch_size=len(jobs))
         
-        # Добавляем изображение если есть
-        if command.get('image_path') and os.path.exists(command['image_path']):
-            # Для image-to-video используем conditioning_media_paths как в рабочем скрипте
-            inference_config.conditioning_media_paths = [command['image_path']]
-            inference_config.conditioning_start_frames = [0]
-            logger.info(f"🖼️ Устанавливаем conditioning_media_paths: {command['image_path']}")
+        # Создаем конфиги для inference
+        configs, conditioning_images_list = [], []
+        with profile.stage("input_decode"):
+            for job in jobs:
+                inference_config, conditioning_images = build_inference_config(job['command'])
+                configs.append(inference_config)
+                conditioning_images_list.append(conditioning_images)
         
-        logger.info(f"🎯 Используем готовый pipeline...")
+        logger.info(f"🎯 Используем готовый pipeline (батч из {len(jobs)})...")
+        for job in jobs:
+            for target in job_group(job):
+                if target.get('reply') is not None:
+                    target['reply'].progress(stage="started", command_id=target['command_id'], batch_size=len(jobs))
         
-        # Используем готовый pipeline напрямую (без subprocess)
-        result_paths = infer_with_ready_pipeline(inference_config, global_pipeline, global_pipeline_config)
+        # Прогресс по шагам: в RPC соединение или в progress_<id>.json (файловый режим)
+        tracker = progress.ProgressTracker(sinks=[progress_sink(job) for job in jobs])
+        preview_modes = [job_preview_mode(job) for job in jobs]
+        try:
+            # Используем готовый pipeline напрямую (без subprocess)
+            results_per_config = infer_batch_with_ready_pipeline(
+                configs, global_pipeline, global_pipeline_config, conditioning_images_list=conditioning_images_list,
+                progress_tracker=tracker, preview_mode=preview.strongest_mode(preview_modes),
+                on_preview=make_preview_handler(jobs, preview_modes, tracker),
+                vae_tiling=tiled_vae.strongest_mode([job_vae_tiling(job) for job in jobs]),
+                profile=profile,
+            )
+        finally:
+            tracker.finish()
+        profile_data = profile.to_dict()
         
-        # Ищем созданный файл в папке outputs
-        output_dir = f"outputs/{time.strftime('%Y-%m-%d')}"
-        if os.path.exists(output_dir):
-            mp4_files = glob.glob(f"{output_dir}/*.mp4")
-            if mp4_files:
-                # Берем самый новый файл
-                video_path = max(mp4_files, key=os.path.getctime)
-                
-                if os.path.exists(video_path):
-                    logger.info(f"✅ Видео создано: {video_path}")
-                    
-                    # Создаем результат
-                    result = {
-                        'status': 'success',
-                        'result': video_path,
-                        'command_id': os.path.basename(command_file).replace('command_', '').replace('.json', '')
-                    }
-                    
-                    return result
-                else:
-                    raise Exception(f"Файл не найден: {video_path}")
-            else:
-                raise Exception("Не найдены MP4 файлы в папке outputs")
-        else:
-            raise Exception("Папка outputs не существует")
+        results = []
+        for command_id, result_paths in zip(command_ids, results_per_config):
+            # Берём путь, который вернул сам inference (без поиска «самого нового» файла)
+            if not result_paths or not os.path.exists(result_paths[0]):
+                results.append({
+                    'status': 'error',
+                    'error': f"Файл результата не найден: {result_paths}",
+                    'command_id': command_id
+                })
+                continue
+            video_path = result_paths[0]
+            logger.info(f"✅ Видео создано: {video_path}")
+            results.append({
+                'status': 'success',
+                'result': video_path,
+                'command_id': command_id,
+                'profile': profile_data,
+            })
+        return results
             
     except Exception as e:
         import traceback
         logger.error(f"❌ Ошибка обработки команды: {e}")
         logger.error(f"❌ Traceback: {traceback.format_exc()}")
-        return {
+        return [{
             'status': 'error',
             'error': str(e),
-            'command_id': os.path.basename(command_file).replace('command_', '').replace('.json', '')
-        }
+            'command_id': command_id
+        } for command_id in command_ids]
+
+def process_command(command, command_id, reply=None):
+    """Обрабатываем одну команду (из файла или из RPC сокета)"""
+    return process_jobs([{'command_id': command_id, 'command': command, 'reply': reply}])[0]
+
+def finish_job(job, result, lease):
+    """Отдаём результат задаче и всем присоединённым к ней дублям"""
+    for follower in coalesced.release(job):
+        try:
+            deliver_result(follower, {**result, 'command_id': follower['command_id'], 'coalesced_with': job['command_id']}, lease)
+        except OSError as e:
+            logger.error(f"❌ Не удалось отдать результат дублю {follower['command_id']}: {e}")
+    deliver_result(job, result, lease)
+
+def deliver_result(job, result, lease):
+    """Отдаём результат: в RPC соединение или в result_<id>.json (файловый режим)"""
+    if job.get('reply') is not None:
+        job['reply'].finish(result)
+        return
+    try:
+        # Сохраняем результат (атомарно, чтобы клиент не прочитал половину файла)
+        result_file = os.path.join(job_leases.COMMANDS_DIR, f"result_{job['command_id']}.json")
+        job_leases.write_json_atomic(result_file, result)
+        try:
+            os.remove(progress_path(job['command_id']))
+        except FileNotFoundError:
+            pass
+    finally:
+        # Снимаем аренду — команда выполнена
+        lease.release(job['claimed_path'])
+
+def coalesce_job(job, lease=None):
+    """True — такая же задача уже в очереди или в работе: job ждёт её результат, в планировщик не идёт
+
+    Незахваченную файловую команду-дубль сначала захватываем (lease), иначе её возьмёт другой демон;
+    ведущей она становится только после захвата (take_job).
+    """
+    if job['command'] is None:
+        return False
+    if 'coalesce_key' not in job:
+        job['cache_key'] = result_cache.command_key(job['command'], default_negative_prompt=DEFAULT_NEGATIVE_PROMPT)
+        job['coalesce_key'] = coalescing.coalesce_key(job['command'], request_hash=job['cache_key'])
+    key = job['coalesce_key']
+    if job.get('command_file') is not None and job.get('claimed_path') is None:
+        if lease is None or coalesced.leader(key) is None:
+            return False
+        claimed_path = lease.claim(job['command_file'])
+        if claimed_path is None:
+            # Опередил другой демон
+            return True
+        job['claimed_path'] = claimed_path
+    leader = coalesced.attach(key, job)
+    if leader is None:
+        return False
+    logger.info(f"🔗 {job['command_id']}: такая же задача {leader['command_id']} уже в работе, ждём её результат")
+    if job.get('reply') is not None:
+        job['reply'].progress(stage="coalesced", command_id=job['command_id'], leader_command_id=leader['command_id'])
+    return True
+
+def admission_error(job, decision):
+    return {
+        'status': 'error',
+        'error': f"Недостаточно памяти GPU: {decision.reason}",
+        'command_id': job['command_id'],
+        'admission': decision.to_dict(),
+    }
+
+def admit_jobs(jobs):
+    """Допуск по прогнозу пика памяти до старта GPU работы: (допущенные задачи, {command_id: ошибка})
+
+    Батч, который не помещается целиком, сокращаем до первой задачи, остальные — обратно в очередь.
+    """
+    # С тайлами VAE пик задаёт denoising — допуск по его модели
+    kind = tiled_vae.admission_kind(global_pipeline, tiled_vae.strongest_mode([job_vae_tiling(job) for job in jobs]))
+    command = jobs[0]['command']
+    decision = memory_model.admission.admit(
+        kind, command['height'], command['width'], command['num_frames'], batch=len(jobs), oversize=command.get('oversize'),
+    )
+    if decision.action != 'accept' and len(jobs) > 1:
+        logger.info(f"🧮 Батч из {len(jobs)} не помещается в память, выполняем по одной")
+        for job in jobs[1:]:
+            schedule_job(job)
+        jobs = jobs[:1]
+        decision = memory_model.admission.admit(
+            kind, command['height'], command['width'], command['num_frames'], oversize=command.get('oversize'),
+        )
+    job = jobs[0]
+    if decision.action == 'reject':
+        return [], {job['command_id']: admission_error(job, decision)}
+    if decision.action == 'downscale':
+        job['admission'] = {**decision.to_dict(), 'requested': [command['width'], command['height']]}
+        job['command'] = {**command, 'height': decision.height, 'width': decision.width}
+        # Уменьшенный результат не кладём в кеш под ключом исходного запроса
+        job['cache_key'] = None
+    return jobs, {}
+
+def schedule_job(job, enqueued_at=None, lease=None):
+    """Ставим задачу (RPC или файл) в планировщик"""
+    error = command_error(job['command']) if job['command'] is not None else None
+    if error:
+        logger.warning(f"⚠️ Некорректная команда {job['command_id']}: {error}")
+        if job.get('reply') is not None:
+            finish_job(job, {'status': 'error', 'error': error, 'command_id': job['command_id']}, None)
+            return
+        # Файловую команду захватим в свою очередь и ответим ошибкой (как на нечитаемую)
+        job['command'], job['command_error'] = None, error
+    if coalesce_job(job, lease):
+        return
+    # Задачу, которая не поместится в память никогда, RPC клиенту отклоняем сразу, а не после очереди
+    if job.get('reply') is not None and job['command'] is not None and global_pipeline is not None:
+        command = job['command']
+        decision = memory_model.admission.decide(
+            tiled_vae.admission_kind(global_pipeline, job_vae_tiling(job)), command['height'], command['width'], command['num_frames'],
+            oversize=command.get('oversize'),
+        )
+        if decision.action == 'reject':
+            finish_job(job, admission_error(job, decision), None)
+            return
+    command = job['command'] or {}
+    enqueued_at = enqueued_at if enqueued_at is not None else time.time()
+    try:
+        priority = job_scheduler.parse_priority(command.get('priority'))
+        deadline = job_scheduler.parse_deadline(command, enqueued_at)
+    except (TypeError, ValueError) as e:
+        logger.warning(f"⚠️ Некорректные priority/deadline в {job['command_id']}: {e}")
+        priority, deadline = None, None
+    bucket = command_bucket(command) if job['command'] else None
+    scheduler.add(job['command_id'], bucket=bucket, priority=priority, deadline=deadline, enqueued_at=enqueued_at)
+    queued_jobs[job['command_id']] = job
+
+def refresh_queue(lease):
+    """Переносим новые RPC задачи и незахваченные команды из общей папки в планировщик"""
+    while True:
+        job = next_rpc_job(timeout=0)
+        if job is None:
+            break
+        schedule_job(job)
+    
+    # Файловые команды остаются незахваченными до выдачи — их могут взять и другие демоны
+    present = set()
+    for command_file in lease.pending():
+        command_id = job_leases.command_id_from_path(command_file)
+        present.add(command_id)
+        if command_id in queued_jobs:
+            continue
+        try:
+            enqueued_at = os.path.getmtime(command_file)
+            with open(command_file, 'r') as f:
+                command = json.load(f)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError):
+            # Битая команда: захватим и ответим ошибкой
+            command, enqueued_at = None, time.time()
+        schedule_job({'command_id': command_id, 'command': command, 'reply': None, 'command_file': command_file},
+                     enqueued_at=enqueued_at, lease=lease)
+    
+    # Команды, которые уже забрал другой демон
+    for command_id, job in list(queued_jobs.items()):
+        if job.get('command_file') and job.get('claimed_path') is None and command_id not in present:
+            scheduler.discard(command_id)
+            queued_jobs.pop(command_id, None)
+    
+    notify_queue_positions()
+
+def notify_queue_positions():
+    """RPC клиентам — позиция в очереди и ожидаемый старт, когда они меняются"""
+    for command_id, (position, expected_start) in scheduler.positions().items():
+        job = queued_jobs.get(command_id)
+        if job is None:
+            continue
+        for target in job_group(job):
+            if target.get('reply') is None or target.get('notified_position') == position:
+                continue
+            target['notified_position'] = position
+            target['reply'].progress(
+                stage="queued", command_id=target['command_id'], position=position, expected_start=expected_start,
+                expected_wait_seconds=max(0.0, expected_start - time.time()),
+            )
+
+def take_job(entry, lease):
+    """Задача, выбранная планировщиком: файловую команду захватываем только сейчас"""
+    job = queued_jobs.pop(entry.job_id, None)
+    if job is None:
+        return None
+    if job.get('command_file') and job.get('claimed_path') is None:
+        claimed_path = lease.claim(job['command_file'])
+        if claimed_path is None:
+            # Опередил другой демон
+            return None
+        logger.info(f"📥 Обрабатываем: {claimed_path}")
+        job['claimed_path'] = claimed_path
+    # Дубль задачи, уже взятой в этот батч, — ждёт её результат, а не занимает слот
+    if coalesce_job(job):
+        return None
+    return job
+
+def next_batch(lease):
+    """Следующая задача по планировщику + совместимые (тот же padded размер, text-to-video) в пределах окна"""
+    while True:
+        entry = scheduler.pop_next()
+        if entry is None:
+            return []
+        job = take_job(entry, lease)
+        if job is not None:
+            break
+    jobs = [job]
+    if entry.bucket is None or MAX_BATCH_SIZE <= 1:
+        return jobs
+    # Батч не больше, чем помещается в память по модели пика
+    max_batch = memory_model.admission.max_batch(
+        tiled_vae.admission_kind(global_pipeline, job_vae_tiling(job)), entry.bucket, MAX_BATCH_SIZE,
+    )
+    
+    deadline = time.time() + BATCH_WINDOW_MS / 1000.0
+    while len(jobs) < max_batch:
+        for other in scheduler.pop_compatible(entry.bucket, max_batch - len(jobs)):
+            other_job = take_job(other, lease)
+            if other_job is not None:
+                jobs.append(other_job)
+        remaining = deadline - time.time()
+        if remaining <= 0 or len(jobs) >= max_batch:
+            break
+        job = next_rpc_job(timeout=min(remaining, 0.05))
+        if job is not None:
+            schedule_job(job)
+        refresh_queue(lease)
+    return jobs
+
+def record_batch_stats(batch_size, elapsed):
+    """Задержка и пропускная способность по размерам батча"""
+    with batch_stats_lock:
+        stats = batch_stats.setdefault(batch_size, {'batches': 0, 'jobs': 0, 'seconds': 0.0})
+        stats['batches'] += 1
+        stats['jobs'] += batch_size
+        stats['seconds'] += elapsed
+        stats = dict(stats)
+    logger.info(
+        f"📦 Батч {batch_size}: {elapsed:.1f}с, {elapsed / batch_size:.1f}с/задачу, "
+        f"в среднем {stats['seconds'] / stats['batches']:.1f}с/батч, "
+        f"{stats['jobs'] / stats['seconds'] * 60:.2f} задач/мин"
+    )
+
+def cached_result(job):
+    """Результат из кеша (копия в outputs/) или None; ключ запоминаем для записи после генерации"""
+    if 'cache_key' not in job:
+        job['cache_key'] = result_cache.command_key(job['command'], default_negative_prompt=DEFAULT_NEGATIVE_PROMPT)
+    hit = result_cache.get_cache().get(job['cache_key'])
+    if hit is None:
+        return None
+    cached_path, _ = hit
+    from datetime import datetime
+    import shutil
+    output_dir = Path(job['command'].get('output_path') or f"outputs/{datetime.today().strftime('%Y-%m-%d')}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # Копия: запись кеша может быть вытеснена, пока клиент забирает файл
+    video_path = str(output_dir / f"cached_{job['command_id']}.mp4")
+    shutil.copyfile(cached_path, video_path)
+    logger.info(f"🎯 {job['command_id']}: результат из кеша, без генерации")
+    return {'status': 'success', 'result': video_path, 'command_id': job['command_id'], 'cached': True}
+
+def run_jobs(jobs, lease):
+    """Выполняем батч задач и раздаём результаты"""
+    global current_command_ids
+    current_command_ids = [job['command_id'] for job in jobs]
+    bucket = command_bucket(jobs[0]['command']) if jobs[0]['command'] else None
+    scheduler.start_run(bucket, len(jobs))
+    notify_queue_positions()
+    started_at = time.time()
+    to_generate = []
+    generation_seconds = None
+    try:
+        runnable = [job for job in jobs if job['command'] is not None]
+        results = {job['command_id']: {
+            'status': 'error', 'error': job.get('command_error') or 'Не удалось прочитать команду', 'command_id': job['command_id']
+        } for job in jobs if job['command'] is None}
+        # Повторы уже сгенерированного — из кеша результатов, без GPU
+        for job in runnable:
+            try:
+                result = cached_result(job)
+            except OSError as e:
+                logger.warning(f"⚠️ Кеш результатов недоступен: {e}")
+                result = None
+            if result is not None:
+                results[job['command_id']] = result
+            else:
+                to_generate.append(job)
+        if to_generate:
+            to_generate, rejected = admit_jobs(to_generate)
+            results.update(rejected)
+        if to_generate:
+            if len(to_generate) > 1:
+                logger.info(f"📦 Батч из {len(to_generate)} задач: {bucket_name(command_bucket(to_generate[0]['command']))}")
+            for job, result in zip(to_generate, process_jobs(to_generate)):
+                if job.get('admission'):
+                    result['admission'] = job['admission']
+                results[job['command_id']] = result
+        if to_generate:
+            generation_seconds = time.time() - started_at
+            for job in to_generate:
+                result = results[job['command_id']]
+                if result.get('status') == 'success':
+                    result['generation_seconds'] = round(generation_seconds / len(to_generate), 3)
+        for job in jobs:
+            finish_job(job, results[job['command_id']], lease)
+        # Метрики — после выдачи: их ошибка не должна оставить клиента без результата
+        for job in to_generate:
+            result = results[job['command_id']]
+            try:
+                metrics.observe_job(
+                    metrics_bucket(job['command']), result.get('status'),
+                    result.get('generation_seconds'), result.get('profile'),
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Метрики задачи {job['command_id']} не записаны: {e}")
+        if to_generate:
+            record_batch_stats(len(to_generate), generation_seconds)
+            # Дубли получили результат ведущей — их доля батча не потрачена на GPU
+            followers = sum(len(job.get('followers', ())) for job in to_generate)
+            if followers:
+                coalesced.record_saved(followers * generation_seconds / len(to_generate))
+        # В кеш — уже после выдачи результатов, чтобы не задерживать клиентов
+        for job in to_generate:
+            result = results[job['command_id']]
+            if result.get('status') == 'success':
+                result_cache.get_cache().put(
+                    job.get('cache_key'), result['result'],
+                    prompt=job['command'].get('prompt'), seed=job['command'].get('seed'),
+                    generation_seconds=round(generation_seconds, 3),
+                )
+    finally:
+        # Ошибки чтения команд и попадания в кеш не должны портить оценку длительности
+        scheduler.finish_run(bucket, len(jobs), generation_seconds)
+        current_command_ids = []
+
+def batch_stats_snapshot():
+    """Копия статистики батчей: её читает поток RPC (status), пока поток генерации пишет"""
+    with batch_stats_lock:
+        return {size: dict(stats) for size, stats in batch_stats.items()}
+
+def daemon_status():
+    """Состояние демона для RPC запроса status"""
+    return {
+        'ready': global_pipeline is not None,
+        'worker_id': worker_id,
+        'device': DAEMON_DEVICE,
+        'busy': bool(current_command_ids),
+        'current_command_id': current_command_ids[0] if current_command_ids else None,
+        'current_batch_size': len(current_command_ids),
+        'rpc_queue_depth': rpc_job_queue.qsize() + sum(1 for job in list(queued_jobs.values()) if job.get('reply') is not None),
+        'file_queue_depth': len(glob.glob(os.path.join(job_leases.COMMANDS_DIR, "command_*.json"))),
+        'max_batch_size': MAX_BATCH_SIZE,
+        'queue': scheduler.snapshot(),
+        'warmup': warmup.latency.stats(),
+        'result_cache': result_cache.get_cache().stats(),
+        'coalescing': coalesced.stats(),
+        'memory': memory_model.stats(),
+        'gpu_memory': memory_model.gpu_memory(),
+        'embedding_cache': global_embedding_cache.stats() if global_embedding_cache is not None else None,
+        'prompt_cache': global_prompt_cache.stats() if global_prompt_cache is not None else None,
+        'offload': offload.offloader.stats(),
+        'startup_timeline': startup_timeline.timeline.to_dict(),
+        'batch_stats': {
+            str(size): {
+                'batches': stats['batches'],
+                'jobs': stats['jobs'],
+                'seconds_per_job': stats['seconds'] / stats['jobs'],
+                'jobs_per_minute': stats['jobs'] / stats['seconds'] * 60 if stats['seconds'] else 0.0,
+            }
+            for size, stats in batch_stats_snapshot().items()
+        },
+    }
+
+class CoalescingJobQueue(queue.Queue):
+    """Очередь RPC задач: дубль присоединяется к задаче в очереди/работе прямо в потоке сервера,
+    в том числе пока основной цикл занят генерацией"""
+
+    def put(self, job, block=True, timeout=None):
+        if coalesce_job(job):
+            return
+        super().put(job, block, timeout)
+
+# Очередь задач из RPC сокета (наполняется потоками сервера, читается основным циклом)
+rpc_job_queue = CoalescingJobQueue()
+# Ведущие задачи по ключу склейки (idempotency_key или хеш запроса) и счётчики сэкономленного
+coalesced = coalescing.InflightRegistry()
+# Планировщик и задачи, которые в нём ждут (command_id -> задача)
+scheduler = job_scheduler.JobScheduler()
+queued_jobs = {}
+# Статистика батчей: размер -> batches / jobs / seconds
+batch_stats = {}
+batch_stats_lock = threading.Lock()
+
+# Идентификатор этого демона в общей очереди и текущие задачи
+worker_id = job_leases.make_worker_id(DAEMON_DEVICE)
+current_command_ids = []
+
+def next_rpc_job(timeout):
+    try:
+        if timeout <= 0:
+            return rpc_job_queue.get_nowait()
+        return rpc_job_queue.get(timeout=timeout)
+    except queue.Empty:
+        return None
 
 def main():
     """Основная функция демона"""
-    logger.info("🚀 Запускаем официальный inference демон...")
+    logger.info(f"🚀 Запускаем официальный inference демон (устройство {DAEMON_DEVICE}, воркер {worker_id})...")
+    startup_timeline.timeline.record_since_import("imports")
     
     # Создаем папки
-    os.makedirs("inference_commands", exist_ok=True)
+    os.makedirs(job_leases.COMMANDS_DIR, exist_ok=True)
     os.makedirs("task_results", exist_ok=True)
     
     # Загружаем модели один раз
@@ -564,34 +1321,45 @@ def main():
         logger.error("💀 Не удалось загрузить модели, завершаем работу")
         return
     
-    # Ставим флаг готовности сразу после полной загрузки моделей
+    # Прогреваем частые размеры, флаг готовности — только после прогрева
+    warmup_pipeline()
     create_ready_flag()
     logger.info("🏁 Демон готов к работе!")
-    logger.info("📁 Ожидаем команды в папке inference_commands/")
+    logger.info(f"📁 Ожидаем команды в папке {job_leases.COMMANDS_DIR}/")
+    
+    # Регистрируемся в общей очереди: захват задач + heartbeat аренды
+    lease = job_leases.WorkerLease(worker_id, device=DAEMON_DEVICE)
+    lease.start()
+    
+    # RPC сокет: задачи приходят сразу, без опроса файловой системы
+    socket_path = os.environ.get("LTX_DAEMON_SOCKET") or daemon_rpc.socket_path_for_device(DAEMON_DEVICE)
+    rpc_server = daemon_rpc.RPCServer(rpc_job_queue, socket_path=socket_path, status_provider=daemon_status, validate=command_error)
+    rpc_server.start()
+    
+    # /metrics для Prometheus: статус читается при скрейпе в потоке HTTP сервера
+    metrics.serve_daemon(daemon_status, DAEMON_DEVICE)
     
     # Основной цикл
     while True:
         try:
-            # Ищем новые команды
-            command_files = glob.glob("inference_commands/command_*.json")
+            # Забираем задачи упавших соседей
+            lease.reap_expired()
             
-            for command_file in command_files:
-                # Обрабатываем команду
-                result = process_command_file(command_file)
-                
-                # Сохраняем результат
-                result_file = command_file.replace('command_', 'result_')
-                with open(result_file, 'w') as f:
-                    json.dump(result, f)
-                
-                # Удаляем команду
-                os.remove(command_file)
-                
-                # Очищаем GPU кеш между генерациями
-                clear_gpu_cache()
+            # RPC задачи и общая файловая очередь -> планировщик
+            refresh_queue(lease)
+            jobs = next_batch(lease)
+            if not jobs:
+                # Работы нет: ждём RPC задачу, таймаут задаёт период опроса папки команд
+                job = next_rpc_job(timeout=COMMAND_POLL_INTERVAL)
+                if job is not None:
+                    schedule_job(job)
+                continue
             
-            # Пауза между проверками
-            time.sleep(1)
+            # Выполняем выбранные задачи одним вызовом pipeline
+            run_jobs(jobs, lease)
+            
+            # Очищаем GPU кеш между генерациями
+            clear_gpu_cache()
             
         except KeyboardInterrupt:
             logger.info("\n🛑 Демон остановлен пользователем")
@@ -599,6 +1367,9 @@ def main():
         except Exception as e:
             logger.error(f"❌ Ошибка в основном цикле: {e}")
             time.sleep(5)
+    
+    rpc_server.stop()
+    lease.stop()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Общая файловая очередь для нескольких inference демонов (по одному на GPU)
+
+- Захват задачи: атомарный os.rename command_<id>.json -> claimed/<worker_id>/command_<id>.json,
+  переименование удаётся ровно одному демону.
+- Аренда: каждый демон раз в HEARTBEAT_INTERVAL обновляет workers/<worker_id>.heartbeat,
+  этим продлеваются все его захваченные задачи.
+- Если heartbeat старше LEASE_TTL, демон считается упавшим и его задачи возвращаются в очередь
+  (не больше MAX_ATTEMPTS раз, дальше пишется result с ошибкой).
+
+Модуль не зависит от torch и проверяется на CPU с «виртуальными» устройствами:
+    python job_leases.py --check
+"""
+
+import os
+import json
+import glob
+import time
+import socket
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+COMMANDS_DIR = os.environ.get("LTX_COMMANDS_DIR", "inference_commands")
+LEASE_TTL = float(os.environ.get("LTX_LEASE_TTL", "60"))
+HEARTBEAT_INTERVAL = float(os.environ.get("LTX_HEARTBEAT_INTERVAL", "10"))
+MAX_ATTEMPTS = int(os.environ.get("LTX_MAX_JOB_ATTEMPTS", "3"))
+
+
+def make_worker_id(device):
+    """Уникальный ID демона: хост + устройство + pid"""
+    return f"{socket.gethostname()}-gpu{device}-{os.getpid()}"
+
+
+def command_id_from_path(command_path):
+    return os.path.basename(command_path).replace('command_', '').replace('.json', '')
+
+
+def write_json_atomic(path, data):
+    """Пишем JSON через временный файл, чтобы читатель не увидел половину"""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class WorkerLease:
+    """Аренда задач одним демоном в общей папке команд"""
+
+    def __init__(self, worker_id, device="0", commands_dir=COMMANDS_DIR,
+                 lease_ttl=LEASE_TTL, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.worker_id = worker_id
+        self.device = str(device)
+        self.commands_dir = commands_dir
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.claimed_root = os.path.join(commands_dir, "claimed")
+        self.claimed_dir = os.path.join(self.claimed_root, worker_id)
+        self.workers_dir = os.path.join(commands_dir, "workers")
+        self.heartbeat_path = os.path.join(self.workers_dir, f"{worker_id}.heartbeat")
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_reap = 0.0
+
+    def start(self):
+        os.makedirs(self.claimed_dir, exist_ok=True)
+        os.makedirs(self.workers_dir, exist_ok=True)
+        # Heartbeat создаём ДО первого захвата, иначе соседи примут нас за упавшего
+        write_json_atomic(self.heartbeat_path, {
+            'worker_id': self.worker_id,
+            'device': self.device,
+            'pid': os.getpid(),
+            'started_at': time.time(),
+        })
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        logger.info(f"🪪 Воркер {self.worker_id} зарегистрирован (ttl={self.lease_ttl}с)")
+
+    def stop(self):
+        """Штатная остановка: возвращаем свои задачи в очередь и снимаем регистрацию"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.heartbeat_interval)
+        for claimed_path in glob.glob(os.path.join(self.claimed_dir, "command_*.json")):
+            self._requeue(claimed_path, count_attempt=False)
+        for path in (self.heartbeat_path, self.claimed_dir):
+            try:
+                os.rmdir(path) if os.path.isdir(path) else os.remove(path)
+            except OSError:
+                pass
+
+    def renew(self):
+        """Продлеваем аренду всех захваченных задач"""
+        try:
+            os.utime(self.heartbeat_path, None)
+        except FileNotFoundError:
+            # Нас успели списать (например, долгий stop-the-world) — регистрируемся заново,
+            # вместе с папкой захваченных задач: её сосед удалил при списании
+            os.makedirs(self.workers_dir, exist_ok=True)
+            os.makedirs(self.claimed_dir, exist_ok=True)
+            write_json_atomic(self.heartbeat_path, {'worker_id': self.worker_id, 'device': self.device,
+                                                    'pid': os.getpid(), 'started_at': time.time()})
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.renew()
+            except Exception as e:
+                logger.error(f"❌ Ошибка heartbeat: {e}")
+
+    def pending(self):
+        """Ожидающие команды, старые первыми"""
+        files = glob.glob(os.path.join(self.commands_dir, "command_*.json"))
+        files_with_mtime = []
+        for path in files:
+            try:
+                files_with_mtime.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue
+        return [path for _, path in sorted(files_with_mtime)]
+
+    def claim(self, command_path):
+        """Атомарно захватываем команду; None если её уже забрал другой демон"""
+        claimed_path = os.path.join(self.claimed_dir, os.path.basename(command_path))
+        try:
+            os.rename(command_path, claimed_path)
+        except FileNotFoundError:
+            if not os.path.exists(command_path):
+                return None
+            # Нет нашей папки (нас списывали) — команда на месте, создаём папку и пробуем ещё раз
+            os.makedirs(self.claimed_dir, exist_ok=True)
+            try:
+                os.rename(command_path, claimed_path)
+            except FileNotFoundError:
+                return None
+        return claimed_path
+
+    def release(self, claimed_path):
+        """Задача выполнена — снимаем аренду"""
+        try:
+            os.remove(claimed_path)
+        except FileNotFoundError:
+            pass
+
+    def _requeue(self, claimed_path, count_attempt=True):
+        command_id = command_id_from_path(claimed_path)
+        # Сначала забираем команду себе одним rename: задачу упавшего демона могут разбирать
+        # несколько соседей сразу, вернуть в очередь (или снять) её должен ровно один
+        own_path = os.path.join(self.claimed_dir, os.path.basename(claimed_path))
+        if os.path.abspath(claimed_path) != os.path.abspath(own_path):
+            try:
+                os.makedirs(self.claimed_dir, exist_ok=True)
+                os.rename(claimed_path, own_path)
+            except FileNotFoundError:
+                return
+            claimed_path = own_path
+        try:
+            with open(claimed_path, 'r') as f:
+                command = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"❌ Повреждённая команда {claimed_path}: {e}")
+            command = None
+
+        attempts = (command or {}).get('attempts', 0) + (1 if count_attempt else 0)
+        if command is None or attempts >= MAX_ATTEMPTS:
+            logger.error(f"💀 Команда {command_id} снята после {attempts} попыток")
+            write_json_atomic(os.path.join(self.commands_dir, f"result_{command_id}.json"), {
+                'status': 'error',
+                'error': f"Задача не выполнена после {attempts} попыток (воркер падал)",
+                'command_id': command_id,
+            })
+        else:
+            command['attempts'] = attempts
+            write_json_atomic(os.path.join(self.commands_dir, f"command_{command_id}.json"), command)
+            logger.warning(f"♻️ Команда {command_id} возвращена в очередь (попытка {attempts + 1})")
+        try:
+            os.remove(claimed_path)
+        except FileNotFoundError:
+            pass
+
+    def reap_expired(self, force=False):
+        """Возвращаем в очередь задачи демонов, у которых истекла аренда"""
+        now = time.time()
+        if not force and now - self._last_reap < self.lease_ttl / 4:
+            return
+        self._last_reap = now
+        for worker_dir in glob.glob(os.path.join(self.claimed_root, "*")):
+            worker_id = os.path.basename(worker_dir)
+            if worker_id == self.worker_id or not os.path.isdir(worker_dir):
+                continue
+            heartbeat_path = os.path.join(self.workers_dir, f"{worker_id}.heartbeat")
+            try:
+                age = now - os.path.getmtime(heartbeat_path)
+            except FileNotFoundError:
+                try:
+                    age = now - os.path.getmtime(worker_dir)
+                except FileNotFoundError:
+                    continue
+            if age <= self.lease_ttl:
+                continue
+            logger.warning(f"⚠️ Аренда воркера {worker_id} истекла ({age:.0f}с без heartbeat)")
+            for claimed_path in glob.glob(os.path.join(worker_dir, "command_*.json")):
+                self._requeue(claimed_path)
+            for path in (heartbeat_path, worker_dir):
+                try:
+                    os.rmdir(path) if os.path.isdir(path) else os.remove(path)
+                except OSError:
+                    pass
+
+
+def check(workers=4, commands=200):
+    """Проверка на CPU с «виртуальными» устройствами: захват ровно одним, возврат задач упавшего,
+    снятие после MAX_ATTEMPTS и работа демона, которого соседи успели списать"""
+    import shutil
+    import tempfile
+
+    root = tempfile.mkdtemp(prefix="ltx_leases_")
+    failures = []
+
+    def add_commands(ids, **fields):
+        for command_id in ids:
+            write_json_atomic(os.path.join(root, f"command_{command_id}.json"), {'prompt': command_id, **fields})
+
+    def expire(lease):
+        os.utime(lease.heartbeat_path, (0, 0))
+
+    try:
+        # Несколько демонов разбирают одну очередь: каждая команда захвачена ровно одним
+        leases = [WorkerLease(f"check-gpu{device}", device=device, commands_dir=root) for device in range(workers)]
+        for lease in leases:
+            lease.start()
+        add_commands(f"job{i}" for i in range(commands))
+        claimed = {lease.worker_id: [] for lease in leases}
+
+        def drain(lease):
+            while True:
+                pending = lease.pending()
+                if not pending:
+                    return
+                for command_path in pending:
+                    claimed_path = lease.claim(command_path)
+                    if claimed_path is not None:
+                        claimed[lease.worker_id].append(command_id_from_path(claimed_path))
+
+        threads = [threading.Thread(target=drain, args=(lease,)) for lease in leases]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        all_claimed = [command_id for ids in claimed.values() for command_id in ids]
+        if sorted(all_claimed) != sorted(f"job{i}" for i in range(commands)):
+            failures.append(f"захват: {len(all_claimed)} захватов на {commands} команд")
+        for lease in leases:
+            for claimed_path in glob.glob(os.path.join(lease.claimed_dir, "command_*.json")):
+                lease.release(claimed_path)
+
+        # Демон упал с задачами: два соседа одновременно возвращают их в очередь, каждую — один раз
+        dead = WorkerLease("check-dead", commands_dir=root)
+        dead.start()
+        dead._stop.set()
+        add_commands(f"crash{i}" for i in range(10))
+        for command_path in dead.pending():
+            dead.claim(command_path)
+        expire(dead)
+        reapers = [threading.Thread(target=lease.reap_expired, kwargs={'force': True}) for lease in leases[:2]]
+        for thread in reapers:
+            thread.start()
+        for thread in reapers:
+            thread.join()
+        requeued = []
+        for path in glob.glob(os.path.join(root, "command_crash*.json")):
+            with open(path) as f:
+                requeued.append(json.load(f))
+        if len(requeued) != 10 or any(command.get('attempts') != 1 for command in requeued):
+            failures.append(f"возврат: в очереди {len(requeued)} из 10, попытки {[c.get('attempts') for c in requeued]}")
+        if glob.glob(os.path.join(root, "claimed", "*", "command_crash*.json")):
+            failures.append("возврат: команды остались захваченными")
+
+        # После MAX_ATTEMPTS падений команда снимается с ошибкой в result_<id>.json
+        for path in glob.glob(os.path.join(root, "command_crash*.json")):
+            os.remove(path)
+        add_commands(["doomed"], attempts=MAX_ATTEMPTS - 1)
+        dead = WorkerLease("check-dead2", commands_dir=root)
+        dead.start()
+        dead._stop.set()
+        dead.claim(os.path.join(root, "command_doomed.json"))
+        expire(dead)
+        leases[0].reap_expired(force=True)
+        result_path = os.path.join(root, "result_doomed.json")
+        if not os.path.exists(result_path) or os.path.exists(os.path.join(root, "command_doomed.json")):
+            failures.append("снятие: нет result с ошибкой после MAX_ATTEMPTS")
+
+        # Живого, но «зависшего» демона списали соседи: после renew() он снова захватывает задачи
+        stalled = leases[-1]
+        expire(stalled)
+        leases[0].reap_expired(force=True)
+        stalled.renew()
+        add_commands(["after_reap"])
+        if stalled.claim(os.path.join(root, "command_after_reap.json")) is None:
+            failures.append("списанный демон: не может захватить задачу после renew()")
+        if stalled.claim(os.path.join(root, "command_missing.json")) is not None:
+            failures.append("захват: несуществующая команда считается захваченной")
+
+        for lease in leases:
+            lease.stop()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    for failure in failures:
+        logger.error(f"❌ {failure}")
+    if not failures:
+        logger.info(f"✅ Аренда задач: {workers} демона, {commands} команд — захват, возврат, снятие и повторная регистрация в порядке")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Аренда задач в общей файловой очереди")
+    parser.add_argument("--check", action="store_true", help="Проверка на CPU с виртуальными устройствами")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--commands", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if not args.check:
+        parser.error("доступна только проверка: --check")
+    sys.exit(check(args.workers, args.commands))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Планировщик очереди задач демона
+- классы приоритета (high / normal / low), внутри класса — ближайший дедлайн первым (EDF)
+- задачи одного padded размера (bucket) идут подряд: меньше переключений формы тензоров,
+  но не больше MAX_BUCKET_RUN подряд, если ждут задачи других размеров
+- задача, прождавшая дольше MAX_WAIT_SECONDS, идёт первой независимо от всего остального
+- для каждой задачи считаются позиция в очереди и ожидаемое время старта
+"""
+
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_CLASSES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+# Ограничение голодания: после стольких секунд ожидания задача обгоняет приоритеты и bucket'ы
+MAX_WAIT_SECONDS = float(os.environ.get("LTX_SCHEDULER_MAX_WAIT", "300"))
+# Сколько раз подряд можно выбирать тот же bucket, пока в очереди есть другие
+MAX_BUCKET_RUN = int(os.environ.get("LTX_SCHEDULER_MAX_BUCKET_RUN", "4"))
+# Оценка длительности задачи, пока нет ни одного замера
+DEFAULT_JOB_SECONDS = float(os.environ.get("LTX_SCHEDULER_DEFAULT_JOB_SECONDS", "120"))
+# Сглаживание замеров длительности (EMA)
+DURATION_SMOOTHING = 0.3
+
+
+def parse_priority(value):
+    """'high' / 'normal' / 'low' или число (меньше — важнее) -> номер класса"""
+    if value is None or value == "":
+        return PRIORITY_CLASSES[DEFAULT_PRIORITY]
+    if isinstance(value, str) and value.lower() in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[value.lower()]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Неизвестный приоритет: {value}")
+
+
+def parse_deadline(command, enqueued_at):
+    """Абсолютный дедлайн (unix time) из команды: 'deadline' или 'deadline_seconds' от постановки"""
+    if command.get("deadline"):
+        return float(command["deadline"])
+    if command.get("deadline_seconds"):
+        return enqueued_at + float(command["deadline_seconds"])
+    return None
+
+
+class ScheduledJob:
+    """Запись очереди планировщика"""
+
+    __slots__ = ("job_id", "bucket", "priority", "deadline", "enqueued_at")
+
+    def __init__(self, job_id, bucket, priority, deadline, enqueued_at):
+        self.job_id = job_id
+        self.bucket = bucket
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = enqueued_at
+
+
+class JobScheduler:
+    """Очередь задач с приоритетами, EDF и группировкой по bucket'ам"""
+
+    def __init__(self, max_wait=MAX_WAIT_SECONDS, max_bucket_run=MAX_BUCKET_RUN,
+                 default_job_seconds=DEFAULT_JOB_SECONDS):
+        self.max_wait = max_wait
+        self.max_bucket_run = max_bucket_run
+        self.default_job_seconds = default_job_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Последний выбранный bucket и сколько раз подряд он выбирался
+        self._last_bucket = None
+        self._bucket_run = 0
+        # bucket -> сглаженная длительность одной задачи, секунды
+        self._durations = {}
+        # Текущий запуск: (bucket, число задач, время старта) — для оценки ожидания
+        self._running = None
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def add(self, job_id, bucket=None, priority=None, deadline=None, enqueued_at=None):
+        entry = ScheduledJob(
+            job_id,
+            bucket,
+            parse_priority(priority),
+            deadline,
+            enqueued_at if enqueued_at is not None else time.time(),
+        )
+        with self._lock:
+            self._jobs[job_id] = entry
+        return entry
+
+    def discard(self, job_id):
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _sort_key(self, entry, last_bucket, bucket_run, now):
+        # Голодающие задачи — первыми, в порядке постановки
+        if now - entry.enqueued_at >= self.max_wait:
+            return (0, entry.enqueued_at)
+        if last_bucket is not None and bucket_run >= self.max_bucket_run:
+            # Лимит подряд исчерпан: теперь предпочитаем другие bucket'ы
+            affinity = 1 if entry.bucket == last_bucket else 0
+        else:
+            affinity = 0 if entry.bucket is not None and entry.bucket == last_bucket else 1
+        deadline = entry.deadline if entry.deadline is not None else float("inf")
+        return (1, entry.priority, deadline, affinity, entry.enqueued_at)
+
+    def _order(self, now):
+        """Порядок выдачи: симулируем выбор по одному, учитывая серию одного bucket'а"""
+        remaining = list(self._jobs.values())
+        last_bucket, bucket_run = self._last_bucket, self._bucket_run
+        ordered = []
+        while remaining:
+            entry = min(remaining, key=lambda e: self._sort_key(e, last_bucket, bucket_run, now))
+            remaining.remove(entry)
+            ordered.append(entry)
+            if entry.bucket is not None and entry.bucket == last_bucket:
+                bucket_run += 1
+            else:
+                last_bucket, bucket_run = entry.bucket, 1
+        return ordered
+
+    def _mark_dispatched(self, bucket):
+        if bucket is not None and bucket == self._last_bucket:
+            self._bucket_run += 1
+        else:
+            self._last_bucket, self._bucket_run = bucket, 1
+
+    def pop_next(self):
+        """Следующая задача; None если очередь пуста"""
+        with self._lock:
+            if not self._jobs:
+                return None
+            now = time.time()
+            entry = min(self._jobs.values(), key=lambda e: self._sort_key(e, self._last_bucket, self._bucket_run, now))
+            del self._jobs[entry.job_id]
+            self._mark_dispatched(entry.bucket)
+            return entry
+
+    def pop_compatible(self, bucket, limit):
+        """До limit задач того же bucket'а в порядке очереди (добор в батч)"""
+        if bucket is None or limit <= 0:
+            return []
+        with self._lock:
+            now = time.time()
+            ordered = [e for e in self._order(now) if e.bucket == bucket][:limit]
+            for entry in ordered:
+                del self._jobs[entry.job_id]
+            return ordered
+
+    def estimate_seconds(self, bucket):
+        """Ожидаемая длительность одной задачи bucket'а"""
+        if bucket in self._durations:
+            return self._durations[bucket]
+        # Нет замеров для этого размера: масштабируем по объёму (h * w * f) от известных
+        if bucket is not None and self._durations:
+            known = [(b, s) for b, s in self._durations.items() if b is not None]
+            if known:
+                per_voxel = sum(s / (b[0] * b[1] * b[2]) for b, s in known) / len(known)
+                return per_voxel * bucket[0] * bucket[1] * bucket[2]
+        return self.default_job_seconds
+
+    def start_run(self, bucket, jobs):
+        with self._lock:
+            self._running = (bucket, jobs, time.time())
+
+    def finish_run(self, bucket, jobs, seconds=None):
+        """Замер запуска (батч из jobs задач за seconds) -> обновляем оценку bucket'а; None — без замера"""
+        with self._lock:
+            self._running = None
+            if seconds is None:
+                return
+            per_job = seconds / max(jobs, 1)
+            previous = self._durations.get(bucket)
+            self._durations[bucket] = per_job if previous is None else (
+                previous + DURATION_SMOOTHING * (per_job - previous)
+            )
+
+    def positions(self):
+        """job_id -> (позиция с 1, ожидаемое время старта unix time)"""
+        with self._lock:
+            now = time.time()
+            start_at = now
+            if self._running is not None:
+                bucket, jobs, started_at = self._running
+                start_at = max(now, started_at + self.estimate_seconds(bucket) * jobs)
+            result = {}
+            for position, entry in enumerate(self._order(now), start=1):
+                result[entry.job_id] = (position, start_at)
+                start_at += self.estimate_seconds(entry.bucket)
+            return result
+
+    def snapshot(self):
+        """Очередь для статуса демона"""
+        positions = self.positions()
+        with self._lock:
+            entries = [self._jobs[job_id] for job_id in positions if job_id in self._jobs]
+        names = {value: name for name, value in PRIORITY_CLASSES.items()}
+        return [
+            {
+                "command_id": entry.job_id,
+                "position": positions[entry.job_id][0],
+                "expected_start": positions[entry.job_id][1],
+                "bucket": list(entry.bucket) if entry.bucket is not None else None,
+                "priority": names.get(entry.priority, entry.priority),
+                "deadline": entry.deadline,
+                "waiting_seconds": time.time() - entry.enqueued_at,
+            }
+            for entry in sorted(entries, key=lambda e: positions[e.job_id][0])
+        ]
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+Модель пиковой памяти GPU и контроль допуска задач
+Слишком большой width x height x num_frames раньше падал с CUDA OOM глубоко в pipeline, через
+минуты работы. Теперь пик памяти сверх весов (max_memory_allocated - allocated до запуска)
+замеряется на каждом вызове pipeline (и на прогреве) и аппроксимируется по типу pipeline линейно
+от числа вокселей padded размера x батч: пик = a + b * h * w * f * batch. Замеры живут на томе
+и переживают рестарты. До первого замера — консервативный априорный коэффициент.
+По прогнозу задача до старта GPU работы допускается, ждёт освобождения памяти, уменьшается
+(с сохранением пропорций) или отклоняется. Сброс кеша аллокатора (empty_cache / synchronize /
+ipc_collect) — политика LTX_CACHE_FLUSH_POLICY, а не безусловный вызов на каждом запросе.
+"""
+
+import os
+import gc
+import json
+import time
+import math
+import logging
+import threading
+
+from shapes import padded_shape, bucket_name
+
+logger = logging.getLogger(__name__)
+
+ADMISSION = os.environ.get("LTX_ADMISSION", "1") == "1"
+MODEL_PATH = os.environ.get("LTX_MEMORY_MODEL_PATH", "/runpod-volume/cache/memory_model.json")
+# Запас к прогнозу и память, которую не отдаём задачам (контекст CUDA, фрагментация)
+MEMORY_MARGIN = float(os.environ.get("LTX_MEMORY_MARGIN", "1.15"))
+HEADROOM_BYTES = int(float(os.environ.get("LTX_MEMORY_HEADROOM_GB", "1.0")) * 1024 ** 3)
+# Априорный пик на воксель (байт), пока нет замеров
+PRIOR_BYTES_PER_VOXEL = float(os.environ.get("LTX_MEMORY_BYTES_PER_VOXEL", "400"))
+# Свои априорные коэффициенты у отдельных этапов (декодирование VAE — по вокселям выходного видео)
+PRIORS = {"vae_decode": float(os.environ.get("LTX_VAE_BYTES_PER_VOXEL", "200"))}
+# Что делать с задачей, которая не помещается никогда: reject или downscale (запрос может переопределить)
+OVERSIZE_POLICY = os.environ.get("LTX_ADMISSION_OVERSIZE", "reject")
+# Сколько ждать, пока освободится память, занятая не нами
+ADMISSION_WAIT_SECONDS = float(os.environ.get("LTX_ADMISSION_WAIT_SECONDS", "30"))
+# Меньше этой стороны не уменьшаем — такой результат клиенту не нужен
+MIN_SIDE = int(os.environ.get("LTX_ADMISSION_MIN_SIDE", "256"))
+# always — как раньше, на каждом запросе; auto — только когда прогноз близок к свободной памяти; never
+FLUSH_POLICY = os.environ.get("LTX_CACHE_FLUSH_POLICY", "auto")
+FLUSH_THRESHOLD = float(os.environ.get("LTX_CACHE_FLUSH_THRESHOLD", "0.9"))
+MAX_SAMPLES = 64
+
+ACTIONS = ("accept", "queue", "downscale", "reject")
+FLUSH_POLICIES = ("always", "auto", "never")
+
+
+def pipeline_type(pipeline):
+    return "multi_scale" if hasattr(pipeline, "video_pipeline") else "single_scale"
+
+
+def voxels(shape, batch=1):
+    height, width, num_frames = shape
+    return height * width * num_frames * batch
+
+
+class PeakMemoryModel:
+    """Замеры (воксели, пик сверх весов) по типу pipeline и линейная аппроксимация по ним"""
+
+    def __init__(self, path=MODEL_PATH, margin=MEMORY_MARGIN, prior_bytes_per_voxel=PRIOR_BYTES_PER_VOXEL):
+        self.path = path
+        self.margin = margin
+        self.prior_bytes_per_voxel = prior_bytes_per_voxel
+        self.samples = {}
+        self._fits = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.samples = {kind: [tuple(s) for s in samples] for kind, samples in data.get("samples", {}).items()}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ Модель памяти не прочитана ({self.path}): {e}")
+            return
+        self._fits = {}
+        logger.info(f"🧮 Модель памяти: {sum(len(s) for s in self.samples.values())} замеров из {self.path}")
+
+    def save(self):
+        with self._lock:
+            data = {"samples": {kind: [list(s) for s in samples] for kind, samples in self.samples.items()}}
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Модель памяти не сохранена: {e}")
+
+    def record(self, kind, shape, batch, peak_bytes, save=True):
+        """Замер пика сверх весов для padded размера shape и батча"""
+        with self._lock:
+            samples = self.samples.setdefault(kind, [])
+            samples.append((voxels(shape, batch), int(peak_bytes)))
+            del samples[:-MAX_SAMPLES]
+            self._fits.pop(kind, None)
+        predicted = self.predict(kind, shape, batch)
+        logger.info(
+            f"🧮 Пик памяти {bucket_name(shape)} x{batch} ({kind}): {peak_bytes / 1024 ** 3:.2f}GB "
+            f"сверх весов, прогноз модели теперь {predicted / 1024 ** 3:.2f}GB"
+        )
+        if save:
+            self.save()
+
+    def fit(self, kind):
+        """(a, b, источник): пик ~ a + b * воксели"""
+        with self._lock:
+            if kind in self._fits:
+                return self._fits[kind]
+            samples = list(self.samples.get(kind, ()))
+        if not samples:
+            fit = (0.0, PRIORS.get(kind, self.prior_bytes_per_voxel), "prior")
+        else:
+            xs = [x for x, _ in samples]
+            ys = [y for _, y in samples]
+            fit = None
+            if len(set(xs)) >= 2:
+                mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+                var = sum((x - mean_x) ** 2 for x in xs)
+                b = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var
+                a = mean_y - b * mean_x
+                if b > 0:
+                    # Прямая не должна занижать ни один замер: поднимаем её до худшего
+                    a += max(0.0, max(y - (a + b * x) for x, y in samples))
+                    fit = (a, b, "fit")
+            if fit is None:
+                # Один размер (или шум): пропорционально худшему замеру
+                fit = (0.0, max(y / x for x, y in samples if x), "ratio")
+        with self._lock:
+            self._fits[kind] = fit
+        return fit
+
+    def predict(self, kind, shape, batch=1):
+        """Прогноз пика сверх весов в байтах (с запасом)"""
+        a, b, _ = self.fit(kind)
+        return int((a + b * voxels(shape, batch)) * self.margin)
+
+    def max_voxels(self, kind, budget_bytes):
+        """Сколько вокселей (h * w * f * batch) помещается в бюджет"""
+        a, b, _ = self.fit(kind)
+        return max(0.0, (budget_bytes / self.margin - a) / b) if b > 0 else float("inf")
+
+    def stats(self):
+        with self._lock:
+            kinds = list(self.samples) or ["multi_scale"]
+        result = {}
+        for kind in kinds:
+            a, b, source = self.fit(kind)
+            result[kind] = {
+                "samples": len(self.samples.get(kind, ())),
+                "source": source,
+                "base_gb": round(a / 1024 ** 3, 3),
+                "bytes_per_voxel": round(b, 2),
+            }
+        return result
+
+
+class Admission:
+    """Решение по задаче: action из ACTIONS; для downscale — новые height/width"""
+
+    __slots__ = ("action", "predicted_bytes", "available_bytes", "height", "width", "reason")
+
+    def __init__(self, action, predicted_bytes, available_bytes, height=None, width=None, reason=""):
+        self.action = action
+        self.predicted_bytes = predicted_bytes
+        self.available_bytes = available_bytes
+        self.height = height
+        self.width = width
+        self.reason = reason
+
+    def to_dict(self):
+        return {
+            "action": self.action,
+            "predicted_gb": round(self.predicted_bytes / 1024 ** 3, 2),
+            "available_gb": round(self.available_bytes / 1024 ** 3, 2),
+            "height": self.height,
+            "width": self.width,
+            "reason": self.reason,
+        }
+
+
+_reservations = {}
+
+
+def reserve(name, nbytes):
+    """Память, которую займут веса, сейчас выгруженные на хост (offload): допуск её не раздаёт"""
+    _reservations[name] = nbytes
+
+
+def memory_state(device=None):
+    """(всего под задачи, свободно прямо сейчас) в байтах сверх уже выделенного нами (веса)"""
+    import torch
+
+    allocated = torch.cuda.memory_allocated(device) + sum(_reservations.values())
+    reserved = torch.cuda.memory_reserved(device)
+    free, total = torch.cuda.mem_get_info(device)
+    capacity = total - HEADROOM_BYTES - allocated
+    # Резерв аллокатора, не занятый тензорами, тоже наш
+    available_now = free + (reserved - allocated) - HEADROOM_BYTES
+    return capacity, min(available_now, capacity)
+
+
+def gpu_memory(device=None):
+    """Память GPU для статуса и метрик (байты): allocated, reserved, free, total"""
+    import torch
+
+    if not torch.cuda.is_available():
+        return {}
+    free, total = torch.cuda.mem_get_info(device)
+    return {
+        "allocated": torch.cuda.memory_allocated(device),
+        "reserved": torch.cuda.memory_reserved(device),
+        "free": free,
+        "total": total,
+    }
+
+
+class AdmissionController:
+    """Допуск задач по прогнозу пика памяти до старта GPU работы"""
+
+    def __init__(self, model, device=None):
+        self.model = model
+        self.device = device
+        self.counts = {action: 0 for action in ACTIONS}
+        self._lock = threading.Lock()
+
+    def _count(self, action):
+        with self._lock:
+            self.counts[action] += 1
+
+    def decide(self, kind, height, width, num_frames, batch=1, oversize=None):
+        """Admission для задачи (или батча одинаковых padded размеров); без CUDA — всегда accept"""
+        import torch
+
+        shape = padded_shape(height, width, num_frames)
+        predicted = self.model.predict(kind, shape, batch)
+        if not ADMISSION or not torch.cuda.is_available():
+            return Admission("accept", predicted, 0, height, width)
+        capacity, available_now = memory_state(self.device)
+        if predicted <= available_now:
+            decision = Admission("accept", predicted, available_now, height, width)
+        elif predicted <= capacity:
+            decision = Admission("queue", predicted, available_now, height, width,
+                                 reason="память занята, ждём освобождения")
+        elif (oversize or OVERSIZE_POLICY) == "downscale" and batch == 1:
+            decision = self._downscale(kind, height, width, num_frames, capacity, predicted)
+        else:
+            decision = Admission("reject", predicted, capacity, reason=(
+                f"{width}x{height}x{num_frames}: прогноз пика {predicted / 1024 ** 3:.1f}GB, "
+                f"доступно {capacity / 1024 ** 3:.1f}GB"
+            ))
+        self._count(decision.action)
+        if decision.action != "accept":
+            logger.warning(f"🧮 Admission {decision.action}: {decision.to_dict()}")
+        return decision
+
+    def _downscale(self, kind, height, width, num_frames, capacity, predicted):
+        """Наибольший размер с теми же пропорциями и числом кадров, который помещается"""
+        _, _, frames_padded = padded_shape(height, width, num_frames)
+        scale = math.sqrt(self.model.max_voxels(kind, capacity) / (height * width * frames_padded))
+        while scale > 0:
+            new_height = int(height * scale) // 32 * 32
+            new_width = int(width * scale) // 32 * 32
+            if min(new_height, new_width) < MIN_SIDE:
+                break
+            new_predicted = self.model.predict(kind, padded_shape(new_height, new_width, num_frames))
+            if new_predicted <= capacity:
+                return Admission("downscale", new_predicted, capacity, new_height, new_width, reason=(
+                    f"{width}x{height} не помещается ({predicted / 1024 ** 3:.1f}GB), уменьшено до {new_width}x{new_height}"
+                ))
+            scale *= 0.95
+        return Admission("reject", predicted, capacity, reason=(
+            f"{width}x{height}x{num_frames}: не помещается даже при уменьшении до {MIN_SIDE}px "
+            f"(прогноз {predicted / 1024 ** 3:.1f}GB, доступно {capacity / 1024 ** 3:.1f}GB)"
+        ))
+
+    def wait_for_memory(self, predicted_bytes, timeout=ADMISSION_WAIT_SECONDS):
+        """queue: сбрасываем свой кеш и ждём, пока память освободят другие; False — не дождались"""
+        flush("admission", force=True)
+        deadline = time.time() + timeout
+        while True:
+            _, available_now = memory_state(self.device)
+            if predicted_bytes <= available_now:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+
+    def admit(self, kind, height, width, num_frames, batch=1, oversize=None):
+        """decide + ожидание памяти для queue: итог — accept, downscale или reject"""
+        decision = self.decide(kind, height, width, num_frames, batch=batch, oversize=oversize)
+        if decision.action != "queue":
+            return decision
+        if self.wait_for_memory(decision.predicted_bytes):
+            decision.action = "accept"
+            return decision
+        decision.action = "reject"
+        decision.reason = (
+            f"за {ADMISSION_WAIT_SECONDS:.0f}с не освободилось {decision.predicted_bytes / 1024 ** 3:.1f}GB "
+            f"(свободно {decision.available_bytes / 1024 ** 3:.1f}GB)"
+        )
+        self._count("reject")
+        return decision
+
+    def max_batch(self, kind, shape, limit):
+        """Сколько задач padded размера shape поместится в один вызов pipeline (не меньше 1)"""
+        import torch
+
+        if not ADMISSION or limit <= 1 or not torch.cuda.is_available():
+            return limit
+        capacity, _ = memory_state(self.device)
+        return max(1, min(limit, int(self.model.max_voxels(kind, capacity) // voxels(shape))))
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+_active_meters = []
+
+
+class PeakMeter:
+    """Замер пика памяти вызова pipeline: with PeakMeter(...) as meter: ...; meter.peak_bytes
+
+    Вложенные замеры (декодирование VAE внутри pipeline) сбрасывают счётчик пика CUDA —
+    пик, набранный до сброса, переносится во внешние замеры. model=None — только замер.
+    """
+
+    def __init__(self, model, kind, shape, batch=1, device=None):
+        self.model = model
+        self.kind = kind
+        self.shape = shape
+        self.batch = batch
+        self.device = device
+        self.peak_bytes = None
+        self.peak_allocated = None
+        self._baseline = None
+        self._carried = 0
+
+    def __enter__(self):
+        import torch
+
+        if torch.cuda.is_available():
+            current_peak = torch.cuda.max_memory_allocated(self.device)
+            for meter in _active_meters:
+                meter._carried = max(meter._carried, current_peak)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._baseline = torch.cuda.memory_allocated(self.device)
+            _active_meters.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        import torch
+
+        if self._baseline is None:
+            return False
+        _active_meters.remove(self)
+        self.peak_allocated = max(torch.cuda.max_memory_allocated(self.device), self._carried)
+        self.peak_bytes = self.peak_allocated - self._baseline
+        if self.model is None:
+            # Только замер (профиль этапов), модель не пополняем
+            return False
+        if exc_type is None:
+            self.model.record(self.kind, self.shape, self.batch, self.peak_bytes)
+        elif issubclass(exc_type, torch.cuda.OutOfMemoryError):
+            logger.error(
+                f"💥 OOM на {bucket_name(self.shape)} x{self.batch}: прогноз был "
+                f"{self.model.predict(self.kind, self.shape, self.batch) / 1024 ** 3:.1f}GB"
+            )
+        return False
+
+
+flush_counts = {"flushed": 0, "skipped": 0}
+_flush_lock = threading.Lock()
+
+
+def flush(point, needed_bytes=None, policy=None, force=False):
+    """Сброс кеша аллокатора в точке point ("before", "between", "after", "idle") по политике
+
+    always — synchronize + empty_cache (после генерации ещё gc и ipc_collect), как раньше на каждом запросе;
+    auto — только если прогноз needed_bytes близок к свободной памяти (фрагментация);
+    never — не сбрасываем. force — сбросить при любой политике (ожидание памяти, OOM).
+    """
+    import torch
+
+    if not torch.cuda.is_available():
+        return False
+    policy = policy or FLUSH_POLICY
+    needed = force or policy == "always"
+    if not needed and policy == "auto" and needed_bytes is not None:
+        _, available_now = memory_state()
+        needed = needed_bytes > FLUSH_THRESHOLD * available_now
+    with _flush_lock:
+        flush_counts["flushed" if needed else "skipped"] += 1
+    if not needed:
+        return False
+    if point == "after":
+        gc.collect()
+    torch.cuda.synchronize()
+    torch.cuda.empty_cache()
+    if point == "after":
+        torch.cuda.ipc_collect()
+    logger.info(
+        f"🧹 Кеш GPU сброшен ({point}, политика {policy}): {torch.cuda.memory_allocated() / 1024 ** 3:.1f}GB allocated, "
+        f"{torch.cuda.memory_reserved() / 1024 ** 3:.1f}GB reserved"
+    )
+    return True
+
+
+if FLUSH_POLICY not in FLUSH_POLICIES:
+    logger.warning(f"⚠️ LTX_CACHE_FLUSH_POLICY={FLUSH_POLICY!r} не из {FLUSH_POLICIES}, используем auto")
+    FLUSH_POLICY = "auto"
+
+model = PeakMemoryModel()
+admission = AdmissionController(model)
+
+
+def stats():
+    return {
+        "model": model.stats(),
+        "admission": admission.stats(),
+        "flush_policy": FLUSH_POLICY,
+        "flushes": dict(flush_counts),
+    }
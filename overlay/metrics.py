@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Метрики Prometheus для API сервера, inference демонов и serverless воркера
+- демон: свой /metrics на LTX_METRICS_PORT + номер GPU (HTTP сервер prometheus_client в фоновом потоке);
+- API (server.py): /metrics с состоянием всех демонов пода (status по RPC сокетам) и очередью Celery;
+- rp_handler (serverless): /metrics на LTX_METRICS_PORT со счётчиками процесса — там идёт загрузка
+  результатов в хранилище (ltx_uploaded_bytes).
+Очередь, задачи в работе, память GPU и кеши читаются из статуса демона в момент скрейпа, в потоке
+HTTP сервера; поток генерации только добавляет наблюдения в гистограммы (observe — счётчик под локом).
+prometheus_client — необязательная зависимость: без неё метрики выключены, остальное работает.
+"""
+
+import os
+import logging
+import threading
+
+try:
+    import prometheus_client
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+METRICS = os.environ.get("LTX_METRICS", "1") == "1"
+# Демон слушает METRICS_PORT + номер GPU (на поде по демону на GPU)
+METRICS_PORT = int(os.environ.get("LTX_METRICS_PORT", "9400"))
+# Секунды: от прогрева маленьких размеров до длинных клипов в высоком разрешении
+LATENCY_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300, 600, float("inf"))
+STATUS_TIMEOUT = float(os.environ.get("LTX_METRICS_STATUS_TIMEOUT", "2"))
+
+_lock = threading.Lock()
+_job_latency = None
+_jobs = None
+_uploaded_bytes = None
+
+
+def available():
+    return METRICS and prometheus_client is not None
+
+
+def _instruments():
+    """Гистограммы и счётчики процесса (в реестре по умолчанию), создаются при первом использовании"""
+    global _job_latency, _jobs, _uploaded_bytes
+    with _lock:
+        if _job_latency is None:
+            _job_latency = prometheus_client.Histogram(
+                "ltx_job_latency_seconds", "Время задачи по этапам (stage=total — вся генерация)",
+                ["bucket", "stage"], buckets=LATENCY_BUCKETS,
+            )
+            _jobs = prometheus_client.Counter("ltx_jobs", "Завершённые задачи", ["status"])
+            _uploaded_bytes = prometheus_client.Counter("ltx_uploaded_bytes", "Байт результатов загружено в хранилище")
+    return _job_latency, _jobs, _uploaded_bytes
+
+
+def observe_job(bucket, status, seconds=None, profile=None):
+    """Задача завершена: статус, общее время и этапы из stage_profile"""
+    if not available():
+        return
+    job_latency, jobs, _ = _instruments()
+    jobs.labels(status=status).inc()
+    if seconds is not None:
+        job_latency.labels(bucket=bucket, stage="total").observe(seconds)
+    for stage, entry in ((profile or {}).get("stages") or {}).items():
+        job_latency.labels(bucket=bucket, stage=stage).observe(entry["seconds"])
+
+
+def record_upload(nbytes):
+    if not available():
+        return
+    _instruments()[2].inc(nbytes)
+
+
+def status_metrics(statuses):
+    """Метрики из статусов демонов: [(device, status dict)] -> семейства метрик"""
+    ready = GaugeMetricFamily("ltx_daemon_ready", "Демон загрузил модели", labels=["device"])
+    queue_depth = GaugeMetricFamily("ltx_queue_depth", "Задач в очереди демона", labels=["device", "source"])
+    oldest = GaugeMetricFamily("ltx_queue_oldest_age_seconds", "Сколько ждёт самая старая задача в очереди", labels=["device"])
+    in_flight = GaugeMetricFamily("ltx_jobs_in_flight", "Задач в текущем вызове pipeline", labels=["device"])
+    memory = GaugeMetricFamily("ltx_gpu_memory_bytes", "Память GPU", labels=["device", "kind"])
+    cache_hits = CounterMetricFamily("ltx_cache_hits", "Попадания в кеши", labels=["device", "cache"])
+    cache_misses = CounterMetricFamily("ltx_cache_misses", "Промахи кешей", labels=["device", "cache"])
+    coalesced = CounterMetricFamily("ltx_coalesced_jobs", "Задач присоединено к одинаковым в работе", labels=["device"])
+    saved = CounterMetricFamily("ltx_coalesced_gpu_seconds", "GPU-секунд сэкономлено склейкой", labels=["device"])
+    for device, status in statuses:
+        device = str(device)
+        ready.add_metric([device], 1 if status.get("ready") else 0)
+        queue_depth.add_metric([device, "rpc"], status.get("rpc_queue_depth", 0))
+        queue_depth.add_metric([device, "file"], status.get("file_queue_depth", 0))
+        waiting = [entry.get("waiting_seconds", 0) for entry in status.get("queue") or ()]
+        oldest.add_metric([device], max(waiting, default=0))
+        in_flight.add_metric([device], status.get("current_batch_size", 0))
+        for kind, value in (status.get("gpu_memory") or {}).items():
+            memory.add_metric([device, kind], value)
+        for cache in ("result_cache", "embedding_cache", "prompt_cache"):
+            stats = status.get(cache)
+            if stats:
+                cache_hits.add_metric([device, cache], stats.get("hits", 0))
+                cache_misses.add_metric([device, cache], stats.get("misses", 0))
+        if status.get("coalescing"):
+            coalesced.add_metric([device], status["coalescing"].get("coalesced", 0))
+            saved.add_metric([device], status["coalescing"].get("gpu_seconds_saved", 0))
+    return [ready, queue_depth, oldest, in_flight, memory, cache_hits, cache_misses, coalesced, saved]
+
+
+class DaemonStatusCollector:
+    """Коллектор: статус читается при скрейпе; statuses() -> [(device, status dict)]"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def collect(self):
+        try:
+            statuses = self.statuses()
+        except Exception as e:
+            logger.warning(f"⚠️ Метрики: статус демонов недоступен: {e}")
+            statuses = []
+        return status_metrics(statuses)
+
+
+def pod_statuses():
+    """Статусы всех демонов пода по RPC (для API сервера)"""
+    import daemon_rpc
+
+    statuses = []
+    for socket_path in daemon_rpc.discover_sockets():
+        try:
+            status = daemon_rpc.request_status(socket_path, timeout=STATUS_TIMEOUT)
+        except OSError:
+            continue
+        statuses.append((status.get("device", os.path.basename(socket_path)), status))
+    return statuses
+
+
+class CeleryQueueCollector:
+    """Длина очереди брокера Celery (Redis LLEN)"""
+
+    def __init__(self, celery_app, queue="celery"):
+        self.celery_app = celery_app
+        self.queue = queue
+
+    def collect(self):
+        depth = GaugeMetricFamily("ltx_celery_queue_depth", "Задач в очереди Celery", labels=["queue"])
+        client = getattr(self.celery_app.backend, "client", None)
+        if client is not None and hasattr(client, "llen"):
+            try:
+                depth.add_metric([self.queue], client.llen(self.queue))
+            except Exception as e:
+                logger.warning(f"⚠️ Метрики: очередь Celery недоступна: {e}")
+        return [depth]
+
+
+def _start_server(port, what):
+    """HTTP /metrics реестра по умолчанию в фоновом потоке -> порт или None"""
+    _instruments()
+    try:
+        prometheus_client.start_http_server(port)
+    except OSError as e:
+        logger.warning(f"⚠️ Метрики {what} не запущены на порту {port}: {e}")
+        return None
+    logger.info(f"📈 Метрики Prometheus: http://0.0.0.0:{port}/metrics")
+    return port
+
+
+def serve_daemon(status_provider, device="0"):
+    """HTTP /metrics демона в фоновом потоке: порт METRICS_PORT + номер GPU; -> порт или None"""
+    if not available():
+        if METRICS:
+            logger.warning("⚠️ prometheus_client не установлен, метрики демона выключены")
+        return None
+    prometheus_client.REGISTRY.register(DaemonStatusCollector(lambda: [(device, status_provider())]))
+    try:
+        port = METRICS_PORT + int(device)
+    except ValueError:
+        port = METRICS_PORT
+    return _start_server(port, "демона")
+
+
+_process_port = None
+_process_lock = threading.Lock()
+
+
+def serve_process(port=METRICS_PORT):
+    """HTTP /metrics счётчиков процесса (serverless воркер: загрузки результатов); повторный вызов — тот же порт"""
+    global _process_port
+    if not available():
+        return None
+    with _process_lock:
+        if _process_port is None:
+            _process_port = _start_server(port, "процесса")
+    return _process_port
+
+
+_api_registry = None
+
+
+def api_registry(celery_app):
+    """Реестр /metrics API сервера: демоны пода и очередь Celery
+
+    Счётчики процесса (гистограммы задач, ltx_uploaded_bytes) сюда не входят: API их не пишет,
+    их отдают демоны (serve_daemon) и serverless воркер (serve_process).
+    """
+    global _api_registry
+    with _lock:
+        if _api_registry is None:
+            _api_registry = prometheus_client.CollectorRegistry()
+            _api_registry.register(DaemonStatusCollector(pod_statuses))
+            _api_registry.register(CeleryQueueCollector(celery_app))
+    return _api_registry
+
+
+def render(registry):
+    """-> (тело ответа, content type)"""
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
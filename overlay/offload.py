@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Выгрузка компонентов pipeline в pinned память хоста для GPU с малой памятью
+13B трансформер (~26GB в bf16), T5 (~9.5GB) и улучшатели промптов вместе не помещаются на
+24-40GB карты. С LTX_OFFLOAD на устройстве только то, что нужно текущей фазе:
+- phase  — T5 и улучшатели приходят на GPU только на промахе своих кешей и уходят перед denoising,
+           трансформер уходит перед декодированием VAE (VAE и latent upsampler живут на GPU);
+- blocks — то же, плюс блоки трансформера живут на хосте и приходят на GPU по одному:
+           следующий блок копируется на отдельном CUDA stream, пока считается текущий.
+Копия весов на хосте постоянная (pinned), поэтому выгрузка — это просто отпустить копию на GPU.
+Штатный offload_to_cpu LTX здесь не годится: .cpu() без pinned памяти копирует веса обратно
+при каждой задаче и ломает _execution_device pipeline.
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import memory_model
+
+logger = logging.getLogger(__name__)
+
+OFFLOAD_MODES = ("off", "phase", "blocks")
+
+
+def parse_mode(value):
+    """Режим из env/запроса; неизвестный -> off"""
+    mode = (value or "off").strip().lower()
+    if mode not in OFFLOAD_MODES:
+        logger.warning(f"⚠️ Неизвестный режим выгрузки {value!r}, используем off")
+        return "off"
+    return mode
+
+
+# Через parse_mode: от режима зависит, куда грузятся веса (неизвестный режим — как off, а не на CPU)
+OFFLOAD = parse_mode(os.environ.get("LTX_OFFLOAD"))
+# Сколько блоков трансформера копировать заранее (режим blocks)
+PREFETCH_BLOCKS = int(os.environ.get("LTX_OFFLOAD_PREFETCH", "1"))
+PIN_MEMORY = os.environ.get("LTX_OFFLOAD_PIN", "1") == "1"
+
+# Фаза -> компоненты, которые в ней должны быть на устройстве (остальные выгружаемые уходят на хост)
+PHASES = {
+    "enhance": ("caption", "llm"),
+    "text": ("text_encoder",),
+    "denoise": ("transformer",),
+    "decode": (),
+}
+# Компонент -> атрибут LTXVideoPipeline
+COMPONENTS = {
+    "text_encoder": "text_encoder",
+    "caption": "prompt_enhancer_image_caption_model",
+    "llm": "prompt_enhancer_llm_model",
+    "transformer": "transformer",
+}
+# Не нужны внутри вызова pipeline (промпт уже улучшен и закодирован) — на время вызова скрываем,
+# иначе pipeline сам тянет их на устройство, а _execution_device берётся с T5
+HIDDEN_DURING_GENERATION = ("text_encoder", "caption", "llm")
+BLOCKS_PREFIX = "transformer_blocks."
+
+
+def _pin(tensor):
+    if not PIN_MEMORY:
+        return tensor
+    try:
+        return tensor.pin_memory()
+    except RuntimeError as e:
+        # Лимит закреплённой памяти (ulimit -l, контейнер) — работаем медленнее, но работаем
+        logger.warning(f"⚠️ pinned память недоступна ({e}), веса остаются в обычной памяти")
+        return tensor
+
+
+class HostWeights:
+    """Параметры и буферы модуля с постоянной копией на хосте
+
+    load() подменяет .data копией на устройстве, unload() возвращает копию хоста
+    (веса при инференсе не меняются, копировать обратно нечего).
+    """
+
+    def __init__(self, module, exclude=None):
+        self.tensors = []
+        self.nbytes = 0
+        self.on_device = False
+        named = list(module.named_parameters()) + list(module.named_buffers())
+        for name, tensor in named:
+            if exclude and name.startswith(exclude):
+                continue
+            host = _pin(tensor.detach().to("cpu"))
+            tensor.data = host
+            self.tensors.append((tensor, host))
+            self.nbytes += host.numel() * host.element_size()
+
+    def load(self, device, stream=None):
+        """stream — CUDA stream, на котором веса будут использоваться (копия идёт на текущем)"""
+        if self.on_device:
+            return
+        for tensor, host in self.tensors:
+            data = host.to(device, non_blocking=True)
+            if stream is not None:
+                # Память копии не должна переиспользоваться, пока её читает stream вычислений
+                data.record_stream(stream)
+            tensor.data = data
+        self.on_device = True
+
+    def unload(self):
+        if not self.on_device:
+            return
+        for tensor, host in self.tensors:
+            tensor.data = host
+        self.on_device = False
+
+
+class BlockStreamer:
+    """Блоки трансформера на хосте: на устройство по одному, следующие копируются заранее на side stream"""
+
+    def __init__(self, blocks, device, prefetch=PREFETCH_BLOCKS):
+        import torch
+
+        self.device = torch.device(device)
+        self.weights = [HostWeights(block) for block in blocks]
+        self.prefetch = max(0, min(prefetch, len(self.weights) - 1))
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.events = [None] * len(self.weights)
+        self.active = False
+        self.blocks_loaded = 0
+        self.stalls = 0
+        self._handles = []
+        for index, block in enumerate(blocks):
+            self._handles.append(block.register_forward_pre_hook(self._make_pre_hook(index)))
+            self._handles.append(block.register_forward_hook(self._make_post_hook(index)))
+
+    @property
+    def nbytes(self):
+        return sum(weights.nbytes for weights in self.weights)
+
+    @property
+    def window_bytes(self):
+        """Сколько весов блоков одновременно на устройстве"""
+        return max((weights.nbytes for weights in self.weights), default=0) * (self.prefetch + 1)
+
+    def _fetch(self, index):
+        import torch
+
+        weights = self.weights[index]
+        if weights.on_device:
+            return
+        self.blocks_loaded += 1
+        if self.stream is None:
+            weights.load(self.device)
+            return
+        compute_stream = torch.cuda.current_stream(self.device)
+        with torch.cuda.stream(self.stream):
+            weights.load(self.device, stream=compute_stream)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[index] = event
+
+    def _make_pre_hook(self, index):
+        def hook(module, args):
+            if not self.active:
+                return None
+            import torch
+
+            self._fetch(index)
+            event = self.events[index]
+            if event is not None:
+                self.events[index] = None
+                if not event.query():
+                    # Копия ещё идёт — вычисления ждут её на GPU (хост не блокируется)
+                    self.stalls += 1
+                torch.cuda.current_stream(self.device).wait_event(event)
+            for ahead in range(1, self.prefetch + 1):
+                self._fetch((index + ahead) % len(self.weights))
+            return None
+        return hook
+
+    def _make_post_hook(self, index):
+        def hook(module, args, output):
+            if self.active:
+                self.weights[index].unload()
+            return None
+        return hook
+
+    def release(self):
+        for index, weights in enumerate(self.weights):
+            weights.unload()
+            self.events[index] = None
+
+    def stats(self):
+        return {
+            'blocks': len(self.weights),
+            'prefetch': self.prefetch,
+            'window_gb': round(self.window_bytes / 1024 ** 3, 2),
+            'blocks_loaded': self.blocks_loaded,
+            'stalls': self.stalls,
+        }
+
+
+class Offloader:
+    """Фазы выгрузки для одного pipeline; в режиме off все методы ничего не делают"""
+
+    def __init__(self):
+        self.mode = "off"
+        self.device = None
+        self.video_pipeline = None
+        self.weights = {}
+        self.streamer = None
+        self.phase = None
+        self.transfer_seconds = 0.0
+        self.transfers = 0
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def attach(self, pipeline, device, mode=OFFLOAD):
+        """Выгружаемые компоненты -> pinned память хоста, остальные -> устройство
+
+        pipeline — LTXVideoPipeline или LTXMultiScalePipeline, загруженный на CPU.
+        """
+        mode = parse_mode(mode)
+        video_pipeline = getattr(pipeline, "video_pipeline", pipeline)
+        self.mode = mode
+        self.device = device
+        self.video_pipeline = video_pipeline
+        if mode == "off":
+            return
+        started_at = time.time()
+        for name, attr in COMPONENTS.items():
+            module = getattr(video_pipeline, attr, None)
+            if module is None:
+                continue
+            if name == "transformer" and mode == "blocks":
+                # Всё, кроме блоков (patchify, adaln, proj_out), — как обычный компонент фазы denoise
+                self.streamer = BlockStreamer(module.transformer_blocks, device)
+                self.weights[name] = HostWeights(module, exclude=BLOCKS_PREFIX)
+            else:
+                self.weights[name] = HostWeights(module)
+        # Небольшие компоненты живут на устройстве постоянно
+        video_pipeline.vae = video_pipeline.vae.to(device)
+        if hasattr(pipeline, "video_pipeline"):
+            pipeline.vae = video_pipeline.vae
+            if getattr(pipeline, "latent_upsampler", None) is not None:
+                pipeline.latent_upsampler = pipeline.latent_upsampler.to(device)
+        self._update_reservation()
+        host_gb = sum(w.nbytes for w in self.weights.values()) / 1024 ** 3
+        if self.streamer is not None:
+            host_gb += self.streamer.nbytes / 1024 ** 3
+        logger.info(
+            f"🔀 Выгрузка {mode}: {host_gb:.1f}GB весов в {'pinned' if PIN_MEMORY else 'обычной'} памяти хоста "
+            f"({', '.join(self.weights)}) за {time.time() - started_at:.1f}с"
+        )
+
+    def _update_reservation(self):
+        # Веса denoising, которые сейчас на хосте, придут на устройство в начале задачи:
+        # допуск по памяти должен их учитывать
+        weights = self.weights.get("transformer")
+        pending = weights.nbytes if weights is not None and not weights.on_device else 0
+        memory_model.reserve("offload", pending)
+
+    def use(self, phase):
+        """На устройство — компоненты фазы, остальные выгружаемые — на хост"""
+        if not self.enabled:
+            return
+        import torch
+
+        needed = PHASES[phase]
+        with self._lock:
+            if self.phase == phase:
+                return
+            started_at = time.perf_counter()
+            moved = False
+            for name, weights in self.weights.items():
+                if name not in needed and weights.on_device:
+                    weights.unload()
+                    moved = True
+            if phase != "denoise" and self.streamer is not None:
+                self.streamer.release()
+            for name in needed:
+                weights = self.weights.get(name)
+                if weights is not None and not weights.on_device:
+                    weights.load(self.device)
+                    moved = True
+            if moved and torch.cuda.is_available():
+                torch.cuda.current_stream().synchronize()
+                self.transfers += 1
+                self.transfer_seconds += time.perf_counter() - started_at
+            self.phase = phase
+            self._update_reservation()
+
+    @contextmanager
+    def generation(self):
+        """На время вызова pipeline: denoising с трансформером, декодирование VAE — без него"""
+        if not self.enabled:
+            yield self
+            return
+        import ltx_video.pipelines.pipeline_ltx_video as pipeline_module
+
+        video_pipeline = self.video_pipeline
+        transformer = video_pipeline.transformer
+        hidden = {attr: getattr(video_pipeline, attr, None) for attr in
+                  (COMPONENTS[name] for name in HIDDEN_DURING_GENERATION)}
+        original_decode = pipeline_module.vae_decode
+
+        def decode(*args, **kwargs):
+            self.use("decode")
+            return original_decode(*args, **kwargs)
+
+        self.use("denoise")
+        for attr in hidden:
+            setattr(video_pipeline, attr, None)
+        if self.streamer is not None:
+            # pipeline зовёт transformer.to(device) — в режиме blocks это притянуло бы все блоки
+            transformer.to = lambda *args, **kwargs: transformer
+            self.streamer.active = True
+        pipeline_module.vae_decode = decode
+        try:
+            yield self
+        finally:
+            pipeline_module.vae_decode = original_decode
+            if self.streamer is not None:
+                self.streamer.active = False
+                self.streamer.release()
+                del transformer.to
+            for attr, module in hidden.items():
+                setattr(video_pipeline, attr, module)
+
+    def stats(self):
+        if not self.enabled:
+            return {'mode': self.mode}
+        result = {
+            'mode': self.mode,
+            'phase': self.phase,
+            'on_device': [name for name, weights in self.weights.items() if weights.on_device],
+            'host_gb': round(sum(w.nbytes for w in self.weights.values()) / 1024 ** 3, 1),
+            'transfers': self.transfers,
+            'transfer_seconds': round(self.transfer_seconds, 1),
+        }
+        if self.streamer is not None:
+            result['blocks'] = self.streamer.stats()
+        return result
+
+
+offloader = Offloader()
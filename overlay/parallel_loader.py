@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Параллельная загрузка моделей для холодного старта
+Независимые компоненты (трансформер, VAE, T5, улучшатели промптов, latent upsampler)
+грузятся одновременно в пуле потоков и сразу уходят на устройство в целевом dtype.
+Трансформер читается из safetensors через mmap прямо на устройство и собирается на meta
+устройстве (load_state_dict(assign=True)) — без промежуточной fp32 копии на хосте.
+Собирает тот же LTXVideoPipeline, что и ltx_video.inference.create_ltx_video_pipeline.
+"""
+
+import os
+import gc
+import json
+import time
+import logging
+import resource
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors import safe_open
+
+import startup_timeline
+import weight_staging
+
+logger = logging.getLogger(__name__)
+
+PARALLEL_LOAD = os.environ.get("LTX_PARALLEL_LOAD", "1") == "1"
+LOAD_WORKERS = int(os.environ.get("LTX_LOAD_WORKERS", "4"))
+
+TRANSFORMER_PREFIX = "model.diffusion_model."
+
+
+def peak_rss_gb():
+    """Пиковый RSS процесса (Linux: ru_maxrss в KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 / 1024
+
+
+def _device_str(device):
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        return f"cuda:{torch.cuda.current_device()}"
+    return str(device)
+
+
+def _timed(name, fn, timings):
+    started_at = time.time()
+    with startup_timeline.timeline.phase(name, parent="load_models"):
+        result = fn()
+    timings[name] = time.time() - started_at
+    logger.info(f"📦 {name}: {timings[name]:.1f}с (пиковый RSS {peak_rss_gb():.1f}GB)")
+    return result
+
+
+def read_checkpoint_configs(ckpt_path):
+    """Конфиги моделей из метаданных single-file чекпоинта"""
+    with safe_open(ckpt_path, framework="pt") as f:
+        metadata = f.metadata() or {}
+    return json.loads(metadata.get("config", "{}"))
+
+
+def load_transformer(ckpt_path, device, dtype=None):
+    """Трансформер: mmap чтение прямо на устройство, модель на meta, assign=True
+
+    При любой ошибке — обычный Transformer3DModel.from_pretrained + перенос на устройство.
+    """
+    from ltx_video.models.transformers.transformer3d import Transformer3DModel
+
+    try:
+        configs = read_checkpoint_configs(ckpt_path)
+        with torch.device("meta"):
+            transformer = Transformer3DModel.from_config(configs["transformer"])
+        state_dict = {}
+        with safe_open(ckpt_path, framework="pt", device=_device_str(device)) as f:
+            for key in f.keys():
+                if not key.startswith(TRANSFORMER_PREFIX):
+                    continue
+                tensor = f.get_tensor(key)
+                if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+                    tensor = tensor.to(dtype)
+                state_dict[key] = tensor
+        # Transformer3DModel.load_state_dict сам снимает префикс model.diffusion_model.
+        transformer.load_state_dict(state_dict, assign=True, strict=True)
+        del state_dict
+        on_meta = [name for name, p in transformer.named_parameters() if p.device.type == "meta"]
+        on_meta += [name for name, b in transformer.named_buffers() if b.device.type == "meta"]
+        if on_meta:
+            raise RuntimeError(f"параметры остались на meta: {on_meta[:3]}")
+        return transformer.eval()
+    except Exception as e:
+        logger.warning(f"⚠️ Быстрая загрузка трансформера не удалась ({e}), грузим через from_pretrained")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        transformer = Transformer3DModel.from_pretrained(ckpt_path)
+        if dtype is not None:
+            transformer = transformer.to(dtype)
+        return transformer.to(device).eval()
+
+
+def load_vae(ckpt_path, device):
+    from ltx_video.models.autoencoders.causal_video_autoencoder import CausalVideoAutoencoder
+
+    # VAE небольшой, а его load_state_dict переименовывает ключи и регистрирует статистики —
+    # грузим штатно, но сразу в bf16 на устройство
+    vae = CausalVideoAutoencoder.from_pretrained(ckpt_path)
+    return vae.to(device=device, dtype=torch.bfloat16).eval()
+
+
+def load_text_encoder(model_name_or_path, device):
+    from transformers import T5EncoderModel
+
+    # Сразу в bf16, веса читаются через mmap (low_cpu_mem_usage), без fp32 копии на хосте
+    try:
+        text_encoder = T5EncoderModel.from_pretrained(
+            model_name_or_path,
+            subfolder="text_encoder",
+            torch_dtype=torch.bfloat16,
+            low_cpu_mem_usage=True,
+            device_map={"": _device_str(device)},
+        )
+    except (ImportError, ValueError) as e:
+        # Без accelerate device_map недоступен
+        logger.warning(f"⚠️ T5 без device_map ({e})")
+        text_encoder = T5EncoderModel.from_pretrained(
+            model_name_or_path, subfolder="text_encoder", torch_dtype=torch.bfloat16
+        ).to(device)
+    return text_encoder.eval()
+
+
+def load_tokenizer(model_name_or_path):
+    from transformers import T5Tokenizer
+
+    return T5Tokenizer.from_pretrained(model_name_or_path, subfolder="tokenizer")
+
+
+def load_caption_model(model_name_or_path, device):
+    from transformers import AutoModelForCausalLM, AutoProcessor
+
+    # dtype как в create_ltx_video_pipeline (remote code Florence-2 ждёт свои dtype входов)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name_or_path, trust_remote_code=True, low_cpu_mem_usage=True
+    ).to(device)
+    processor = AutoProcessor.from_pretrained(model_name_or_path, trust_remote_code=True)
+    return model.eval(), processor
+
+
+def load_llm(model_name_or_path, device):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name_or_path, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True
+    ).to(device)
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    return model.eval(), tokenizer
+
+
+def load_scheduler(ckpt_path, sampler):
+    from ltx_video.schedulers.rf import RectifiedFlowScheduler
+
+    if sampler == "from_checkpoint" or not sampler:
+        return RectifiedFlowScheduler.from_pretrained(ckpt_path)
+    return RectifiedFlowScheduler(sampler=("Uniform" if sampler.lower() == "uniform" else "LinearQuadratic"))
+
+
+def load_pipeline_parallel(pipeline_config, device, enhance_prompt=False):
+    """-> (LTXVideoPipeline, latent_upsampler или None), всё уже на device"""
+    from ltx_video.pipelines.pipeline_ltx_video import LTXVideoPipeline
+    from ltx_video.models.transformers.symmetric_patchifier import SymmetricPatchifier
+    from ltx_video.inference import create_latent_upsampler
+
+    # С LTX_STAGE_WEIGHTS=1 чекпоинт копируется на локальный диск в фоне: ждём его только
+    # в потоках, которым он нужен, T5 и улучшатели промптов грузятся не дожидаясь
+    source_ckpt_path = pipeline_config["checkpoint_path"]
+    text_encoder_path = pipeline_config["text_encoder_model_name_or_path"]
+    precision = pipeline_config["precision"]
+    # Как в create_ltx_video_pipeline: bf16 только при precision=bfloat16, иначе dtype чекпоинта
+    transformer_dtype = torch.bfloat16 if precision == "bfloat16" else None
+    upsampler_path = None
+    if pipeline_config.get("pipeline_type") == "multi-scale":
+        upsampler_path = pipeline_config.get("spatial_upscaler_model_path")
+
+    started_at = time.time()
+    timings = {}
+    logger.info(f"🚀 Параллельная загрузка моделей ({LOAD_WORKERS} потоков) на {device}...")
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix="model-load") as pool:
+        futures = {
+            "text_encoder": pool.submit(_timed, "text_encoder", lambda: load_text_encoder(text_encoder_path, device), timings),
+            "tokenizer": pool.submit(load_tokenizer, text_encoder_path),
+            "transformer": pool.submit(_timed, "transformer", lambda: load_transformer(
+                weight_staging.resolve(source_ckpt_path), device, transformer_dtype), timings),
+            "vae": pool.submit(_timed, "vae", lambda: load_vae(weight_staging.resolve(source_ckpt_path), device), timings),
+            "scheduler": pool.submit(lambda: load_scheduler(
+                weight_staging.resolve(source_ckpt_path), pipeline_config.get("sampler"))),
+        }
+        if enhance_prompt:
+            futures["caption"] = pool.submit(_timed, "caption_model", lambda: load_caption_model(
+                pipeline_config["prompt_enhancer_image_caption_model_name_or_path"], device), timings)
+            futures["llm"] = pool.submit(_timed, "llm", lambda: load_llm(
+                pipeline_config["prompt_enhancer_llm_model_name_or_path"], device), timings)
+        if upsampler_path:
+            futures["latent_upsampler"] = pool.submit(
+                _timed, "latent_upsampler", lambda: create_latent_upsampler(
+                    weight_staging.resolve(upsampler_path), device), timings)
+        # result() пробрасывает исключение потока загрузки
+        loaded = {name: future.result() for name, future in futures.items()}
+
+    caption_model, caption_processor = loaded.get("caption", (None, None))
+    llm_model, llm_tokenizer = loaded.get("llm", (None, None))
+    configs = read_checkpoint_configs(weight_staging.resolve(source_ckpt_path))
+    pipeline = LTXVideoPipeline(
+        transformer=loaded["transformer"],
+        patchifier=SymmetricPatchifier(patch_size=1),
+        text_encoder=loaded["text_encoder"],
+        tokenizer=loaded["tokenizer"],
+        scheduler=loaded["scheduler"],
+        vae=loaded["vae"],
+        prompt_enhancer_image_caption_model=caption_model,
+        prompt_enhancer_image_caption_processor=caption_processor,
+        prompt_enhancer_llm_model=llm_model,
+        prompt_enhancer_llm_tokenizer=llm_tokenizer,
+        allowed_inference_steps=configs.get("allowed_inference_steps", None),
+    )
+
+    total = time.time() - started_at
+    logger.info(
+        f"✅ Модели загружены параллельно за {total:.1f}с "
+        f"(сумма по компонентам {sum(timings.values()):.1f}с), пиковый RSS {peak_rss_gb():.1f}GB"
+    )
+    return pipeline, loaded.get("latent_upsampler")
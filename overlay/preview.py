@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Быстрое превью из первого прохода multi-scale pipeline
+Латенты первого прохода (разрешение downscale_factor) готовы задолго до конца второго прохода.
+Перехватываем LTXMultiScalePipeline._upsample_latents, декодируем VAE первый латентный кадр
+(poster, JPEG) или несколько первых латентных кадров (clip, MP4) и отдаём клиенту, пока идёт
+второй проход — плохой seed можно отменить, не дожидаясь полного рендера.
+На GPU только декодирование маленького куска; JPEG/MP4 и доставка — в отдельном потоке.
+"""
+
+import io
+import os
+import time
+import logging
+import threading
+
+import torch
+import torch.nn.functional as F
+
+from frame_transfer import quantize_frames
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_MODES = ("off", "poster", "clip")
+# Режим по умолчанию (запрос может переопределить полем preview)
+PREVIEW_MODE = os.environ.get("LTX_PREVIEW", "off")
+# clip: сколько латентных кадров декодировать (1 + 8 * (n - 1) кадров видео); 0 — все
+PREVIEW_LATENT_FRAMES = int(os.environ.get("LTX_PREVIEW_LATENT_FRAMES", "4"))
+# Превью уменьшается до этой длинной стороны
+PREVIEW_MAX_SIDE = int(os.environ.get("LTX_PREVIEW_MAX_SIDE", "512"))
+PREVIEW_JPEG_QUALITY = int(os.environ.get("LTX_PREVIEW_JPEG_QUALITY", "80"))
+
+
+def parse_mode(value):
+    """'poster' / 'clip' / 'off' (или True/False) -> режим; None — режим по умолчанию"""
+    if value is None or value == "":
+        value = PREVIEW_MODE
+    if value is True:
+        return "poster"
+    if value is False:
+        return "off"
+    mode = str(value).strip().lower()
+    if mode in ("0", "none", "false", "no"):
+        return "off"
+    if mode in ("1", "true", "yes"):
+        return "poster"
+    if mode not in PREVIEW_MODES:
+        raise ValueError(f"preview: ожидается одно из {PREVIEW_MODES}, получено {value!r}")
+    return mode
+
+
+def strongest_mode(modes):
+    """Один декод на весь батч: clip > poster > off"""
+    return max(modes, key=PREVIEW_MODES.index, default="off")
+
+
+def decode_preview(multi_scale_pipeline, latents, pipeline_config, mode):
+    """Латенты первого прохода -> uint8 кадры (N, H, W, 3) на хосте, по массиву на элемент батча"""
+    from ltx_video.models.autoencoders.vae_encode import vae_decode
+
+    vae = getattr(multi_scale_pipeline, "vae", None) or multi_scale_pipeline.video_pipeline.vae
+    if mode == "poster":
+        latents = latents[:, :, :1]
+    elif PREVIEW_LATENT_FRAMES > 0:
+        latents = latents[:, :, :PREVIEW_LATENT_FRAMES]
+
+    timestep = None
+    if getattr(vae.decoder, "timestep_conditioning", False):
+        # Без добавления шума (decode_noise_scale) — для превью это не нужно
+        timestep = torch.tensor(
+            [pipeline_config.get("decode_timestep", 0.05)] * latents.shape[0], device=latents.device
+        )
+    with torch.no_grad():
+        frames = vae_decode(latents, vae, is_video=True, vae_per_channel_normalize=True, timestep=timestep)
+        # [-1, 1] -> [0, 1], как postprocess pipeline
+        frames = frames.float() / 2 + 0.5
+        height, width = frames.shape[-2:]
+        scale = PREVIEW_MAX_SIDE / max(height, width)
+        results = []
+        for video in frames:
+            if scale < 1:
+                # (C, F, H, W): F как батч для interpolate; чётные размеры для yuv420p
+                size = (max(int(height * scale) // 2 * 2, 2), max(int(width * scale) // 2 * 2, 2))
+                video = F.interpolate(video.permute(1, 0, 2, 3), size=size, mode="bilinear",
+                                      align_corners=False).permute(1, 0, 2, 3)
+            results.append(quantize_frames(video).cpu().numpy())
+    del frames, latents
+    return results
+
+
+def encode_preview(frames, mode, fps):
+    """uint8 (N, H, W, 3) -> (bytes, формат)"""
+    if mode == "poster" or frames.shape[0] == 1:
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.fromarray(frames[0]).save(buffer, format="JPEG", quality=PREVIEW_JPEG_QUALITY)
+        return buffer.getvalue(), "jpg"
+    from video_writer import encode_mp4_bytes
+
+    return encode_mp4_bytes([frames], width=frames.shape[2], height=frames.shape[1], fps=fps), "mp4"
+
+
+class PreviewHook:
+    """На время вызова pipeline подменяет _upsample_latents экземпляра LTXMultiScalePipeline
+
+    on_preview(index, data, fmt) вызывается в отдельном потоке для каждого элемента батча.
+    """
+
+    def __init__(self, pipeline, pipeline_config, mode, on_preview, fps=24):
+        self.pipeline = pipeline
+        self.pipeline_config = pipeline_config
+        self.mode = mode
+        self.on_preview = on_preview
+        self.fps = fps
+        self.latency = None
+        self._thread = None
+        self._started_at = None
+        self._installed = False
+
+    def __enter__(self):
+        if self.mode == "off" or self.on_preview is None or not hasattr(self.pipeline, "_upsample_latents"):
+            return self
+        self._started_at = time.time()
+        original = self.pipeline._upsample_latents
+
+        def upsample_with_preview(latent_upsampler, latents):
+            try:
+                self._deliver(decode_preview(self.pipeline, latents, self.pipeline_config, self.mode))
+            except Exception as e:
+                logger.warning(f"⚠️ Превью не удалось: {e}")
+            return original(latent_upsampler, latents)
+
+        # Атрибут экземпляра перекрывает метод класса; в __exit__ убираем
+        self.pipeline._upsample_latents = upsample_with_preview
+        self._installed = True
+        return self
+
+    def _deliver(self, frames_list):
+        decoded_at = time.time()
+
+        def run():
+            for index, frames in enumerate(frames_list):
+                try:
+                    data, fmt = encode_preview(frames, self.mode, self.fps)
+                    self.on_preview(index, data, fmt)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось отдать превью {index}: {e}")
+            self.latency = time.time() - self._started_at
+            logger.info(
+                f"👀 Превью ({self.mode}) отдано через {self.latency:.1f}с от начала генерации "
+                f"(декодировано через {decoded_at - self._started_at:.1f}с)"
+            )
+
+        self._thread = threading.Thread(target=run, name="preview", daemon=True)
+        self._thread.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._installed:
+            del self.pipeline._upsample_latents
+            self._installed = False
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        return False
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Прогресс генерации по шагам и этапам
+Этапы: prepare (промпт, эмбеддинги) -> first_pass -> upsample -> second_pass -> decode -> encode
+(-> upload в rp_handler); у single-scale pipeline вместо двух проходов — denoise.
+Шаги denoising приходят через callback_on_step_end pipeline. На шаге — только time.time()
+и сравнения: обновления прореживаются (LTX_PROGRESS_INTERVAL) и отправляются в sinks
+(RunPod progress_update, RPC, файл прогресса) отдельным потоком, без синхронизации с GPU.
+ETA — по средней длительности шага текущего прохода и истории этапов для того же bucket'а.
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("prepare", "first_pass", "upsample", "second_pass", "denoise", "decode", "encode", "upload", "done")
+# Не чаще одного обновления за столько секунд (смена этапа отправляется всегда)
+PROGRESS_INTERVAL = float(os.environ.get("LTX_PROGRESS_INTERVAL", "1.0"))
+HISTORY_EMA = 0.3
+
+# (bucket, этап) -> EMA длительности этапа в секундах; общая на процесс, пополняется и прогревом
+_history = {}
+_history_lock = threading.Lock()
+
+
+def _remember(bucket, stage, seconds):
+    key = (bucket, stage)
+    with _history_lock:
+        previous = _history.get(key)
+        _history[key] = seconds if previous is None else (1 - HISTORY_EMA) * previous + HISTORY_EMA * seconds
+
+
+def _recall(bucket, stage):
+    with _history_lock:
+        return _history.get((bucket, stage))
+
+
+class ProgressTracker:
+    """Состояние прогресса одного вызова pipeline (батча); sinks — callable(update: dict)"""
+
+    def __init__(self, sinks=(), interval=PROGRESS_INTERVAL, extra_stages=()):
+        self.sinks = [sink for sink in sinks if sink is not None]
+        self.interval = interval
+        self.extra_stages = tuple(extra_stages)
+        # [(этап, шагов, относительная стоимость шага)]
+        self.plan = [("prepare", 0, 0.0), ("denoise", 0, 1.0), ("decode", 0, 0.0), ("encode", 0, 0.0)]
+        self.plan += [(stage, 0, 0.0) for stage in self.extra_stages]
+        self.bucket = None
+        self.started_at = time.time()
+        self.current = None
+        self.stage_started_at = self.started_at
+        self.step = 0
+        self.steps = 0
+        self._last_step = -1
+        # Секунд на шаг единичной стоимости (последний замер)
+        self._unit_seconds = None
+        self._last_emit = 0.0
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self.stage("prepare")
+
+    def configure(self, pipeline_config, multi_scale, bucket=None):
+        """План этапов по конфигу pipeline; bucket — ключ истории длительностей"""
+        first_steps = len(pipeline_config.get("first_pass", {}).get("timesteps") or [])
+        if multi_scale:
+            second_steps = len(pipeline_config.get("second_pass", {}).get("timesteps") or [])
+            # Первый проход идёт в уменьшенном разрешении, шаг второго дороже в ~1/scale^2 раз
+            scale = float(pipeline_config.get("downscale_factor", 0.6666666))
+            plan = [("prepare", 0, 0.0), ("first_pass", first_steps, 1.0), ("upsample", 0, 0.0),
+                    ("second_pass", second_steps, 1.0 / scale ** 2), ("decode", 0, 0.0)]
+        else:
+            steps = first_steps or int(pipeline_config.get("num_inference_steps", 0))
+            plan = [("prepare", 0, 0.0), ("denoise", steps, 1.0), ("decode", 0, 0.0)]
+        self.plan = plan + [("encode", 0, 0.0)] + [(stage, 0, 0.0) for stage in self.extra_stages]
+        self.bucket = bucket
+
+    def _plan_index(self, stage):
+        for index, (name, _, _) in enumerate(self.plan):
+            if name == stage:
+                return index
+        return None
+
+    def stage(self, name, now=None):
+        """Переход к этапу; длительность предыдущего уходит в историю"""
+        now = now if now is not None else time.time()
+        if self.current is not None and self.current != name:
+            seconds = now - self.stage_started_at
+            _remember(self.bucket, self.current, seconds)
+            index = self._plan_index(self.current)
+            if index is not None and self.plan[index][1] and self.step:
+                self._unit_seconds = seconds / self.step / (self.plan[index][2] or 1.0)
+        self.current = name
+        self.stage_started_at = now
+        self.step = 0
+        self._last_step = -1
+        index = self._plan_index(name)
+        self.steps = self.plan[index][1] if index is not None else 0
+        self._emit(now, force=True)
+
+    def on_step_end(self, pipeline, step, timestep=None, callback_kwargs=None):
+        """callback_on_step_end для LTXVideoPipeline (вызывается после каждого шага denoising)"""
+        now = time.time()
+        index = self._plan_index(self.current)
+        in_denoise = index is not None and self.plan[index][1] > 0
+        if not in_denoise or step <= self._last_step:
+            # Новый проход: следующий по плану этап с шагами
+            start = (index + 1) if index is not None else 0
+            next_stage = next((name for name, steps, _ in self.plan[start:] if steps), None)
+            if next_stage is not None:
+                self.stage(next_stage, now)
+        self._last_step = step
+        self.step = step + 1
+        if self.steps and self.step >= self.steps:
+            # Проход закончился — дальше апсемплинг или декодирование VAE (без своих callback'ов)
+            index = self._plan_index(self.current)
+            if index is not None and index + 1 < len(self.plan):
+                self.stage(self.plan[index + 1][0], now)
+                return callback_kwargs if callback_kwargs is not None else {}
+        self._emit(now)
+        return callback_kwargs if callback_kwargs is not None else {}
+
+    def refresh(self):
+        """Отправить обновление вне очереди (например, когда появилось превью)"""
+        self._emit(time.time(), force=True)
+
+    def eta_seconds(self, now=None):
+        """Оценка оставшегося времени; None, если оценить пока нечем"""
+        now = now if now is not None else time.time()
+        index = self._plan_index(self.current)
+        if index is None:
+            return None
+        _, steps, cost = self.plan[index]
+        stage_elapsed = now - self.stage_started_at
+        unit = self._unit_seconds
+        remaining = 0.0
+        known = True
+        if steps and self.step:
+            step_seconds = stage_elapsed / self.step
+            unit = step_seconds / (cost or 1.0)
+            remaining += step_seconds * (steps - self.step)
+        else:
+            seconds = _recall(self.bucket, self.current)
+            if seconds is not None:
+                remaining += max(seconds - stage_elapsed, 0.0)
+            elif steps and unit is not None:
+                remaining += max(unit * cost * steps - stage_elapsed, 0.0)
+            elif steps:
+                known = False
+        for name, steps, cost in self.plan[index + 1:]:
+            seconds = _recall(self.bucket, name)
+            if seconds is not None:
+                remaining += seconds
+            elif steps and unit is not None:
+                remaining += unit * cost * steps
+            elif steps:
+                known = False
+        return remaining if known else None
+
+    def snapshot(self, now=None):
+        now = now if now is not None else time.time()
+        elapsed = now - self.started_at
+        eta = 0.0 if self.current == "done" else self.eta_seconds(now)
+        update = {
+            "stage": self.current,
+            "step": self.step,
+            "steps": self.steps,
+            "elapsed_seconds": round(elapsed, 2),
+            "eta_seconds": round(eta, 2) if eta is not None else None,
+            "progress": round(elapsed / (elapsed + eta), 4) if eta is not None and elapsed + eta > 0 else None,
+        }
+        return update
+
+    def _emit(self, now, force=False):
+        if not self.sinks:
+            return
+        if not force and now - self._last_emit < self.interval:
+            return
+        self._last_emit = now
+        update = self.snapshot(now)
+        with self._cond:
+            self._pending = update
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._send_loop, name="progress", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                update, self._pending = self._pending, None
+                if update is None:
+                    return
+            for sink in self.sinks:
+                try:
+                    sink(update)
+                except Exception as e:
+                    logger.warning(f"⚠️ Не удалось отправить прогресс: {e}")
+
+    def finish(self):
+        """Последний этап в историю, финальное обновление и остановка потока отправки"""
+        self.stage("done")
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Персистентный кеш улучшенных промптов (caption модель + LLM)
+Ключ — промпт + хеш conditioning картинки + ID моделей улучшателя.
+Живёт на /runpod-volume, переживает рестарты воркеров; вытеснение по размеру (LRU по mtime).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get("LTX_PROMPT_CACHE_DIR", "/runpod-volume/cache/enhanced_prompts")
+MAX_BYTES = int(float(os.environ.get("LTX_PROMPT_CACHE_MB", "64")) * 1024 * 1024)
+# Как часто (в записях) пересчитываем размер кеша и вытесняем старое
+EVICT_EVERY = 50
+# Как часто (секунды) сбрасываем счётчики попаданий в общий stats.json на томе
+STATS_FLUSH_SECONDS = float(os.environ.get("LTX_PROMPT_CACHE_STATS_SECONDS", "60"))
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class EnhancedPromptCache:
+    """Кеш улучшенных промптов: по файлу JSON на запись"""
+
+    def __init__(self, enhancer_id, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.enhancer_id = enhancer_id
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True
+        self._puts = 0
+        # Ещё не сброшенные в stats.json счётчики и время последнего сброса
+        self._pending = {"hits": 0, "misses": 0}
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Кеш промптов отключён, нет доступа к {self.cache_dir}: {e}")
+            self.enabled = False
+
+    def key(self, prompt, image_hash=None):
+        payload = json.dumps([self.enhancer_id, prompt, image_hash or ""], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, prompt, image_hash=None):
+        if not self.enabled:
+            return None
+        path = self._path(self.key(prompt, image_hash))
+        try:
+            with open(path, 'r') as f:
+                enhanced_prompt = json.load(f)["enhanced_prompt"]
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # Обрезанная или нечитаемая запись (EIO, права на томе) — промах, а не ошибка запроса
+            logger.warning(f"⚠️ Запись кеша промптов не читается, считаем промахом: {e}")
+            self._count(hit=False)
+            return None
+        try:
+            # mtime = время последнего использования (для LRU вытеснения)
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return enhanced_prompt
+
+    def put(self, prompt, image_hash, enhanced_prompt):
+        if not self.enabled:
+            return
+        path = self._path(self.key(prompt, image_hash))
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    "prompt": prompt,
+                    "image_hash": image_hash,
+                    "enhancer_id": self.enhancer_id,
+                    "enhanced_prompt": enhanced_prompt,
+                    "created_at": time.time(),
+                }, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать кеш промпта: {e}")
+            return
+        self._puts += 1
+        if self._puts % EVICT_EVERY == 1:
+            self.evict()
+
+    def get_or_enhance(self, prompt, image_hash, enhance_fn):
+        """Берём улучшенный промпт из кеша или считаем enhance_fn()"""
+        cached = self.get(prompt, image_hash)
+        if cached is not None:
+            return cached
+        enhanced_prompt = enhance_fn()
+        self.put(prompt, image_hash, enhanced_prompt)
+        return enhanced_prompt
+
+    def evict(self):
+        """Удаляем давно не использованные записи, пока кеш не влезет в бюджет"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json") or name == "stats.json":
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except FileNotFoundError:
+                pass
+        logger.info(f"🧹 Кеш промптов: вытеснено {removed} записей, осталось {total / 1024 / 1024:.1f}MB")
+
+    def _count(self, hit):
+        field = "hits" if hit else "misses"
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+            self._pending[field] += 1
+            due = time.time() - self._flushed_at >= STATS_FLUSH_SECONDS
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Накопленные счётчики — в суммарный stats.json на томе (best-effort, общий для всех воркеров)"""
+        with self._lock:
+            pending, self._pending = self._pending, {"hits": 0, "misses": 0}
+            self._flushed_at = time.time()
+        if not any(pending.values()):
+            return
+        stats_path = os.path.join(self.cache_dir, "stats.json")
+        try:
+            try:
+                with open(stats_path, 'r') as f:
+                    totals = json.load(f)
+            except (FileNotFoundError, ValueError):
+                totals = {"hits": 0, "misses": 0}
+            for field, count in pending.items():
+                totals[field] = totals.get(field, 0) + count
+            tmp_path = f"{stats_path}.tmp.{os.getpid()}"
+            with open(tmp_path, 'w') as f:
+                json.dump(totals, f)
+            os.replace(tmp_path, stats_path)
+        except OSError:
+            pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Контентно-адресуемый кеш готовых видео
+Генерация детерминирована: промпт, негативный промпт, картинка, размеры, seed, режим тайлов VAE
+и конфиг pipeline однозначно задают результат. Ключ — sha256 канонического JSON этих входов + отпечаток модели
+(конфиг, sha256 чекпоинтов, параметры кодирования MP4). Повторы (ретраи клиента, повторная
+генерация из галереи, дубли вебхуков) отдаются с диска за миллисекунды, без GPU.
+Живёт на /runpod-volume; на запись — MP4 и JSON метаданных, вытеснение по размеру (LRU по mtime).
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE = os.environ.get("LTX_RESULT_CACHE", "1") == "1"
+CACHE_DIR = os.environ.get("LTX_RESULT_CACHE_DIR", "/runpod-volume/cache/results")
+MAX_BYTES = int(float(os.environ.get("LTX_RESULT_CACHE_GB", "20")) * 1024 ** 3)
+# Меняется при изменениях кода, влияющих на пиксели результата
+CACHE_VERSION = 2
+EVICT_EVERY = 20
+
+_fingerprints = {}
+_fingerprint_lock = threading.Lock()
+
+
+def _file_identity(path):
+    """sha256 из .sha256.json загрузчика весов, иначе имя + размер"""
+    try:
+        with open(f"{path}.sha256.json") as f:
+            sha256 = json.load(f).get("sha256")
+        if sha256:
+            return sha256
+    except (OSError, ValueError):
+        pass
+    try:
+        return f"{os.path.basename(path)}:{os.path.getsize(path)}"
+    except OSError:
+        return os.path.basename(path)
+
+
+def model_fingerprint(pipeline_config_path="ltxv-13b-0.9.8-distilled.yaml"):
+    """Отпечаток модели и конфига (считается один раз на процесс, без torch)"""
+    import yaml
+    from video_writer import DEFAULT_CRF, DEFAULT_PRESET
+
+    path = os.path.abspath(pipeline_config_path)
+    with _fingerprint_lock:
+        if path in _fingerprints:
+            return _fingerprints[path]
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        base_dir = os.path.dirname(path)
+        weights = {}
+        for key in ("checkpoint_path", "spatial_upscaler_model_path"):
+            if config.get(key):
+                weights[key] = _file_identity(os.path.join(base_dir, config[key]))
+        payload = json.dumps({
+            "version": CACHE_VERSION,
+            "config": config,
+            "weights": weights,
+            "encoder": {"crf": DEFAULT_CRF, "preset": DEFAULT_PRESET},
+        }, sort_keys=True, ensure_ascii=False, default=str)
+        _fingerprints[path] = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return _fingerprints[path]
+
+
+def request_key(fingerprint, prompt, negative_prompt, height, width, num_frames, seed,
+                frame_rate=24, image_hash=None, **extra):
+    """Канонический ключ запроса; extra — прочие входы, влияющие на результат"""
+    payload = json.dumps({
+        "model": fingerprint,
+        "prompt": prompt,
+        "negative_prompt": negative_prompt or "",
+        "height": int(height),
+        "width": int(width),
+        "num_frames": int(num_frames),
+        "seed": int(seed),
+        "frame_rate": frame_rate,
+        "image": image_hash,
+        "extra": {k: v for k, v in extra.items() if v is not None},
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Кеш результатов: <key>.mp4 + <key>.json (метаданные, mtime — последнее использование)"""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, enabled=RESULT_CACHE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Кеш результатов отключён, нет доступа к {self.cache_dir}: {e}")
+            self.enabled = False
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return f"{base}.mp4", f"{base}.json"
+
+    def get(self, key):
+        """-> (путь к MP4, метаданные) или None"""
+        if not self.enabled or not key:
+            return None
+        video_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if os.path.getsize(video_path) != meta.get("size"):
+                raise ValueError("размер не совпал")
+            # mtime = время последнего использования (для LRU вытеснения)
+            os.utime(meta_path, None)
+        except (OSError, ValueError):
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        logger.info(f"🎯 Кеш результатов: попадание {key[:12]} ({meta.get('size', 0) / 1024 / 1024:.1f}MB)")
+        return video_path, meta
+
+    def put(self, key, source, **meta):
+        """source — путь к файлу, bytes или файловый объект (читается с текущей позиции)"""
+        if not self.enabled or not key:
+            return None
+        video_path, meta_path = self._paths(key)
+        tmp_path = f"{video_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+        try:
+            os.makedirs(os.path.dirname(video_path), exist_ok=True)
+            if isinstance(source, (str, os.PathLike)):
+                shutil.copyfile(source, tmp_path)
+            elif isinstance(source, (bytes, bytearray, memoryview)):
+                with open(tmp_path, "wb") as f:
+                    f.write(source)
+            else:
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(source, f, 4 * 1024 * 1024)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, video_path)
+            # Метаданные последними: запись без .json не видна get()
+            meta = {**meta, "key": key, "size": size, "created_at": time.time()}
+            tmp_meta = f"{meta_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_meta, "w") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_meta, meta_path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать кеш результата: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % EVICT_EVERY == 1
+        if evict:
+            self.evict()
+        return video_path
+
+    def update_meta(self, key, **fields):
+        """Дописываем метаданные (например, ключ объекта в S3 после загрузки)"""
+        if not self.enabled or not key:
+            return
+        _, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta.update(fields)
+            tmp_meta = f"{meta_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_meta, "w") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_meta, meta_path)
+        except (OSError, ValueError):
+            pass
+
+    def evict(self):
+        """Удаляем давно не использованные записи, пока кеш не влезет в бюджет"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(root, name)
+                video_path = meta_path[:-len(".json")] + ".mp4"
+                try:
+                    last_used = os.stat(meta_path).st_mtime
+                    size = os.path.getsize(video_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((last_used, size, meta_path, video_path))
+                total += size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, meta_path, video_path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            for path in (meta_path, video_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+        logger.info(f"🧹 Кеш результатов: вытеснено {removed} записей, осталось {total / 1024 ** 3:.2f}GB")
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Общий ResultCache процесса"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
+
+
+def command_key(command, pipeline_config_path="ltxv-13b-0.9.8-distilled.yaml", default_negative_prompt=""):
+    """Ключ для команды демона / задачи Celery (dict с prompt, размерами, seed, image_base64)
+
+    Считается и при выключенном кеше — по нему же склеиваются одинаковые задачи в работе.
+    """
+    try:
+        image_hash = None
+        if command.get("image_base64"):
+            from conditioning import image_hash as hash_image
+            image_hash = hash_image(command["image_base64"])
+        elif command.get("image_path"):
+            from prompt_cache import hash_file
+            image_hash = hash_file(command["image_path"])
+        from tiled_vae import cache_identity
+        return request_key(
+            model_fingerprint(pipeline_config_path),
+            prompt=command["prompt"],
+            negative_prompt=command.get("negative_prompt") or default_negative_prompt,
+            height=command["height"],
+            width=command["width"],
+            num_frames=command["num_frames"],
+            seed=command["seed"],
+            frame_rate=command.get("frame_rate", 24),
+            image_hash=image_hash,
+            vae_tiling=cache_identity(command.get("vae_tiling")),
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Ключ кеша результатов не посчитан: {e}")
+        return None
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Загрузка результатов в S3-совместимое хранилище
+Параллельный multipart upload с настраиваемым размером части и повторами. MultipartStream —
+file-like объект: его можно отдать StreamingMp4Writer напрямую, части уходят в хранилище,
+пока ffmpeg ещё кодирует. Копия пишется во временный файл (на диск, не в RAM) — из неё
+повторяется загрузка и строится base64, если хранилище недоступно.
+Кредиты — те же переменные, что у runpod rp_upload (BUCKET_ENDPOINT_URL, BUCKET_ACCESS_KEY_ID,
+BUCKET_SECRET_ACCESS_KEY); для локального S3 (MinIO и т.п.) достаточно указать его endpoint.
+
+Проверка вручную: python result_uploader.py video.mp4 --key test/video.mp4
+Проверка на локальном S3 (moto[server]): python result_uploader.py --check
+"""
+
+import os
+import sys
+import time
+import base64
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BUCKET_ENDPOINT_URL = os.environ.get("BUCKET_ENDPOINT_URL")
+BUCKET_ACCESS_KEY_ID = os.environ.get("BUCKET_ACCESS_KEY_ID")
+BUCKET_SECRET_ACCESS_KEY = os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+# Как у rp_upload: по умолчанию бакет "%m-%y"
+RESULT_BUCKET = os.environ.get("LTX_RESULT_BUCKET") or time.strftime("%m-%y")
+RESULT_PREFIX = os.environ.get("LTX_RESULT_PREFIX", "")
+URL_EXPIRES = int(os.environ.get("LTX_RESULT_URL_EXPIRES", str(7 * 24 * 3600)))
+# S3 требует части не меньше 5MB (кроме последней)
+PART_BYTES = max(int(float(os.environ.get("LTX_UPLOAD_PART_MB", "8")) * 1024 * 1024), 5 * 1024 * 1024)
+UPLOAD_CONCURRENCY = int(os.environ.get("LTX_UPLOAD_CONCURRENCY", "4"))
+UPLOAD_RETRIES = int(os.environ.get("LTX_UPLOAD_RETRIES", "3"))
+# Лимит base64 в ответе (payload RunPod ограничен); больше — отдаём ошибку вместо гигантского JSON
+MAX_BASE64_BYTES = int(os.environ.get("LTX_MAX_BASE64_BYTES", str(20 * 1024 * 1024)))
+# Кратно 3 — куски base64 склеиваются без паддинга в середине
+BASE64_CHUNK_BYTES = 3 * 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class Base64LimitExceeded(Exception):
+    pass
+
+
+def configured():
+    """Есть ли кредиты хранилища и boto3"""
+    if not (BUCKET_ENDPOINT_URL and BUCKET_ACCESS_KEY_ID and BUCKET_SECRET_ACCESS_KEY):
+        return False
+    try:
+        import boto3  # noqa: F401
+    except ImportError:
+        logger.warning("⚠️ BUCKET_* заданы, но boto3 не установлен")
+        return False
+    return True
+
+
+def _retry(fn, what, retries=UPLOAD_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise UploadError(f"{what}: {e}") from e
+            delay = 0.5 * 2 ** attempt
+            logger.warning(f"⚠️ {what}: {e}, повтор через {delay:.1f}с ({attempt + 1}/{retries})")
+            time.sleep(delay)
+
+
+class ResultUploader:
+    """boto3 клиент + параметры загрузки; клиент потокобезопасен и переиспользуется"""
+
+    def __init__(self, endpoint_url=None, access_key_id=None, secret_access_key=None, bucket=None,
+                 prefix=None, part_bytes=PART_BYTES, concurrency=UPLOAD_CONCURRENCY, retries=UPLOAD_RETRIES):
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = bucket or RESULT_BUCKET
+        self.prefix = RESULT_PREFIX if prefix is None else prefix
+        self.part_bytes = max(int(part_bytes), 5 * 1024 * 1024)
+        self.concurrency = max(int(concurrency), 1)
+        self.retries = retries
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or BUCKET_ENDPOINT_URL,
+            aws_access_key_id=access_key_id or BUCKET_ACCESS_KEY_ID,
+            aws_secret_access_key=secret_access_key or BUCKET_SECRET_ACCESS_KEY,
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=self.concurrency * 2,
+                # Path-style работает и с AWS, и с локальными S3 (MinIO, moto)
+                s3={"addressing_style": "path"},
+                # Повторы делаем сами, по частям
+                retries={"max_attempts": 1},
+            ),
+        )
+
+    def object_key(self, name):
+        return f"{self.prefix.rstrip('/')}/{name}" if self.prefix else name
+
+    def presigned_url(self, key):
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=URL_EXPIRES
+        )
+
+    def open_stream(self, name, content_type="video/mp4"):
+        return MultipartStream(self, self.object_key(name), content_type)
+
+    def upload_fileobj(self, fileobj, name, content_type="video/mp4"):
+        """Загрузить уже готовые данные (файл, BytesIO) -> presigned URL"""
+        stream = self.open_stream(name, content_type)
+        try:
+            with stream:
+                while True:
+                    chunk = fileobj.read(self.part_bytes)
+                    if not chunk:
+                        break
+                    stream.write(chunk)
+        finally:
+            stream.discard()
+        return stream.url
+
+
+class MultipartStream:
+    """write() копит части по part_bytes и загружает их в пуле потоков; close() -> URL
+
+    Маленький результат (меньше одной части) уходит одним put_object.
+    """
+
+    def __init__(self, uploader, key, content_type):
+        self.uploader = uploader
+        self.key = key
+        self.content_type = content_type
+        self.url = None
+        self.error = None
+        self.bytes_written = 0
+        self.spool = tempfile.TemporaryFile(prefix="ltx_result_")
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._part_futures = []
+        self._pool = None
+        self._started_at = time.time()
+
+    # file-like интерфейс для StreamingMp4Writer
+    def write(self, data):
+        self.spool.write(data)
+        self.bytes_written += len(data)
+        if self.error is not None:
+            # Хранилище уже отказало — просто копим в spool для фолбэка
+            return len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.uploader.part_bytes:
+            part = bytes(self._buffer[:self.uploader.part_bytes])
+            del self._buffer[:self.uploader.part_bytes]
+            self._submit_part(part)
+        return len(data)
+
+    def _submit_part(self, data):
+        try:
+            if self._upload_id is None:
+                response = _retry(lambda: self.uploader.client.create_multipart_upload(
+                    Bucket=self.uploader.bucket, Key=self.key, ContentType=self.content_type
+                ), "create_multipart_upload", self.uploader.retries)
+                self._upload_id = response["UploadId"]
+                self._pool = ThreadPoolExecutor(max_workers=self.uploader.concurrency, thread_name_prefix="upload")
+        except UploadError as e:
+            self.error = e
+            return
+        in_flight = [future for future in self._part_futures if not future.done()]
+        if len(in_flight) >= self.uploader.concurrency * 2:
+            # Хранилище медленнее кодирования — не копим части в памяти
+            wait(in_flight, return_when=FIRST_COMPLETED)
+        part_number = len(self._part_futures) + 1
+        self._part_futures.append(self._pool.submit(self._upload_part, part_number, data))
+
+    def _upload_part(self, part_number, data):
+        response = _retry(lambda: self.uploader.client.upload_part(
+            Bucket=self.uploader.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=data,
+        ), f"upload_part {part_number}", self.uploader.retries)
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def abort(self, reason="прервано"):
+        """Отменяем загрузку: частичный результат не должен остаться в хранилище под именем результата"""
+        self.error = self.error or UploadError(reason)
+        self._buffer = bytearray()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+        self._abort()
+
+    def _abort(self):
+        if self._upload_id is None:
+            return
+        try:
+            self.uploader.client.abort_multipart_upload(
+                Bucket=self.uploader.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ abort_multipart_upload {self.key}: {e}")
+
+    def close(self):
+        """Дожидаемся частей и завершаем загрузку; при ошибке URL = None, error заполнен"""
+        try:
+            if self.error is None:
+                if self._upload_id is None:
+                    body = bytes(self._buffer)
+                    _retry(lambda: self.uploader.client.put_object(
+                        Bucket=self.uploader.bucket, Key=self.key, Body=body, ContentType=self.content_type
+                    ), "put_object", self.uploader.retries)
+                else:
+                    if self._buffer:
+                        self._submit_part(bytes(self._buffer))
+                    parts = [future.result() for future in self._part_futures]
+                    _retry(lambda: self.uploader.client.complete_multipart_upload(
+                        Bucket=self.uploader.bucket, Key=self.key, UploadId=self._upload_id,
+                        MultipartUpload={"Parts": parts},
+                    ), "complete_multipart_upload", self.uploader.retries)
+                self.url = self.uploader.presigned_url(self.key)
+        except Exception as e:
+            self.error = e if isinstance(e, UploadError) else UploadError(str(e))
+        finally:
+            self._buffer = bytearray()
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+        if self.error is not None:
+            self._abort()
+            logger.error(f"🔴 Загрузка {self.key} не удалась: {self.error}")
+        else:
+            metrics.record_upload(self.bytes_written)
+            seconds = time.time() - self._started_at
+            logger.info(
+                f"☁️ Загружено {self.key}: {self.bytes_written / 1024 / 1024:.2f}MB, "
+                f"{len(self._part_futures) or 1} част(ей), {seconds:.1f}с с начала кодирования"
+            )
+        return self.url
+
+    def reader(self):
+        """Копия результата (для фолбэка): файловый объект с начала"""
+        self.spool.flush()
+        self.spool.seek(0)
+        return self.spool
+
+    def discard(self):
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort(f"прервано: {exc}")
+            return False
+        self.close()
+        if self.error is not None:
+            raise self.error
+        return False
+
+
+def encode_base64_chunked(fileobj, limit=MAX_BASE64_BYTES, chunk_bytes=BASE64_CHUNK_BYTES):
+    """base64 кусками из файла: в памяти только итоговая строка, без копии bytes целиком"""
+    pieces = []
+    encoded_size = 0
+    while True:
+        chunk = fileobj.read(chunk_bytes)
+        if not chunk:
+            break
+        encoded_size += (len(chunk) + 2) // 3 * 4
+        if limit and encoded_size > limit:
+            raise Base64LimitExceeded(
+                f"результат больше лимита base64 ({limit / 1024 / 1024:.0f}MB, LTX_MAX_BASE64_BYTES); "
+                f"настройте BUCKET_* для загрузки в хранилище"
+            )
+        pieces.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(pieces)
+
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    """Общий ResultUploader процесса или None, если хранилище не настроено"""
+    global _uploader
+    if not configured():
+        return None
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = ResultUploader()
+        return _uploader
+
+
+def check():
+    """Загрузчик против локального S3 (moto): multipart и put_object байт в байт, отмена без следа, лимит base64"""
+    import io
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    failures = []
+    try:
+        uploader = ResultUploader(
+            endpoint_url=f"http://{host}:{port}", access_key_id="check", secret_access_key="check",
+            bucket="ltx-check", prefix="", part_bytes=5 * 1024 * 1024, concurrency=3, retries=0,
+        )
+        uploader.client.create_bucket(Bucket="ltx-check")
+
+        def stored(key):
+            try:
+                return uploader.client.get_object(Bucket="ltx-check", Key=key)["Body"].read()
+            except uploader.client.exceptions.NoSuchKey:
+                return None
+
+        def stream_upload(key, data):
+            stream = uploader.open_stream(key)
+            try:
+                for offset in range(0, len(data), 256 * 1024):
+                    stream.write(data[offset:offset + 256 * 1024])
+                return stream.close(), stream
+            finally:
+                stream.discard()
+
+        for name, size in (("multipart", 12 * 1024 * 1024 + 123), ("put_object", 300 * 1024)):
+            data = os.urandom(size)
+            url, stream = stream_upload(f"{name}.mp4", data)
+            if url is None or stored(f"{name}.mp4") != data:
+                failures.append(f"{name}: результат в хранилище не совпадает ({stream.error})")
+
+        # Отмена посреди кодирования: ни объекта, ни незавершённой multipart загрузки
+        stream = uploader.open_stream("aborted.mp4")
+        stream.write(os.urandom(11 * 1024 * 1024))
+        stream.abort("ошибка генерации")
+        stream.discard()
+        pending = uploader.client.list_multipart_uploads(Bucket="ltx-check").get("Uploads", [])
+        if stored("aborted.mp4") is not None or pending:
+            failures.append(f"abort: остался объект или {len(pending)} незавершённых загрузок")
+
+        data = os.urandom(1024 * 1024)
+        if base64.b64decode(encode_base64_chunked(io.BytesIO(data), limit=None)) != data:
+            failures.append("base64: не совпадает с исходными данными")
+        try:
+            encode_base64_chunked(io.BytesIO(data), limit=1024 * 1024)
+            failures.append("base64: лимит не сработал")
+        except Base64LimitExceeded:
+            pass
+    finally:
+        server.stop()
+
+    for failure in failures:
+        logger.error(f"❌ {failure}")
+    if not failures:
+        logger.info("✅ Загрузчик: multipart, put_object, отмена и base64 в порядке")
+    return 1 if failures else 0
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Загрузка файла через ResultUploader")
+    parser.add_argument("path", nargs="?")
+    parser.add_argument("--key", default=None)
+    parser.add_argument("--bucket", default=None)
+    parser.add_argument("--part-mb", type=float, default=PART_BYTES / 1024 / 1024)
+    parser.add_argument("--check", action="store_true", help="Проверка на локальном S3 (нужен moto[server])")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.check:
+        return check()
+    if args.path is None:
+        parser.error("нужен путь к файлу (или --check)")
+    if not configured():
+        logger.error("❌ Задайте BUCKET_ENDPOINT_URL, BUCKET_ACCESS_KEY_ID, BUCKET_SECRET_ACCESS_KEY (нужен boto3)")
+        return 1
+    uploader = ResultUploader(bucket=args.bucket, part_bytes=args.part_mb * 1024 * 1024)
+    with open(args.path, "rb") as f:
+        try:
+            url = uploader.upload_fileobj(f, args.key or os.path.basename(args.path))
+        except UploadError as e:
+            logger.error(f"❌ {e}")
+            return 1
+    print(url)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
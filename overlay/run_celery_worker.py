@@ -9,8 +9,8 @@ import sys
 from my_celery import celery_app
 
 if __name__ == '__main__':
-    # Устанавливаем переменные окружения для GPU
-    os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+    # Воркер сам GPU не использует — генерация идёт в inference демонах
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', os.environ.get('LTX_DAEMON_DEVICE', '0'))
     
     # Запускаем воркер
     celery_app.worker_main([
@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 """
 Скрипт для запуска официального inference демона
-Запускать: python run_inference_daemon_official.py
+Запускать: python run_inference_daemon_official.py [--device N]
+Несколько GPU: по одному демону на устройство, все читают общую очередь inference_commands/
 """
 
 import os
 import sys
+import argparse
 
-# Устанавливаем переменные окружения для GPU и кеша
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+import startup_timeline  # noqa: F401 — фаза импортов считается с этого момента
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--device", default=os.environ.get("LTX_DAEMON_DEVICE", "0"),
+                    help="Номер GPU для этого демона")
+args = parser.parse_args()
+
+# Устанавливаем переменные окружения для GPU и кеша (до импорта torch)
+os.environ["LTX_DAEMON_DEVICE"] = str(args.device)
+os.environ['CUDA_VISIBLE_DEVICES'] = str(args.device)
+# Таймлайн старта рядом с daemon_ready.flag, по файлу на демон (как и логи)
+os.environ.setdefault(
+    "LTX_STARTUP_TIMELINE",
+    "startup_timeline.json" if str(args.device) == "0" else f"startup_timeline_gpu{args.device}.json",
+)
 os.environ["HF_HOME"] = "/workspace/.cache/huggingface"  # Путь к кешу в workspace
 os.environ["HUGGINGFACE_HUB_CACHE"] = os.environ["HF_HOME"]
 os.environ["TRANSFORMERS_CACHE"] = os.environ["HF_HOME"]
@@ -1,10 +1,14 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import base64
+import glob
 import os
+import uuid
 from celery.result import AsyncResult
 from my_celery import celery_app
+import coalescing
+import metrics
 
 app = FastAPI()
 
@@ -26,18 +30,44 @@ async def generate(
     num_frames: int = Form(96),
     seed: int = Form(42),
     image: UploadFile = File(None),
+    priority: str = Form("normal"),
+    deadline_seconds: float = Form(None),
+    preview: str = Form(None),
+    idempotency_key: str = Form(None),
+    oversize: str = Form(None),
+    vae_tiling: str = Form(None),
 ):
     image_base64 = None
     if image is not None:
         image_bytes = await image.read()
         image_base64 = base64.b64encode(image_bytes).decode("utf-8")
     
+    # Такой же запрос уже в очереди или в работе — отдаём его task_id, а не занимаем ещё один GPU
+    task_id = uuid.uuid4().hex
+    coalescer = coalescing.task_coalescer(celery_app)
+    if coalescer is not None:
+        try:
+            key = coalescing.coalesce_key({
+                "prompt": prompt, "negative_prompt": negative_prompt, "image_base64": image_base64,
+                "height": expected_height, "width": expected_width, "num_frames": num_frames, "seed": seed,
+                "idempotency_key": idempotency_key, "oversize": oversize, "vae_tiling": vae_tiling,
+            })
+            leader_id = coalescer.submit(key, task_id, lambda existing: not AsyncResult(existing, app=celery_app).ready())
+            if leader_id != task_id:
+                return {"task_id": leader_id, "coalesced": True}
+        except Exception as e:
+            print(f"⚠️ Склейка запросов недоступна: {e}")
+    
     # Отправляем задачу через Celery клиент
     task = celery_app.send_task(
         'celery_task.generate_video_inference_task',
-        args=[prompt, negative_prompt, image_base64, expected_width, expected_height, num_frames, seed]
+        args=[prompt, negative_prompt, image_base64, expected_width, expected_height, num_frames, seed],
+        kwargs={"priority": priority, "deadline_seconds": deadline_seconds, "preview": preview,
+                "idempotency_key": idempotency_key, "oversize": oversize,
+                "vae_tiling": vae_tiling},
+        task_id=task_id,
     )
-    return {"task_id": task.id}
+    return {"task_id": task.id, "coalesced": False}
 
 @app.get("/status/{task_id}")
 async def get_task_status(task_id: str):
@@ -46,7 +76,10 @@ async def get_task_status(task_id: str):
     return {
         "task_id": task_id,
         "status": task_result.status,
-        "result": task_result.result if task_result.ready() else None
+        # Пока задача не готова, в result — служебные данные (например, позиция в очереди для QUEUED)
+        "result": task_result.result if task_result.ready() else (
+            task_result.info if isinstance(task_result.info, dict) else None
+        )
     }
 
 @app.get("/video/{filename:path}")
@@ -63,6 +96,35 @@ async def get_video(filename: str):
         filename=os.path.basename(filename)
     )
 
+@app.get("/health")
+async def health():
+    """Готовность демонов и таймлайны их холодного старта"""
+    import startup_timeline
+    timelines = {
+        os.path.basename(path): startup_timeline.load(path)
+        for path in sorted(glob.glob(os.path.join(os.getcwd(), "startup_timeline*.json")))
+    }
+    coalescer = coalescing.task_coalescer(celery_app)
+    try:
+        coalescing_stats = coalescer.stats() if coalescer is not None else None
+    except Exception:
+        coalescing_stats = None
+    return {
+        "daemon_ready": os.path.exists(os.path.join(os.getcwd(), "daemon_ready.flag")),
+        "coalescing": coalescing_stats,
+        "build_id": startup_timeline.BUILD_ID,
+        "startup_timelines": timelines,
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Метрики Prometheus: демоны пода (очередь, задачи в работе, память GPU, кеши) и очередь Celery"""
+    # Не async: статусы демонов запрашиваются по сокетам, в пуле потоков, а не в event loop
+    if not metrics.available():
+        raise HTTPException(status_code=503, detail="prometheus_client не установлен или LTX_METRICS=0")
+    body, content_type = metrics.render(metrics.api_registry(celery_app))
+    return Response(content=body, media_type=content_type)
+
 @app.get("/")
 async def root():
     """Корневой endpoint"""
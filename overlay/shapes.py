@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+Размеры, с которыми реально работает модель
+Высота/ширина дополняются до кратных 32, число кадров — до 8k + 1 (как в ltx_video.inference).
+Один и тот же padded размер = одна «корзина» (bucket) для батчей, планировщика и статистики.
+"""
+
+
+def padded_shape(height, width, num_frames):
+    """(height_padded, width_padded, num_frames_padded)"""
+    height_padded = ((int(height) - 1) // 32 + 1) * 32
+    width_padded = ((int(width) - 1) // 32 + 1) * 32
+    num_frames_padded = ((int(num_frames) - 2) // 8 + 1) * 8 + 1
+    return height_padded, width_padded, num_frames_padded
+
+
+def bucket_name(bucket):
+    """(h, w, f) -> 'HxWxF' для логов и метрик"""
+    return "x".join(str(v) for v in bucket)
+
+
+def parse_bucket(text):
+    """'HxWxF' -> padded (h, w, f)"""
+    height, width, num_frames = (int(v) for v in text.lower().split("x"))
+    return padded_shape(height, width, num_frames)
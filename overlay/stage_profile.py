@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Профиль задачи по этапам: время и пик памяти GPU на каждом этапе
+Этапы: input_decode -> conditioning -> prompt_enhance -> text_encode -> first_pass -> latent_upsample
+-> second_pass (у single-scale — denoise) -> vae_decode -> tensor_to_host -> encode -> upload -> base64.
+Время этапа — собственное: вложенные замеры (копия кадров на хост внутри кодирования) из него вычитаются.
+Границы этапов внутри pipeline — подмена _upsample_latents и vae_decode на время вызова;
+на границах — torch.cuda.synchronize (LTX_PROFILE_SYNC), иначе работа GPU уезжает в следующий этап.
+Декодирование превью первого прохода попадает в latent_upsample, загрузка в S3 идёт параллельно
+с кодированием — upload показывает только ожидание последних частей.
+Профиль возвращается в ответе rp_handler и в результате демона ('profile').
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import memory_model
+
+logger = logging.getLogger(__name__)
+
+STAGES = (
+    "input_decode", "conditioning", "prompt_enhance", "text_encode",
+    "first_pass", "latent_upsample", "second_pass", "denoise", "vae_decode",
+    "tensor_to_host", "encode", "upload", "base64",
+)
+PROFILE_SYNC = os.environ.get("LTX_PROFILE_SYNC", "1") == "1"
+
+
+def _synchronize():
+    if not PROFILE_SYNC:
+        return
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class _Frame:
+    __slots__ = ("name", "started_at", "meter", "nested")
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.meter = memory_model.PeakMeter(None, name, None)
+        self.meter.__enter__()
+        self.nested = 0.0
+
+
+class StageProfile:
+    """Профиль одного вызова (задачи или батча): with profile.stage(name), switch(name), timed_iter()"""
+
+    def __init__(self, batch_size=1):
+        self.batch_size = batch_size
+        self.stages = {}
+        self.started_at = time.perf_counter()
+        self._stack = []
+        self._running = None
+        self._lock = threading.Lock()
+
+    def _record(self, name, seconds, peak_allocated=None):
+        with self._lock:
+            entry = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "peak_allocated": None})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            if peak_allocated is not None:
+                entry["peak_allocated"] = max(entry["peak_allocated"] or 0, peak_allocated)
+            if self._stack:
+                self._stack[-1].nested += seconds
+
+    def _open(self, name):
+        frame = _Frame(name)
+        self._stack.append(frame)
+        return frame
+
+    def _close(self, frame, exc_type=None):
+        _synchronize()
+        frame.meter.__exit__(exc_type, None, None)
+        self._stack.remove(frame)
+        elapsed = time.perf_counter() - frame.started_at
+        self._record(frame.name, max(elapsed - frame.nested, 0.0), frame.meter.peak_allocated)
+
+    @contextmanager
+    def stage(self, name):
+        frame = self._open(name)
+        try:
+            yield self
+        except BaseException as e:
+            self._close(frame, type(e))
+            raise
+        self._close(frame)
+
+    def switch(self, name):
+        """Последовательные этапы: закрываем текущий и открываем name (None — только закрыть)"""
+        if self._running is not None:
+            self._close(self._running)
+            self._running = None
+        if name is not None:
+            self._running = self._open(name)
+
+    def timed_iter(self, name, iterable):
+        """Время ожидания следующего элемента — в этап name (вычитается из объемлющего этапа)"""
+        waited = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started_at = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.perf_counter() - started_at
+                yield item
+        finally:
+            self._record(name, waited)
+
+    @contextmanager
+    def pipeline_stages(self, pipeline):
+        """На время вызова pipeline: проходы, апсемплинг латентов и декодирование VAE — отдельными этапами"""
+        import ltx_video.pipelines.pipeline_ltx_video as pipeline_module
+
+        multi_scale = hasattr(pipeline, "video_pipeline")
+        original_decode = pipeline_module.vae_decode
+
+        def decode(*args, **kwargs):
+            self.switch("vae_decode")
+            return original_decode(*args, **kwargs)
+
+        # Поверх превью (PreviewHook тоже подменяет _upsample_latents атрибутом экземпляра)
+        had_upsample = "_upsample_latents" in vars(pipeline)
+        original_upsample = getattr(pipeline, "_upsample_latents", None)
+
+        def upsample(latent_upsampler, latents):
+            self.switch("latent_upsample")
+            result = original_upsample(latent_upsampler, latents)
+            self.switch("second_pass")
+            return result
+
+        if multi_scale:
+            pipeline._upsample_latents = upsample
+        pipeline_module.vae_decode = decode
+        self.switch("first_pass" if multi_scale else "denoise")
+        try:
+            yield self
+        finally:
+            self.switch(None)
+            pipeline_module.vae_decode = original_decode
+            if multi_scale:
+                if had_upsample:
+                    pipeline._upsample_latents = original_upsample
+                else:
+                    del pipeline._upsample_latents
+
+    def to_dict(self):
+        order = {name: index for index, name in enumerate(STAGES)}
+        stages = {}
+        with self._lock:
+            for name in sorted(self.stages, key=lambda n: order.get(n, len(order))):
+                entry = self.stages[name]
+                stages[name] = {"seconds": round(entry["seconds"], 3)}
+                if entry["peak_allocated"] is not None:
+                    stages[name]["peak_gb"] = round(entry["peak_allocated"] / 1024 ** 3, 2)
+                if entry["calls"] > 1:
+                    stages[name]["calls"] = entry["calls"]
+        return {
+            "stages": stages,
+            "total_seconds": round(time.perf_counter() - self.started_at, 3),
+            "batch_size": self.batch_size,
+        }
+
+    def summary(self):
+        """Строка для лога: этап=секунды"""
+        return ", ".join(f"{name}={entry['seconds']:.2f}с" for name, entry in self.to_dict()["stages"].items())
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Таймлайн холодного старта
+Фазы запуска (импорты, конфиг, компоненты моделей, перенос на устройство, прогрев, первый запрос)
+с wall/CPU временем и приростом RSS и памяти устройства. Пишется JSON рядом с daemon_ready.flag
+и отдаётся в статусе — чтобы сравнивать холодный старт между сборками образа.
+Импортируется до torch: фаза "imports" считается от загрузки этого модуля.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+TIMELINE_FILE = os.environ.get("LTX_STARTUP_TIMELINE", "startup_timeline.json")
+# Тайминги entrypoint.sh (проверка/загрузка весов) — пишет сам entrypoint
+ENTRYPOINT_TIMELINE = os.environ.get("LTX_ENTRYPOINT_TIMELINE", "/tmp/ltx_entrypoint_timeline.json")
+# Идентификатор сборки образа (Dockerfile: ARG LTX_BUILD_ID)
+BUILD_ID = os.environ.get("LTX_BUILD_ID", "dev")
+
+_MODULE_LOADED_AT = time.time()
+_MODULE_LOADED_CPU = time.process_time()
+
+
+def process_started_at():
+    """Время старта процесса (unix time) по /proc; иначе — время загрузки модуля"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _MODULE_LOADED_AT
+
+
+def rss_bytes():
+    """Текущий RSS процесса"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def device_memory_bytes():
+    """allocated/reserved на устройстве; CUDA не инициализируем ради замера"""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return None
+    try:
+        if not torch.cuda.is_initialized():
+            return None
+        return {"allocated": torch.cuda.memory_allocated(), "reserved": torch.cuda.memory_reserved()}
+    except Exception:
+        return None
+
+
+def _snapshot():
+    return {
+        "wall": time.time(),
+        "cpu": time.process_time(),
+        "rss": rss_bytes(),
+        "device": device_memory_bytes(),
+    }
+
+
+def _gb(value):
+    return round(value / 1024 ** 3, 3)
+
+
+class StartupTimeline:
+    """Фазы старта процесса; потокобезопасно (компоненты грузятся параллельно)
+
+    CPU время и дельты памяти — по всему процессу, у параллельных фаз они пересекаются.
+    """
+
+    def __init__(self, path=TIMELINE_FILE):
+        self.path = path
+        self.process_started_at = process_started_at()
+        self.phases = []
+        self.events = {}
+        self.ready_at = None
+        self._lock = threading.Lock()
+
+    def _record(self, name, before, after, parent=None, **fields):
+        entry = {
+            "name": name,
+            "started_at": before["wall"],
+            "offset_seconds": round(before["wall"] - self.process_started_at, 3),
+            "wall_seconds": round(after["wall"] - before["wall"], 3),
+            "cpu_seconds": round(after["cpu"] - before["cpu"], 3),
+            "rss_gb": _gb(after["rss"]),
+            "rss_delta_gb": _gb(after["rss"] - before["rss"]),
+        }
+        if parent:
+            entry["parent"] = parent
+        if after["device"] is not None:
+            before_device = before["device"] or {"allocated": 0, "reserved": 0}
+            entry["device_allocated_gb"] = _gb(after["device"]["allocated"])
+            entry["device_allocated_delta_gb"] = _gb(after["device"]["allocated"] - before_device["allocated"])
+            entry["device_reserved_delta_gb"] = _gb(after["device"]["reserved"] - before_device["reserved"])
+        entry.update(fields)
+        with self._lock:
+            self.phases.append(entry)
+        logger.info(
+            f"⏱️ [startup] {name}: {entry['wall_seconds']:.2f}с wall, {entry['cpu_seconds']:.2f}с CPU, "
+            f"RSS {entry['rss_delta_gb']:+.2f}GB"
+        )
+        return entry
+
+    @contextmanager
+    def phase(self, name, parent=None, **fields):
+        before = _snapshot()
+        try:
+            yield
+        finally:
+            self._record(name, before, _snapshot(), parent=parent, **fields)
+
+    def record_since_import(self, name="imports"):
+        """Фаза от загрузки этого модуля до текущего момента (импорты torch/ltx_video)"""
+        before = {"wall": _MODULE_LOADED_AT, "cpu": _MODULE_LOADED_CPU, "rss": 0, "device": None}
+        return self._record(name, before, _snapshot())
+
+    def event(self, name, **fields):
+        """Разовое событие (ready, первый запрос) — один раз за процесс"""
+        with self._lock:
+            if name in self.events:
+                return
+            self.events[name] = {
+                "at": time.time(),
+                "offset_seconds": round(time.time() - self.process_started_at, 3),
+                **fields,
+            }
+        self.save()
+
+    def mark_ready(self):
+        self.ready_at = time.time()
+        self.event("ready")
+
+    def external_phases(self):
+        """Фазы entrypoint.sh, если он их записал"""
+        try:
+            with open(ENTRYPOINT_TIMELINE) as f:
+                return json.load(f).get("phases", [])
+        except (OSError, ValueError):
+            return []
+
+    def to_dict(self):
+        with self._lock:
+            phases = list(self.phases)
+            events = dict(self.events)
+        return {
+            "build_id": BUILD_ID,
+            "pid": os.getpid(),
+            "process_started_at": self.process_started_at,
+            "ready_seconds": round(self.ready_at - self.process_started_at, 3) if self.ready_at else None,
+            "entrypoint": self.external_phases(),
+            "phases": phases,
+            "events": events,
+        }
+
+    def save(self, path=None):
+        path = path or self.path
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось записать таймлайн старта {path}: {e}")
+
+
+def load(path=TIMELINE_FILE):
+    """Прочитать сохранённый таймлайн (для /health и статусов других процессов)"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Один таймлайн на процесс
+timeline = StartupTimeline()
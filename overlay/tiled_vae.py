@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Декодирование VAE тайлами и кусками по времени
+На 1280x720x121 и больше пик памяти — не denoising, а декодирование всего латентного видео
+одним куском. Здесь латенты режутся на пространственные тайлы и временные куски с перекрытием,
+каждый кусок декодируется штатным vae_decode, результаты смешиваются линейными весами на
+перекрытиях (веса раскладываются по осям, поэтому нормировка — без буфера размером с видео).
+Кадры: латентный кадр c у LTX VAE соответствует кадру видео 8c (каждый временной x2 апсемплинг
+отбрасывает первый кадр), кусок латентов [c, e) даёт кадры [8c, 8(e - 1)].
+Размер тайла выбирается по свободной памяти и модели пика декодирования (memory_model, вид
+"vae_decode"): в режиме auto видео, которое помещается целиком, декодируется как раньше.
+Режим — LTX_VAE_TILING или поле запроса vae_tiling: off / auto / on.
+Проверка швов против декодирования целиком: python tiled_vae.py --check
+"""
+
+import os
+import json
+import logging
+
+import memory_model
+
+logger = logging.getLogger(__name__)
+
+TILING_MODES = ("off", "auto", "on")
+VAE_TILING = os.environ.get("LTX_VAE_TILING", "auto")
+# Перекрытие в латентах: по пространству (x32 пикселей) и по времени (x8 кадров)
+TILE_OVERLAP = int(os.environ.get("LTX_VAE_TILE_OVERLAP", "4"))
+FRAME_OVERLAP = int(os.environ.get("LTX_VAE_FRAME_OVERLAP", "2"))
+# Режим on: тайл не больше этого (латенты: сторона, кадры), даже если память позволяет больше
+MAX_TILE = int(os.environ.get("LTX_VAE_MAX_TILE", "16"))
+MAX_TILE_FRAMES = int(os.environ.get("LTX_VAE_MAX_TILE_FRAMES", "8"))
+# До такой стороны тайла (латенты) сначала режем пространство, потом время, потом снова пространство
+PREFERRED_MIN_TILE = 16
+MIN_TILE = 2 * TILE_OVERLAP or 2
+MIN_TILE_FRAMES = FRAME_OVERLAP + 2
+# check(): минимальный PSNR тайлов против декодирования целиком (ниже — швы видны, проверка не пройдена)
+CHECK_MIN_PSNR_DB = float(os.environ.get("LTX_VAE_CHECK_MIN_PSNR", "32"))
+
+
+def parse_mode(value):
+    """'off' / 'auto' / 'on' (или True/False); None — режим по умолчанию"""
+    if value is None or value == "":
+        value = VAE_TILING
+    if value is True:
+        return "on"
+    if value is False:
+        return "off"
+    mode = str(value).strip().lower()
+    if mode in ("0", "false", "no", "none"):
+        return "off"
+    if mode in ("1", "true", "yes"):
+        return "on"
+    if mode not in TILING_MODES:
+        raise ValueError(f"vae_tiling: ожидается одно из {TILING_MODES}, получено {value!r}")
+    return mode
+
+
+def cache_identity(value):
+    """Режим и параметры тайлов для ключа кеша результатов: тайлы лишь приближают декодирование целиком"""
+    try:
+        mode = parse_mode(value)
+    except ValueError:
+        # Демон выполняет такую задачу в режиме по умолчанию
+        mode = parse_mode(None)
+    if mode == "off":
+        return {"mode": mode}
+    return {
+        "mode": mode,
+        "tile_overlap": TILE_OVERLAP,
+        "frame_overlap": FRAME_OVERLAP,
+        "max_tile": MAX_TILE,
+        "max_tile_frames": MAX_TILE_FRAMES,
+    }
+
+
+def strongest_mode(modes):
+    """Один режим на батч: on > auto > off"""
+    return max(modes, key=TILING_MODES.index, default=parse_mode(None))
+
+
+def output_shape(latent_shape, temporal_scale, spatial_scale):
+    """(кадры, высота, ширина) латентов -> (высота, ширина, кадры) видео"""
+    frames, height, width = latent_shape
+    return height * spatial_scale, width * spatial_scale, 1 + temporal_scale * (frames - 1)
+
+
+def choose_tile(latent_shape, budget_voxels, temporal_scale, spatial_scale, mode="auto"):
+    """Размер тайла в латентах (кадры, высота, ширина); None — декодировать целиком
+
+    budget_voxels — сколько вокселей выходного видео помещается в память за один вызов декодера.
+    """
+    frames, height, width = latent_shape
+    tile_f, tile_h, tile_w = frames, height, width
+    if mode == "on":
+        tile_f, tile_h, tile_w = min(frames, MAX_TILE_FRAMES), min(height, MAX_TILE), min(width, MAX_TILE)
+
+    def fits():
+        h, w, f = output_shape((tile_f, tile_h, tile_w), temporal_scale, spatial_scale)
+        return h * w * f <= budget_voxels
+
+    # Пространство до PREFERRED_MIN_TILE, затем время, затем пространство до MIN_TILE
+    while not fits():
+        if max(tile_h, tile_w) > PREFERRED_MIN_TILE:
+            if tile_h >= tile_w:
+                tile_h = max(PREFERRED_MIN_TILE, tile_h * 3 // 4)
+            else:
+                tile_w = max(PREFERRED_MIN_TILE, tile_w * 3 // 4)
+        elif tile_f > MIN_TILE_FRAMES:
+            tile_f = max(MIN_TILE_FRAMES, tile_f * 3 // 4)
+        elif max(tile_h, tile_w) > MIN_TILE:
+            tile_h = max(MIN_TILE, tile_h * 3 // 4)
+            tile_w = max(MIN_TILE, tile_w * 3 // 4)
+        else:
+            logger.warning(f"⚠️ VAE: даже минимальный тайл не помещается в {budget_voxels / 1e6:.1f}M вокселей")
+            break
+    tile = (min(tile_f, frames), min(tile_h, height), min(tile_w, width))
+    return None if tile == (frames, height, width) else tile
+
+
+def _ranges(size, tile, overlap):
+    """Начала и концы тайлов вдоль оси (последний прижат к концу)"""
+    if tile >= size:
+        return [(0, size)]
+    step = max(tile - overlap, 1)
+    starts = list(range(0, size - tile, step)) + [size - tile]
+    return [(start, start + tile) for start in starts]
+
+
+def _weights(pixel_ranges, device):
+    """Вес каждого тайла вдоль оси: линейные рампы на перекрытиях с соседями"""
+    import torch
+
+    weights = []
+    for index, (start, end) in enumerate(pixel_ranges):
+        weight = torch.ones(end - start, device=device, dtype=torch.float32)
+        if index > 0:
+            lead = pixel_ranges[index - 1][1] - start
+            if lead > 0:
+                weight[:lead] = torch.arange(1, lead + 1, device=device, dtype=torch.float32) / (lead + 1)
+        if index + 1 < len(pixel_ranges):
+            tail = end - pixel_ranges[index + 1][0]
+            if tail > 0:
+                ramp = torch.arange(tail, 0, -1, device=device, dtype=torch.float32) / (tail + 1)
+                weight[-tail:] = torch.minimum(weight[-tail:], ramp)
+        weights.append(weight)
+    return weights
+
+
+def _normalizer(pixel_ranges, weights, size, device):
+    import torch
+
+    total = torch.zeros(size, device=device, dtype=torch.float32)
+    for (start, end), weight in zip(pixel_ranges, weights):
+        total[start:end] += weight
+    return total
+
+
+def tiled_decode(latents, vae, tile, decode_fn=None, overlap=TILE_OVERLAP, frame_overlap=FRAME_OVERLAP, **decode_kwargs):
+    """Декодирование тайлами: тот же результат, что decode_fn(latents, vae, **decode_kwargs), кусками"""
+    import torch
+    from ltx_video.models.autoencoders.vae_encode import vae_decode, get_vae_size_scale_factor
+
+    decode_fn = decode_fn or vae_decode
+    temporal_scale, spatial_scale, _ = get_vae_size_scale_factor(vae)
+    batch, _, frames, height, width = latents.shape
+    tile_f, tile_h, tile_w = tile
+    device = latents.device
+
+    # Соседние куски должны делить хотя бы латентный кадр, иначе между [8c, 8(e - 1)] остаются дыры
+    frame_ranges = _ranges(frames, tile_f, max(frame_overlap, 1))
+    height_ranges = _ranges(height, tile_h, overlap)
+    width_ranges = _ranges(width, tile_w, overlap)
+    # Латенты -> пиксели: кадры [8c, 8(e - 1)], пространство x32
+    pixel_frames = [(temporal_scale * start, temporal_scale * (end - 1) + 1) for start, end in frame_ranges]
+    pixel_heights = [(spatial_scale * start, spatial_scale * end) for start, end in height_ranges]
+    pixel_widths = [(spatial_scale * start, spatial_scale * end) for start, end in width_ranges]
+    out_height, out_width, out_frames = output_shape((frames, height, width), temporal_scale, spatial_scale)
+
+    frame_weights = _weights(pixel_frames, device)
+    height_weights = _weights(pixel_heights, device)
+    width_weights = _weights(pixel_widths, device)
+
+    output = None
+    for (f0, f1), (pf0, pf1), wf in zip(frame_ranges, pixel_frames, frame_weights):
+        for (y0, y1), (py0, py1), wh in zip(height_ranges, pixel_heights, height_weights):
+            for (x0, x1), (px0, px1), ww in zip(width_ranges, pixel_widths, width_weights):
+                decoded = decode_fn(latents[:, :, f0:f1, y0:y1, x0:x1], vae, **decode_kwargs)
+                if output is None:
+                    output_dtype = decoded.dtype
+                    output = torch.zeros(
+                        (batch, decoded.shape[1], out_frames, out_height, out_width), device=device, dtype=torch.float32
+                    )
+                weight = wf[:, None, None] * wh[None, :, None] * ww[None, None, :]
+                output[:, :, pf0:pf1, py0:py1, px0:px1].add_(decoded.float() * weight)
+                del decoded
+
+    # Веса раскладываются по осям — нормировка тоже
+    output /= _normalizer(pixel_frames, frame_weights, out_frames, device)[:, None, None]
+    output /= _normalizer(pixel_heights, height_weights, out_height, device)[None, :, None]
+    output /= _normalizer(pixel_widths, width_weights, out_width, device)[None, None, :]
+    return output.to(output_dtype)
+
+
+class TiledDecode:
+    """На время вызова pipeline подменяет vae_decode модуля pipeline_ltx_video
+
+    meter — memory_model.PeakMeter вызова pipeline: если декодирование пошло тайлами, его замер
+    уходит в отдельный вид модели ("<тип pipeline>/tiled_vae"), пик там задаёт denoising.
+    """
+
+    def __init__(self, mode, meter=None):
+        self.mode = mode
+        self.meter = meter
+        self.tiled = False
+        self.tile = None
+        self._module = None
+        self._original = None
+
+    def __enter__(self):
+        if self.mode == "off":
+            return self
+        import ltx_video.pipelines.pipeline_ltx_video as pipeline_module
+
+        self._module = pipeline_module
+        self._original = pipeline_module.vae_decode
+        pipeline_module.vae_decode = self._decode
+        return self
+
+    def _decode(self, latents, vae, is_video=True, split_size=1, vae_per_channel_normalize=False, timestep=None):
+        import torch
+        from ltx_video.models.autoencoders.vae_encode import get_vae_size_scale_factor
+
+        kwargs = dict(is_video=is_video, vae_per_channel_normalize=vae_per_channel_normalize, timestep=timestep)
+        if latents.dim() != 5:
+            return self._original(latents, vae, split_size=split_size, **kwargs)
+        temporal_scale, spatial_scale, _ = get_vae_size_scale_factor(vae)
+        batch = latents.shape[0]
+        latent_shape = tuple(latents.shape[2:])
+        out_shape = output_shape(latent_shape, temporal_scale, spatial_scale)
+
+        budget = float("inf")
+        if torch.cuda.is_available():
+            _, available_now = memory_model.memory_state(latents.device)
+            # Минус буфер результата (float32) — он живёт всё время декодирования тайлами
+            accumulator = batch * 3 * memory_model.voxels(out_shape) * 4
+            budget = memory_model.model.max_voxels("vae_decode", available_now - accumulator) / batch
+        tile = choose_tile(latent_shape, budget, temporal_scale, spatial_scale, self.mode)
+        if tile is None:
+            with memory_model.PeakMeter(memory_model.model, "vae_decode", out_shape, batch):
+                return self._original(latents, vae, split_size=split_size, **kwargs)
+
+        self.tiled, self.tile = True, tile
+        if self.meter is not None and not self.meter.kind.endswith("/tiled_vae"):
+            self.meter.kind = f"{self.meter.kind}/tiled_vae"
+        tile_shape = output_shape(tile, temporal_scale, spatial_scale)
+        logger.info(
+            f"🧩 VAE тайлами: латенты {latent_shape} -> тайл {tile} "
+            f"({tile_shape[1]}x{tile_shape[0]}x{tile_shape[2]} пикселей), режим {self.mode}"
+        )
+        meter = memory_model.PeakMeter(memory_model.model, "vae_decode", tile_shape, batch)
+        first = [True]
+
+        def decode_tile(tile_latents, tile_vae, **tile_kwargs):
+            # Пик замеряем на первом (полноразмерном) тайле — он пополняет модель декодирования
+            if first[0]:
+                first[0] = False
+                with meter:
+                    return self._original(tile_latents, tile_vae, **tile_kwargs)
+            return self._original(tile_latents, tile_vae, **tile_kwargs)
+
+        return tiled_decode(latents, vae, tile, decode_fn=decode_tile, **kwargs)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._module is not None:
+            self._module.vae_decode = self._original
+            self._module = None
+        return False
+
+
+def admission_kind(pipeline, mode):
+    """Вид модели памяти для допуска: с тайлами VAE пик задаёт denoising (если есть его замеры)"""
+    kind = memory_model.pipeline_type(pipeline)
+    if mode != "off" and memory_model.model.samples.get(f"{kind}/tiled_vae"):
+        return f"{kind}/tiled_vae"
+    return kind
+
+
+def check(height=512, width=768, num_frames=49, seed=0, pipeline_config_path="ltxv-13b-0.9.8-distilled.yaml",
+          min_psnr_db=CHECK_MIN_PSNR_DB):
+    """Швы: декодирование тайлами (размер как в режиме on) против целиком на одних и тех же латентах
+
+    -> отчёт; passed=False, если PSNR ниже min_psnr_db.
+    """
+    import yaml
+    import torch
+    from parallel_loader import load_vae
+    from ltx_video.models.autoencoders.vae_encode import vae_decode, get_vae_size_scale_factor
+
+    with open(pipeline_config_path) as f:
+        pipeline_config = yaml.safe_load(f)
+    vae = load_vae(pipeline_config["checkpoint_path"], "cuda")
+    temporal_scale, spatial_scale, _ = get_vae_size_scale_factor(vae)
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    latents = torch.randn(
+        (1, vae.config.latent_channels, (num_frames - 1) // temporal_scale + 1, height // spatial_scale, width // spatial_scale),
+        generator=generator,
+    ).to("cuda", dtype=vae.dtype)
+    timestep = None
+    if getattr(vae.decoder, "timestep_conditioning", False):
+        timestep = torch.tensor([pipeline_config.get("decode_timestep", 0.05)], device="cuda")
+    kwargs = dict(is_video=True, vae_per_channel_normalize=True, timestep=timestep)
+    tile = (min(latents.shape[2], MAX_TILE_FRAMES), min(latents.shape[3], MAX_TILE), min(latents.shape[4], MAX_TILE))
+    with torch.no_grad():
+        full = vae_decode(latents, vae, **kwargs).float()
+        tiled = tiled_decode(latents, vae, tile, **kwargs).float()
+    error = (full - tiled).abs()
+    # Значения в [-1, 1]: пиковый сигнал 2
+    mse = float((error ** 2).mean())
+    psnr_db = float(10 * torch.log10(torch.tensor(4.0 / mse))) if mse > 0 else float("inf")
+    return {
+        "shape": [height, width, num_frames],
+        "tile": list(tile),
+        "max_abs_error": float(error.max()),
+        "mean_abs_error": float(error.mean()),
+        "psnr_db": psnr_db,
+        "min_psnr_db": min_psnr_db,
+        "passed": psnr_db >= min_psnr_db,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Декодирование VAE тайлами")
+    parser.add_argument("--check", action="store_true", help="Сравнить со швами декодирование целиком")
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--width", type=int, default=768)
+    parser.add_argument("--num-frames", type=int, default=49)
+    parser.add_argument("--min-psnr", type=float, default=CHECK_MIN_PSNR_DB, help="Порог PSNR, дБ")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.check:
+        report = check(args.height, args.width, args.num_frames, min_psnr_db=args.min_psnr)
+        print(json.dumps(report, indent=2))
+        if not report["passed"]:
+            logger.error(f"❌ Швы: PSNR {report['psnr_db']:.1f}дБ ниже порога {report['min_psnr_db']:.1f}дБ")
+            raise SystemExit(1)
+        logger.info(f"✅ Швы: PSNR {report['psnr_db']:.1f}дБ")
+    else:
+        parser.print_help()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Потоковая запись MP4 через ffmpeg pipe
+Кадры подаются кусками (uint8, N x H x W x 3), память хоста ограничена размером куска.
+Выход — путь к файлу или любой объект с .write() (BytesIO, поток загрузки и т.п.).
+"""
+
+import io
+import os
+import subprocess
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Параметры как у imageio.mimsave по умолчанию (libx264, yuv420p, quality=5 -> crf 25)
+DEFAULT_CRF = int(os.environ.get("LTX_VIDEO_CRF", "25"))
+DEFAULT_PRESET = os.environ.get("LTX_VIDEO_PRESET", "medium")
+# Сколько кадров переводим в uint8 и отдаём ffmpeg за раз
+ENCODE_CHUNK_FRAMES = int(os.environ.get("LTX_ENCODE_CHUNK_FRAMES", "16"))
+
+_READ_SIZE = 1024 * 1024
+
+
+def get_ffmpeg_exe():
+    """ffmpeg из imageio-ffmpeg, иначе системный"""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+
+class StreamingMp4Writer:
+    """Кодирует кадры в MP4 по мере поступления, не собирая всё видео в памяти"""
+
+    def __init__(self, output, width, height, fps, crf=DEFAULT_CRF, preset=DEFAULT_PRESET):
+        self.width = int(width)
+        self.height = int(height)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self._sink = None
+        self._reader = None
+        self._sink_error = None
+        self._stderr_tail = []
+
+        cmd = [
+            get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", f"{self.width}x{self.height}", "-r", str(fps),
+            "-i", "pipe:0",
+            "-an", "-vcodec", "libx264", "-pix_fmt", "yuv420p",
+            "-crf", str(crf), "-preset", preset,
+            # yuv420p требует чётных размеров
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        ]
+        if isinstance(output, (str, os.PathLike)):
+            # Файл можно перематывать — обычный MP4 с moov в начале
+            cmd += ["-movflags", "+faststart", "-f", "mp4", str(output)]
+            stdout = subprocess.DEVNULL
+        else:
+            # Поток перематывать нельзя — фрагментированный MP4
+            cmd += ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+            stdout = subprocess.PIPE
+            self._sink = output
+
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.PIPE)
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+        if self._sink is not None:
+            self._reader = threading.Thread(target=self._drain_stdout, daemon=True)
+            self._reader.start()
+
+    def _drain_stdout(self):
+        while True:
+            chunk = self._proc.stdout.read(_READ_SIZE)
+            if not chunk:
+                break
+            if self._sink_error is not None:
+                continue
+            try:
+                self._sink.write(chunk)
+            except Exception as e:
+                # Приёмник отказал (например, часть загрузки): без чтения stdout ffmpeg встанет,
+                # а с ним и write() — останавливаем ffmpeg, ошибку отдадим в write()/close()
+                self._sink_error = e
+                self._proc.kill()
+                continue
+            self.bytes_written += len(chunk)
+
+    def _raise_sink_error(self):
+        if self._sink_error is not None:
+            raise RuntimeError(f"Ошибка записи результата: {self._sink_error}") from self._sink_error
+
+    def _drain_stderr(self):
+        for line in self._proc.stderr:
+            self._stderr_tail = (self._stderr_tail + [line.decode(errors="replace").rstrip()])[-20:]
+
+    def write(self, frames):
+        """Пишем кусок кадров uint8 формы (N, H, W, 3)"""
+        if frames.shape[1:] != (self.height, self.width, 3):
+            raise ValueError(f"Неверная форма кадров: {frames.shape}, ожидается (N, {self.height}, {self.width}, 3)")
+        self._raise_sink_error()
+        try:
+            # memoryview без лишней копии, если массив уже непрерывный
+            self._proc.stdin.write(memoryview(frames).cast("B") if frames.flags["C_CONTIGUOUS"] else frames.tobytes())
+        except BrokenPipeError:
+            self._proc.wait()
+            if self._reader is not None:
+                self._reader.join()
+            self._raise_sink_error()
+            raise RuntimeError(f"ffmpeg завершился: {' | '.join(self._stderr_tail)}")
+        self.frames_written += frames.shape[0]
+
+    def close(self):
+        if self._proc.stdin and not self._proc.stdin.closed:
+            self._proc.stdin.close()
+        returncode = self._proc.wait()
+        if self._reader is not None:
+            self._reader.join()
+        self._stderr_thread.join()
+        self._raise_sink_error()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg вернул код {returncode}: {' | '.join(self._stderr_tail)}")
+
+    def abort(self):
+        self._proc.kill()
+        self._proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            return False
+        self.close()
+        return False
+
+
+def encode_mp4_bytes(frame_chunks, width, height, fps):
+    """Кодируем поток кусков кадров в MP4 прямо в память"""
+    buffer = io.BytesIO()
+    with StreamingMp4Writer(buffer, width, height, fps) as writer:
+        for chunk in frame_chunks:
+            writer.write(chunk)
+    return buffer.getvalue()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Прогрев pipeline после загрузки моделей
+Прогоняем генерацию на частых размерах (bucket'ах), чтобы автотюнинг cuDNN, рост аллокатора
+и ленивая загрузка ядер случились до первой реальной задачи, а не во время неё.
+Опционально трансформер и VAE компилируются через torch.compile; кеш inductor/triton
+лежит на /runpod-volume и переиспользуется следующими холодными стартами.
+"""
+
+import os
+import time
+import logging
+import threading
+
+import torch
+
+from shapes import parse_bucket, bucket_name
+
+logger = logging.getLogger(__name__)
+
+# Через запятую, HxWxF (до паддинга); пусто или "none" — без прогрева
+WARMUP_BUCKETS = os.environ.get("LTX_WARMUP_BUCKETS", "512x704x97")
+WARMUP_PROMPT = os.environ.get(
+    "LTX_WARMUP_PROMPT", "A calm lake at sunrise, gentle waves, slow camera pan over the water"
+)
+# torch.compile для трансформера и VAE decoder
+TORCH_COMPILE = os.environ.get("LTX_TORCH_COMPILE", "0") == "1"
+TORCH_COMPILE_MODE = os.environ.get("LTX_TORCH_COMPILE_MODE", "default")
+COMPILE_CACHE_DIR = os.environ.get("LTX_COMPILE_CACHE_DIR", "/runpod-volume/cache/torch_compile")
+MEGA_CACHE_FILE = "compile_artifacts.bin"
+
+
+def parse_buckets(text=WARMUP_BUCKETS):
+    """'512x704x97,736x1280x121' -> список padded (h, w, f) без повторов"""
+    buckets = []
+    if not text or text.strip().lower() in ("none", "0", "off"):
+        return buckets
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            bucket = parse_bucket(item)
+        except ValueError:
+            logger.warning(f"⚠️ Пропускаем некорректный bucket прогрева: {item}")
+            continue
+        if bucket not in buckets:
+            buckets.append(bucket)
+    return buckets
+
+
+class FirstRequestLatency:
+    """Задержка первого запроса каждого bucket'а: во время прогрева (холодная) и после него"""
+
+    def __init__(self):
+        self.warming_up = False
+        self.cold = {}
+        self.first = {}
+        self._lock = threading.Lock()
+
+    def record(self, bucket, seconds):
+        with self._lock:
+            if self.warming_up:
+                self.cold.setdefault(bucket, seconds)
+                return
+            if bucket in self.first:
+                return
+            self.first[bucket] = seconds
+        if bucket in self.cold:
+            logger.info(
+                f"🔥 Первый запрос {bucket_name(bucket)}: {seconds:.1f}с после прогрева "
+                f"(холодный, во время прогрева: {self.cold[bucket]:.1f}с)"
+            )
+        else:
+            logger.info(f"🧊 Первый запрос {bucket_name(bucket)}: {seconds:.1f}с (bucket не прогревался)")
+
+    def stats(self):
+        return {
+            "cold_seconds": {bucket_name(b): s for b, s in self.cold.items()},
+            "first_request_seconds": {bucket_name(b): s for b, s in self.first.items()},
+        }
+
+
+latency = FirstRequestLatency()
+
+
+def configure_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    """Кеш inductor/triton на томе + готовые артефакты прошлых запусков (если torch умеет)"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"⚠️ Кеш компиляции недоступен ({cache_dir}): {e}")
+        return False
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except Exception:
+        pass
+
+    artifacts_path = os.path.join(cache_dir, MEGA_CACHE_FILE)
+    if os.path.exists(artifacts_path) and hasattr(torch.compiler, "load_cache_artifacts"):
+        try:
+            with open(artifacts_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            logger.info(f"📦 Загружены артефакты компиляции: {artifacts_path}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось загрузить артефакты компиляции: {e}")
+    logger.info(f"📦 Кеш torch.compile: {os.environ['TORCHINDUCTOR_CACHE_DIR']}")
+    return True
+
+
+def save_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    """Сохраняем артефакты компиляции одним файлом (torch >= 2.7); иначе хватает кеша inductor"""
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return
+    try:
+        artifacts = torch.compiler.save_cache_artifacts()
+        if not artifacts:
+            return
+        data = artifacts[0]
+        path = os.path.join(cache_dir, MEGA_CACHE_FILE)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        logger.info(f"💾 Артефакты компиляции сохранены: {path} ({len(data) / 1024 / 1024:.1f}MB)")
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось сохранить артефакты компиляции: {e}")
+
+
+def compile_pipeline(pipeline, mode=TORCH_COMPILE_MODE):
+    """torch.compile на месте (module.compile) — ссылки pipeline на модули не меняются"""
+    video_pipeline = getattr(pipeline, "video_pipeline", pipeline)
+    # Формы фиксированы bucket'ами, dynamic=False даёт самые быстрые ядра
+    video_pipeline.transformer.compile(mode=mode, dynamic=False)
+    video_pipeline.vae.decoder.compile(mode=mode, dynamic=False)
+    logger.info(f"⚙️ torch.compile включён (mode={mode}): transformer, vae.decoder")
+
+
+def run_warmup(pipeline, run_fn, buckets=None):
+    """Прогоняем run_fn(height, width, num_frames) на каждом bucket'е; ошибки прогрева не фатальны"""
+    buckets = parse_buckets() if buckets is None else buckets
+    cache_ready = False
+    if TORCH_COMPILE:
+        cache_ready = configure_compile_cache()
+        compile_pipeline(pipeline)
+    if not buckets:
+        logger.info("🌡️ Прогрев отключён (LTX_WARMUP_BUCKETS пуст)")
+        return latency.stats()
+
+    logger.info(f"🌡️ Прогрев на {len(buckets)} bucket'ах: {', '.join(bucket_name(b) for b in buckets)}")
+    started_at = time.time()
+    latency.warming_up = True
+    try:
+        for height, width, num_frames in buckets:
+            bucket_started_at = time.time()
+            try:
+                run_fn(height, width, num_frames)
+            except Exception as e:
+                logger.warning(f"⚠️ Прогрев {height}x{width}x{num_frames} не удался: {e}")
+                continue
+            logger.info(f"🌡️ Прогрет {height}x{width}x{num_frames}: {time.time() - bucket_started_at:.1f}с")
+    finally:
+        latency.warming_up = False
+    if cache_ready:
+        save_compile_cache()
+    logger.info(f"🌡️ Прогрев завершён за {time.time() - started_at:.1f}с")
+    return latency.stats()
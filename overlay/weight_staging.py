@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Стейджинг весов с сетевого тома на локальный диск
+/workspace/LTX-Video/models -> /runpod-volume/models: каждый холодный старт читает десятки GB
+по сети с холодным page cache. Здесь чекпоинты копируются (или reflink) на локальный диск
+в фоне, пока идут импорты и грузятся лёгкие компоненты; загрузчик ждёт только тот файл,
+который ему нужен прямо сейчас (resolve()).
+Локальная копия переиспользуется, если совпадают размер, mtime и sha256 исходника.
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import shutil
+import threading
+
+logger = logging.getLogger(__name__)
+
+STAGE_WEIGHTS = os.environ.get("LTX_STAGE_WEIGHTS", "0") == "1"
+STAGE_DIR = os.environ.get("LTX_STAGE_DIR", "/workspace/.staged_weights")
+BLOCK_BYTES = int(float(os.environ.get("LTX_STAGE_BLOCK_MB", "64")) * 1024 * 1024)
+# sha256 во время копирования (сверяется с .sha256.json, который пишет download_weights.py)
+VERIFY = os.environ.get("LTX_STAGE_VERIFY", "1") == "1"
+# Запас свободного места на локальном диске
+FREE_SPACE_MARGIN = 1.05
+
+FICLONE = 0x40049409
+
+
+def config_weight_paths(pipeline_config_path):
+    """Чекпоинты из yaml конфига pipeline (в порядке, в котором они нужны загрузчику)"""
+    import yaml
+
+    try:
+        with open(pipeline_config_path) as f:
+            config = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        logger.warning(f"⚠️ Стейджинг: не удалось прочитать {pipeline_config_path}: {e}")
+        return []
+    paths = [config.get("checkpoint_path")]
+    if config.get("pipeline_type") == "multi-scale":
+        paths.append(config.get("spatial_upscaler_model_path"))
+    return [p for p in paths if p and os.path.isfile(p)]
+
+
+def _source_identity(src):
+    st = os.stat(src)
+    identity = {"source": os.path.realpath(src), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    # Хеш, записанный при загрузке весов (если есть)
+    try:
+        with open(f"{src}.sha256.json") as f:
+            identity["sha256"] = json.load(f).get("sha256")
+    except (OSError, ValueError):
+        identity["sha256"] = None
+    return identity
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_sequential(src, dst, block_bytes, verify):
+    """Крупные последовательные чтения с подсказками readahead; -> sha256 или None"""
+    digest = hashlib.sha256() if verify else None
+    with open(src, "rb", buffering=0) as fin, open(dst, "wb") as fout:
+        if _reflink(fin.fileno(), fout.fileno()):
+            logger.info(f"🔗 Стейджинг: reflink {os.path.basename(src)}")
+            return None
+        src_fd = fin.fileno()
+        os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(block_bytes)
+        view = memoryview(buffer)
+        offset = 0
+        while True:
+            # Просим ядро заранее читать следующие блоки, пока пишем текущий
+            os.posix_fadvise(src_fd, offset + block_bytes, block_bytes * 2, os.POSIX_FADV_WILLNEED)
+            n = fin.readinto(buffer)
+            if not n:
+                break
+            fout.write(view[:n])
+            if digest is not None:
+                digest.update(view[:n])
+            # Страницы тома больше не нужны: не вытесняем ими полезный page cache
+            os.posix_fadvise(src_fd, offset, n, os.POSIX_FADV_DONTNEED)
+            offset += n
+        fout.flush()
+        os.fsync(fout.fileno())
+    return digest.hexdigest() if digest is not None else None
+
+
+class WeightStager:
+    """Фоновое копирование весов; resolve(path) отдаёт локальную копию, когда она готова"""
+
+    def __init__(self, stage_dir=STAGE_DIR, block_bytes=BLOCK_BYTES, verify=VERIFY):
+        self.stage_dir = stage_dir
+        self.block_bytes = block_bytes
+        self.verify = verify
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def start(self, paths):
+        """Запускаем копирование в фоне (по потоку на файл)"""
+        try:
+            os.makedirs(self.stage_dir, exist_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Стейджинг отключён, нет доступа к {self.stage_dir}: {e}")
+            return
+        for path in paths:
+            key = os.path.realpath(path)
+            with self._lock:
+                if key in self._files:
+                    continue
+                entry = {
+                    "source": path,
+                    "path": path,
+                    "ready": threading.Event(),
+                    "stats": {"name": os.path.basename(path)},
+                }
+                self._files[key] = entry
+            threading.Thread(target=self._stage, args=(entry,), name="weight-stage", daemon=True).start()
+
+    def _stage(self, entry):
+        src = entry["source"]
+        stats = entry["stats"]
+        name = stats["name"]
+        local_path = os.path.join(self.stage_dir, name)
+        sidecar_path = f"{local_path}.stage.json"
+        started_at = time.time()
+        lock_file = None
+        try:
+            # На поде демонов по одному на GPU: копирует первый, остальные ждут и переиспользуют копию
+            lock_file = open(f"{local_path}.lock", "w")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            identity = _source_identity(src)
+            stats["bytes"] = identity["size"]
+
+            # Локальная копия от прошлого запуска (например, тот же под после рестарта)
+            try:
+                with open(sidecar_path) as f:
+                    recorded = json.load(f)
+            except (OSError, ValueError):
+                recorded = None
+            if recorded and os.path.exists(local_path) and os.path.getsize(local_path) == identity["size"]:
+                fresh = {k: recorded.get(k) for k in ("source", "size", "mtime_ns")} == \
+                    {k: identity[k] for k in ("source", "size", "mtime_ns")}
+                if fresh and (not identity["sha256"] or recorded.get("sha256") in (None, identity["sha256"])):
+                    entry["path"] = local_path
+                    stats.update(reused=True, copy_seconds=0.0)
+                    logger.info(f"♻️ Стейджинг: локальная копия {name} актуальна")
+                    return
+                logger.info(f"🔄 Стейджинг: локальная копия {name} устарела, копируем заново")
+            for stale in (local_path, sidecar_path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+            free = shutil.disk_usage(self.stage_dir).free
+            if free < identity["size"] * FREE_SPACE_MARGIN:
+                logger.warning(
+                    f"⚠️ Стейджинг: мало места для {name} "
+                    f"({free / 1024 ** 3:.1f}GB < {identity['size'] / 1024 ** 3:.1f}GB), читаем с тома"
+                )
+                stats["skipped"] = "no_space"
+                return
+
+            tmp_path = f"{local_path}.tmp.{os.getpid()}"
+            try:
+                sha256 = _copy_sequential(src, tmp_path, self.block_bytes, self.verify)
+                if sha256 and identity["sha256"] and sha256 != identity["sha256"]:
+                    raise IOError(f"sha256 копии {sha256} != {identity['sha256']}")
+                if os.path.getsize(tmp_path) != identity["size"]:
+                    raise IOError("размер копии не совпал")
+                os.replace(tmp_path, local_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            with open(sidecar_path, "w") as f:
+                json.dump({**identity, "sha256": sha256 or identity["sha256"]}, f)
+
+            entry["path"] = local_path
+            stats["copy_seconds"] = time.time() - started_at
+            logger.info(
+                f"💾 Стейджинг: {name} {identity['size'] / 1024 ** 3:.1f}GB за {stats['copy_seconds']:.1f}с "
+                f"({identity['size'] / max(stats['copy_seconds'], 1e-6) / 1024 ** 2:.0f}MB/s)"
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Стейджинг {name} не удался, читаем с тома: {e}")
+            stats["error"] = str(e)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+            entry["ready"].set()
+
+    def resolve(self, path):
+        """Путь для загрузки: локальная копия (ждём её готовности) или исходный путь"""
+        with self._lock:
+            entry = self._files.get(os.path.realpath(path))
+        if entry is None:
+            return path
+        waited_at = time.time()
+        entry["ready"].wait()
+        blocked = time.time() - waited_at
+        entry["stats"]["blocked_seconds"] = entry["stats"].get("blocked_seconds", 0.0) + blocked
+        if blocked > 0.1:
+            logger.info(f"⏳ Загрузчик ждал стейджинг {entry['stats']['name']}: {blocked:.1f}с")
+        return entry["path"]
+
+    def report(self):
+        """Сколько чтения с тома ушло в фон: копирование минус время, которое загрузчик его ждал"""
+        with self._lock:
+            files = [dict(entry["stats"]) for entry in self._files.values()]
+        copy_seconds = sum(f.get("copy_seconds", 0.0) for f in files)
+        blocked_seconds = sum(f.get("blocked_seconds", 0.0) for f in files)
+        return {
+            "files": files,
+            "staged_bytes": sum(f.get("bytes", 0) for f in files if "copy_seconds" in f),
+            "copy_seconds": round(copy_seconds, 3),
+            "blocked_seconds": round(blocked_seconds, 3),
+            # Чтение с тома, которое загрузчик сделал бы сам, минус то, что он всё-таки прождал
+            "saved_seconds": round(max(copy_seconds - blocked_seconds, 0.0), 3),
+        }
+
+
+stager = WeightStager()
+
+
+def start_from_config(pipeline_config_path):
+    """Запуск стейджинга до тяжёлых импортов (если включён LTX_STAGE_WEIGHTS)"""
+    if not STAGE_WEIGHTS:
+        return
+    paths = config_weight_paths(pipeline_config_path)
+    if paths:
+        logger.info(f"🚚 Стейджинг весов в {STAGE_DIR}: {', '.join(os.path.basename(p) for p in paths)}")
+        stager.start(paths)
+
+
+def resolve(path):
+    return stager.resolve(path)
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import os
 import sys
-import base64
 import io
+import base64
 import uuid
+import threading
 from typing import Any, Dict
 
 import runpod
@@ -21,7 +22,7 @@ def _ensure_env():
     os.environ.setdefault("HUGGINGFACE_HUB_CACHE", HF_CACHE)
     os.environ.setdefault("TRANSFORMERS_CACHE", HF_CACHE)
     os.environ.setdefault("DIFFUSERS_CACHE", HF_CACHE)
-    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", os.environ.get("LTX_DAEMON_DEVICE", "0"))
 
 
 def _prepare_imports():
@@ -51,6 +52,15 @@ def init():
     _ensure_env()
     _prepare_imports()
 
+    # /metrics воркера: загрузки результатов в хранилище идут в этом процессе (ltx_uploaded_bytes)
+    import metrics
+    metrics.serve_process()
+
+    # Таймлайн старта: фазы init() и load_models_once(), JSON рядом с daemon_ready.flag
+    import startup_timeline
+    timeline = startup_timeline.timeline
+    timeline.event("init_started")
+
     # Переходим в директорию проекта LTX-Video
     os.chdir(LTX_DIR)
     logger.info(f"🔧 Рабочая директория: {os.getcwd()}")
@@ -62,8 +72,9 @@ def init():
     ]
     
     logger.info(f"🔍 Проверяем наличие весов...")
-    for candidate in ckpt_candidates:
-        logger.info(f"  - {candidate}: {'✅ найден' if os.path.exists(candidate) else '❌ не найден'}")
+    with timeline.phase("weights_check"):
+        for candidate in ckpt_candidates:
+            logger.info(f"  - {candidate}: {'✅ найден' if os.path.exists(candidate) else '❌ не найден'}")
     
     if not any(os.path.exists(p) for p in ckpt_candidates):
         raise RuntimeError(f"Веса модели не найдены! Проверьте: {ckpt_candidates}")
@@ -74,10 +85,15 @@ def init():
         raise RuntimeError(f"Конфиг не найден: {config_path}")
     logger.info(f"✅ Конфиг найден: {config_path}")
 
+    # Копирование весов с тома на локальный диск идёт в фоне, пока импортируются torch/ltx_video
+    import weight_staging
+    weight_staging.start_from_config(config_path)
+
     # Импортируем модуль демона и загружаем модели
     import importlib
     try:
-        daemon = importlib.import_module('inference_daemon_official')
+        with timeline.phase("import_daemon"):
+            daemon = importlib.import_module('inference_daemon_official')
         logger.info("✅ Модуль inference_daemon_official импортирован")
     except Exception as e:
         raise RuntimeError(f"Ошибка импорта inference_daemon_official: {e}")
@@ -90,6 +106,9 @@ def init():
     except Exception as e:
         raise RuntimeError(f"Ошибка при загрузке моделей: {e}")
 
+    # Прогрев частых размеров до первой задачи (ошибки прогрева не фатальны)
+    daemon.warmup_pipeline()
+
     # Ставит флаг готовности (используется и в оригинальном стартапе)
     daemon.create_ready_flag()
     logger.info("✅ Флаг готовности создан")
@@ -113,15 +132,46 @@ def init():
     logger.info("✅ Инициализация завершена успешно")
 
 
-def _decode_image_to_file(image_base64: str) -> str:
-    from PIL import Image
-    image_bytes = base64.b64decode(image_base64.split(',')[1] if ',' in image_base64 else image_base64)
-    image = Image.open(io.BytesIO(image_bytes))
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    filename = f"temp_image_{uuid.uuid4().hex}.jpg"
-    image.save(filename)
-    return filename
+def _cached_response(request_id, cache, cache_key, video_path, meta):
+    """Ответ из кеша результатов: ссылка на уже загруженный объект, новая загрузка или base64"""
+    import logging
+    import result_uploader
+    logger = logging.getLogger(__name__)
+
+    result_name = meta.get("result_name") or f"ltxv_{request_id}_{uuid.uuid4().hex[:8]}.mp4"
+    result_url = None
+    video_base64 = None
+    uploader = result_uploader.get_uploader()
+    if uploader is not None:
+        object_key = meta.get("object_key")
+        if object_key and meta.get("bucket") == uploader.bucket:
+            # Объект мог удалить lifecycle бакета — проверяем, прежде чем подписывать ссылку
+            try:
+                uploader.client.head_object(Bucket=uploader.bucket, Key=object_key)
+                result_url = uploader.presigned_url(object_key)
+            except Exception:
+                result_url = None
+        if result_url is None:
+            try:
+                with open(video_path, "rb") as f:
+                    result_url = uploader.upload_fileobj(f, result_name)
+                cache.update_meta(cache_key, object_key=uploader.object_key(result_name), bucket=uploader.bucket)
+            except (OSError, result_uploader.UploadError) as e:
+                logger.warning(f"⚠️ [{request_id}] Не удалось загрузить результат из кеша: {e}")
+    if result_url is None:
+        try:
+            with open(video_path, "rb") as f:
+                video_base64 = result_uploader.encode_base64_chunked(f)
+        except (OSError, result_uploader.Base64LimitExceeded) as e:
+            return {"status": "ERROR", "error": str(e)}
+    return {
+        "status": "SUCCESS",
+        "result_path": result_name,
+        "result_url": result_url,
+        "video_base64": video_base64,
+        "all_results": [result_name],
+        "cached": True,
+    }
 
 
 def handler(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -135,6 +185,10 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
     - num_frames (int, optional)
     - seed (int, optional)
     - image_base64 (str, optional) — для image-to-video
+    - preview ("poster" | "clip" | "off", optional) — превью из первого прохода в прогрессе задачи
+    - oversize ("reject" | "downscale", optional) — что делать, если размер не помещается в память GPU
+    - vae_tiling ("auto" | "on" | "off", optional) — декодирование VAE тайлами (большие разрешения, длинные клипы)
+    - action="status" — вместо генерации вернуть готовность и таймлайн холодного старта
     """
     import logging
     import torch
@@ -157,9 +211,49 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
         return {"status": "ERROR", "error": "payload.input is missing"}
 
     data = event["input"] or {}
+    global global_pipeline, global_pipeline_config
+
+    # Статус воркера без генерации (и без загрузки моделей): таймлайн холодного старта
+    if data.get("action") == "status":
+        import startup_timeline
+        return {
+            "status": "OK",
+            "ready": global_pipeline is not None,
+            "startup_timeline": startup_timeline.timeline.to_dict(),
+        }
+
+    prompt = data.get("prompt")
+    if not prompt:
+        return {"status": "ERROR", "error": "prompt is required"}
+
+    negative_prompt = data.get("negative_prompt", "worst quality, inconsistent motion, blurry, jittery, distorted")
+    width = int(data.get("width", 1280))
+    height = int(data.get("height", 720))
+    num_frames = int(data.get("num_frames", 120))
+    seed = int(data.get("seed", 42))
+    image_b64 = data.get("image_base64")
+
+    # Повтор уже сгенерированного (ретрай, дубль вебхука) — из кеша результатов, без init() и GPU
+    import result_cache
+    cache = result_cache.get_cache()
+    cache_key = result_cache.command_key({
+        "prompt": prompt,
+        "negative_prompt": negative_prompt,
+        "height": height,
+        "width": width,
+        "num_frames": num_frames,
+        "seed": seed,
+        "image_base64": image_b64,
+        # Тайлы VAE меняют пиксели результата; oversize — как в команде Celery (уменьшенное в кеш не попадает)
+        "vae_tiling": data.get("vae_tiling"),
+        "oversize": data.get("oversize"),
+    }, pipeline_config_path=os.path.join(LTX_DIR, "ltxv-13b-0.9.8-distilled.yaml"))
+    hit = cache.get(cache_key)
+    if hit is not None:
+        logger.info(f"🎯 [{request_id}] Результат из кеша")
+        return _cached_response(request_id, cache, cache_key, *hit)
 
     # Проверяем что модель загружена, если нет - вызываем init()
-    global global_pipeline, global_pipeline_config
     if global_pipeline is None or global_pipeline_config is None:
         logger.info(f"🔵 [{request_id}] Модель не загружена, вызываем init()...")
         try:
@@ -175,6 +269,25 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
             return {"status": "ERROR", "error": "Model still not loaded after init()"}
     
     logger.info(f"🔵 [{request_id}] Параметры: {data.get('width')}x{data.get('height')}x{data.get('num_frames')}")
+
+    # Допуск по прогнозу пика памяти — до любой работы на GPU, а не OOM через минуты генерации
+    import memory_model
+    import tiled_vae
+    try:
+        vae_tiling = tiled_vae.parse_mode(data.get("vae_tiling"))
+    except ValueError as e:
+        return {"status": "ERROR", "error": str(e)}
+    admission = memory_model.admission.admit(
+        tiled_vae.admission_kind(global_pipeline, vae_tiling), height, width, num_frames, oversize=data.get("oversize"),
+    )
+    if admission.action == "reject":
+        logger.error(f"🔴 [{request_id}] Не помещается в память GPU: {admission.reason}")
+        return {"status": "ERROR", "error": f"insufficient GPU memory: {admission.reason}", "admission": admission.to_dict()}
+    if admission.action == "downscale":
+        logger.warning(f"🟠 [{request_id}] {admission.reason}")
+        height, width = admission.height, admission.width
+        # Уменьшенный результат не кладём в кеш под ключом исходного запроса
+        cache_key = None
     
     # Логируем память ДО обработки
     if torch.cuda.is_available():
@@ -182,24 +295,17 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
         memory_reserved_before = torch.cuda.memory_reserved() / 1024**3
         logger.info(f"🧠 [{request_id}] Память ДО: allocated={memory_before:.2f}GB, reserved={memory_reserved_before:.2f}GB")
 
-    prompt = data.get("prompt")
-    if not prompt:
-        return {"status": "ERROR", "error": "prompt is required"}
+    # Время и пик памяти по этапам — в ответе (profile)
+    import stage_profile
+    profile = stage_profile.StageProfile()
 
-    negative_prompt = data.get("negative_prompt", "worst quality, inconsistent motion, blurry, jittery, distorted")
-    width = int(data.get("width", 1280))
-    height = int(data.get("height", 720))
-    num_frames = int(data.get("num_frames", 120))
-    seed = int(data.get("seed", 42))
-    image_b64 = data.get("image_base64")
-
-    # Подготовка image-to-video, если передано изображение
-    conditioning_media_paths = None
-    tmp_image_path = None
+    # Подготовка image-to-video, если передано изображение: декодируем в памяти, без временного файла
+    conditioning_images = None
     if image_b64:
         try:
-            tmp_image_path = _decode_image_to_file(image_b64)
-            conditioning_media_paths = [tmp_image_path]
+            from conditioning import decode_base64_image
+            with profile.stage("input_decode"):
+                conditioning_images = [decode_base64_image(image_b64)]
         except Exception as e:
             return {"status": "ERROR", "error": f"failed to decode image: {e}"}
 
@@ -215,80 +321,126 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
         frame_rate=24,
     )
 
-    if conditioning_media_paths:
-        config.conditioning_media_paths = conditioning_media_paths
+    if conditioning_images:
         config.conditioning_start_frames = [0]
 
+    import result_uploader
+    import progress
+    import preview
+    # Прогресс по шагам и этапам — в RunPod (виден в /status задачи как output с IN_PROGRESS);
+    # progress_extra (превью) повторяется в каждом следующем обновлении — /status отдаёт только последнее
+    progress_extra = {}
+    tracker = progress.ProgressTracker(
+        sinks=[lambda update: runpod.serverless.progress_update(event, {**update, **progress_extra})],
+        extra_stages=("upload",),
+    )
+    result_name = f"ltxv_{request_id}_{uuid.uuid4().hex[:8]}.mp4"
+    try:
+        preview_mode = preview.parse_mode(data.get("preview"))
+    except ValueError as e:
+        return {"status": "ERROR", "error": str(e)}
+    # С настроенным хранилищем MP4 из ffmpeg сразу уходит в S3 частями (multipart), пока идёт кодирование
+    uploader = result_uploader.get_uploader()
+    upload_stream = uploader.open_stream(result_name) if uploader is not None else None
+
+    def on_preview(index, preview_data, fmt):
+        # Превью маленькое: в хранилище, если оно есть, иначе base64 прямо в прогрессе
+        if uploader is not None:
+            try:
+                progress_extra["preview_url"] = uploader.upload_fileobj(
+                    io.BytesIO(preview_data), f"preview_{result_name.rsplit('.', 1)[0]}.{fmt}",
+                    content_type="image/jpeg" if fmt == "jpg" else "video/mp4",
+                )
+            except result_uploader.UploadError as e:
+                logger.warning(f"⚠️ [{request_id}] Превью не загружено: {e}")
+        if "preview_url" not in progress_extra:
+            progress_extra["preview_base64"] = base64.b64encode(preview_data).decode("ascii")
+        progress_extra["preview_format"] = fmt
+        tracker.refresh()
+
     # Генерация через оптимизированную функцию демона с уже загруженным pipeline
     logger.info(f"🟢 [{request_id}] Запускаем генерацию...")
     try:
-        result_paths = infer_with_ready_pipeline(config, global_pipeline, global_pipeline_config)
-        logger.info(f"🟢 [{request_id}] Генерация завершена, результат: {result_paths}")
+        # MP4 кодируется сразу в память (или поток загрузки) — без записи на диск и повторного чтения
+        result_videos = infer_with_ready_pipeline(
+            config, global_pipeline, global_pipeline_config,
+            in_memory=True, conditioning_images=conditioning_images, output=upload_stream,
+            progress_tracker=tracker, preview_mode=preview_mode, on_preview=on_preview, vae_tiling=vae_tiling,
+            profile=profile,
+        )
+        logger.info(f"🟢 [{request_id}] Генерация завершена")
     except Exception as e:
         logger.error(f"🔴 [{request_id}] Ошибка генерации: {e}", exc_info=True)
-        # Уборка временного файла
-        if tmp_image_path and os.path.exists(tmp_image_path):
-            try:
-                os.remove(tmp_image_path)
-            except Exception:
-                pass
-        return {"status": "ERROR", "error": str(e)}
-
-    # Уборка временного файла изображения
-    if tmp_image_path and os.path.exists(tmp_image_path):
-        try:
-            os.remove(tmp_image_path)
-        except Exception:
-            pass
-
-    if not result_paths:
+        tracker.finish()
+        if upload_stream is not None:
+            # Недокодированный MP4 не завершаем как результат: отменяем multipart / put_object
+            upload_stream.abort(f"ошибка генерации: {e}")
+            upload_stream.discard()
+        return {"status": "ERROR", "error": str(e), "profile": profile.to_dict()}
+
+    if not result_videos:
         return {"status": "ERROR", "error": "no output produced"}
 
-    # Пытаемся загрузить файл в хранилище RunPod и вернуть публичный URL
     result_url = None
-    try:
-        from runpod.serverless.utils import rp_upload
-        upload_result = rp_upload.upload_file_to_bucket(result_paths[0])
-        if isinstance(upload_result, str):
-            result_url = upload_result
-        elif isinstance(upload_result, dict):
-            result_url = upload_result.get("url") or upload_result.get("file_url")
-    except Exception:
-        result_url = None
+    video_bytes = None
+    tracker.stage("upload")
+    with profile.stage("upload"):
+        if upload_stream is not None:
+            # Дожидаемся последних частей; при ошибке данные остаются во временном файле для фолбэка
+            result_url = upload_stream.close()
+        else:
+            video_bytes = result_videos[0]
+            logger.info(f"🟢 [{request_id}] Видео: {len(video_bytes)} байт")
+            # Хранилище не настроено для boto3 — пробуем загрузчик RunPod
+            try:
+                from runpod.serverless.utils import rp_upload
+                upload_result = rp_upload.upload_in_memory_object(result_name, video_bytes)
+                if isinstance(upload_result, str):
+                    result_url = upload_result
+                elif isinstance(upload_result, dict):
+                    result_url = upload_result.get("url") or upload_result.get("file_url")
+            except Exception:
+                result_url = None
+    tracker.finish()
 
     logger.info(f"🟡 [{request_id}] Начинаем обработку результата...")
     
-    # Принудительная очистка GPU памяти ПЕРЕД загрузкой результата в base64
+    # Очистка GPU памяти перед base64 — по политике LTX_CACHE_FLUSH_POLICY (always — как раньше)
     try:
-        import torch
-        if torch.cuda.is_available():
-            before_alloc = torch.cuda.memory_allocated() / 1024**3
-            before_cached = torch.cuda.memory_reserved() / 1024**3
-            logger.info(f"🟡 [{request_id}] GPU память ПЕРЕД очисткой: {before_alloc:.2f}GB allocated, {before_cached:.2f}GB cached")
-            
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-            import gc
-            gc.collect()
-            
-            after_alloc = torch.cuda.memory_allocated() / 1024**3
-            after_cached = torch.cuda.memory_reserved() / 1024**3
-            logger.info(f"🟡 [{request_id}] GPU память ПОСЛЕ очистки: {after_alloc:.2f}GB allocated, {after_cached:.2f}GB cached")
-            logger.info(f"🟡 [{request_id}] Освобождено: {before_alloc - after_alloc:.2f}GB allocated, {before_cached - after_cached:.2f}GB cached")
+        memory_model.flush("idle")
     except Exception as e:
         logger.error(f"🔴 [{request_id}] Ошибка очистки памяти: {e}")
     
-    # Если S3 не настроен, возвращаем видео как base64
+    # Если S3 не настроен или загрузка не удалась, возвращаем видео как base64 (кусками, с лимитом размера)
     video_base64 = None
+    result_error = None
     if result_url is None:
         try:
             logger.info(f"🟡 [{request_id}] Кодируем видео в base64...")
-            with open(result_paths[0], 'rb') as f:
-                video_bytes = f.read()
-                video_base64 = base64.b64encode(video_bytes).decode('utf-8')
+            source = upload_stream.reader() if upload_stream is not None else io.BytesIO(video_bytes)
+            with profile.stage("base64"):
+                video_base64 = result_uploader.encode_base64_chunked(source)
             logger.info(f"🟡 [{request_id}] base64 размер: {len(video_base64) / 1024 / 1024:.2f}MB")
+        except result_uploader.Base64LimitExceeded as e:
+            result_error = str(e)
+            logger.error(f"🔴 [{request_id}] {e}")
         except Exception as e:
             logger.error(f"🔴 [{request_id}] Ошибка кодирования base64: {e}")
+    # В кеш результатов — в фоне, ответ не ждёт записи на том
+    cache_source = upload_stream.reader() if upload_stream is not None else video_bytes
+    cache_meta = {"result_name": result_name, "prompt": prompt, "seed": seed}
+    if upload_stream is not None and result_url is not None:
+        cache_meta.update(object_key=upload_stream.key, bucket=uploader.bucket)
+
+    def store_result():
+        try:
+            cache.put(cache_key, cache_source, **cache_meta)
+        finally:
+            if upload_stream is not None:
+                upload_stream.discard()
+
+    threading.Thread(target=store_result, name="result-cache", daemon=True).start()
+    del video_bytes
     
     # Финальное логирование памяти
     if torch.cuda.is_available():
@@ -297,15 +449,23 @@ def handler(event: Dict[str, Any]) -> Dict[str, Any]:
         logger.info(f"🧠 [{request_id}] Память ПОСЛЕ: allocated={memory_after:.2f}GB, reserved={memory_reserved_after:.2f}GB")
         logger.info(f"🧠 [{request_id}] Изменение памяти: allocated={memory_after - memory_before:+.2f}GB, reserved={memory_reserved_after - memory_reserved_before:+.2f}GB")
     
-    # Возвращаем путь, URL (если есть) и base64 (если нет URL)
+    # Возвращаем имя результата, URL (если есть) и base64 (если нет URL)
     logger.info(f"✅ [{request_id}] Handler завершен успешно")
-    return {
+    response = {
         "status": "SUCCESS",
-        "result_path": result_paths[0],
+        "result_path": result_name,
         "result_url": result_url,
         "video_base64": video_base64,
-        "all_results": result_paths,
+        "all_results": [result_name],
+        "profile": profile.to_dict(),
     }
+    if admission.action == "downscale":
+        response["admission"] = {**admission.to_dict(), "requested": [int(data.get("width", 1280)), int(data.get("height", 720))]}
+    if result_error:
+        # Видео сгенерировано, но отдать его некуда
+        response["status"] = "ERROR"
+        response["error"] = result_error
+    return response
 
 
 runpod.serverless.start({
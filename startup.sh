@@ -144,12 +144,9 @@ apt-get install -y --no-install-recommends redis-server
 
 # ── 9) Весы модели ──────────────────────────────────────────────────────────
 cd "$LTX_DIR"
-if [ ! -f "models/ltxv-13b-0.9.8-distilled/model.safetensors" ]; then
-  echo "🎬 Загружаем весы модели..."
-  "$VENV_DIR/bin/python" download_weights.py
-else
-  echo "✅ Веса модели уже загружены, пропускаем"
-fi
+# Докачка и проверка sha256; при валидном маркере скрипт сразу выходит
+echo "🎬 Проверяем весы модели..."
+"$VENV_DIR/bin/python" download_weights.py --marker "models/.models_ready"
 
 # ── 10) Запуск сервисов ──────────────────────────────────────────────────────
 echo "🚦 Запускаем Redis..."
@@ -158,7 +155,8 @@ sleep 2
 
 # Ожидание готовности демона
 wait_for_daemon() {
-  local max_wait=300
+  # Флаг ставится после прогрева (LTX_WARMUP_BUCKETS), поэтому ждём дольше самой загрузки
+  local max_wait=${LTX_DAEMON_READY_TIMEOUT:-600}
   local elapsed=0
   local check_interval=10
   echo "⏳ Ожидаем готовности inference демона (максимум ${max_wait}с)..."
@@ -196,18 +194,47 @@ check_process() {
   fi
 }
 
-echo "🚦 Запускаем inference демон (логи в inference_daemon_official.log)..."
-cd "$LTX_DIR"
-nohup "$VENV_DIR/bin/python" run_inference_daemon_official.py > inference_daemon_official.log 2>&1 &
-DAEMON_PID=$!
-echo "📋 Демон запущен с PID: $DAEMON_PID"
+# По одному демону на GPU: все читают общую очередь inference_commands/ с арендой задач
+NUM_GPUS="${LTX_NUM_DAEMONS:-$(nvidia-smi -L 2>/dev/null | wc -l)}"
+if [ "$NUM_GPUS" -lt 1 ]; then
+  NUM_GPUS=1
+fi
+
+# Лог демона: первый GPU пишет в привычный inference_daemon_official.log
+daemon_log() {
+  if [ "$1" -eq 0 ]; then
+    echo "inference_daemon_official.log"
+  else
+    echo "inference_daemon_official_gpu$1.log"
+  fi
+}
+
+start_daemon() {
+  local device=$1
+  local log_file
+  log_file=$(daemon_log "$device")
+  cd "$LTX_DIR"
+  LTX_DAEMON_LOG="$log_file" nohup "$VENV_DIR/bin/python" run_inference_daemon_official.py --device "$device" > "$log_file.stdout" 2>&1 &
+}
+
+echo "🚦 Запускаем inference демоны: $NUM_GPUS шт. (логи в inference_daemon_official*.log)..."
+DAEMON_PIDS=()
+for device in $(seq 0 $((NUM_GPUS - 1))); do
+  start_daemon "$device"
+  DAEMON_PIDS+=($!)
+  echo "📋 Демон GPU $device запущен с PID: $!"
+done
 
 sleep 5
-if ! kill -0 $DAEMON_PID 2>/dev/null; then
-  echo "❌ Демон завершился сразу после запуска! Последние строки лога:"
-  tail -n 20 inference_daemon_official.log || true
-  exit 1
-fi
+# Индекс в DAEMON_PIDS — номер GPU демона: показываем лог именно упавшего
+for device in "${!DAEMON_PIDS[@]}"; do
+  pid=${DAEMON_PIDS[$device]}
+  if ! kill -0 "$pid" 2>/dev/null; then
+    echo "❌ Демон GPU $device (PID $pid) завершился сразу после запуска! Последние строки лога:"
+    tail -n 20 "$(daemon_log "$device").stdout" || true
+    exit 1
+  fi
+done
 echo "✅ Демон успешно запущен, ждём загрузки моделей..."
 
 if wait_for_daemon; then
@@ -277,11 +304,12 @@ echo "🛡️ Держим процессы живыми..."
 while true; do
   sleep 30
 
-  if ! pgrep -f "run_inference_daemon_official.py" >/dev/null; then
-    echo "⚠️ Inference демон упал! Перезапускаем..."
-    cd "$LTX_DIR"
-    nohup "$VENV_DIR/bin/python" run_inference_daemon_official.py > inference_daemon_restart.log 2>&1 &
-  fi
+  for device in $(seq 0 $((NUM_GPUS - 1))); do
+    if ! pgrep -f "run_inference_daemon_official.py --device $device\$" >/dev/null; then
+      echo "⚠️ Inference демон GPU $device упал! Перезапускаем (его задачи вернутся в очередь по истечении аренды)..."
+      start_daemon "$device"
+    fi
+  done
 
   if ! pgrep -f "celery.*my_celery" >/dev/null; then
     echo "⚠️ Celery воркер упал! Перезапускаем..."